@@ -0,0 +1,71 @@
+"""
+Micro-benchmark of the FCast codec: encode and decode throughput per opcode.
+
+Encode measures encode_packet() for the messages the receiver sends. Decode
+measures a full FCastSession.process_bytes() pass for the messages senders send
+(framing, opcode dispatch and JSON decoding), which gives packets per second
+per core for the receive path.
+
+Usage: python benchmarks/bench_codec.py [iterations]
+"""
+import sys
+import time
+
+import headless # Kodi stub modules
+
+from fcast_plugin.FCastCodec import JSON_BACKEND, encode_packet
+from fcast_plugin.FCastPackets import *
+from fcast_plugin.FCastSession import Event, FCastSession
+
+class NullClient:
+    def send(self, data) -> int:
+        return len(data)
+
+    sendall = send
+
+    def close(self):
+        pass
+
+OUTGOING = [
+    (OpCode.PLAYBACK_UPDATE, PlayBackUpdateMessage(120, PlayBackState.PLAYING, duration=3600)),
+    (OpCode.VOLUME_UPDATE, VolumeUpdateMessage(0.5)),
+    (OpCode.VERSION, VersionMessage(1)),
+    (OpCode.PONG, None),
+]
+
+INCOMING = [
+    (OpCode.PLAY, PlayMessage('video/mp4', url='https://example.com/video.mp4', time=10, headers={'User-Agent': 'FCast'})),
+    (OpCode.SEEK, SeekMessage(42.5)),
+    (OpCode.SET_VOLUME, SetVolumeMessage(0.75)),
+    (OpCode.SET_SPEED, SetSpeedMessage(1.5)),
+    (OpCode.PAUSE, None),
+    (OpCode.PING, None),
+    (OpCode.VERSION, VersionMessage(1)),
+]
+
+def rate(iterations: int, elapsed: float) -> str:
+    return '%12.0f %12.3f' % (iterations / elapsed, elapsed / iterations * 1e6)
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    print('JSON backend: %s' % JSON_BACKEND)
+    print('%-8s %-16s %12s %12s' % ('', 'opcode', 'packets/s', 'us/packet'))
+
+    for opcode, message in OUTGOING:
+        start = time.perf_counter()
+        for _ in range(iterations):
+            encode_packet(opcode, message)
+        print('%-8s %-16s %s' % ('encode', opcode.name, rate(iterations, time.perf_counter() - start)))
+
+    for opcode, message in INCOMING:
+        session = FCastSession(NullClient()) # type: ignore[arg-type]
+        for event in Event:
+            session.on(event, lambda s, m: None)
+        packet = encode_packet(opcode, message)
+        start = time.perf_counter()
+        for _ in range(iterations):
+            session.process_bytes(packet)
+        print('%-8s %-16s %s' % ('decode', opcode.name, rate(iterations, time.perf_counter() - start)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+"""
+Volume and speed control against the headless Kodi stub.
+
+A sender drags a volume slider: --volumes SET_VOLUME packets --gap seconds
+apart, then a few SET_SPEED packets. The stub's executeJSONRPC double counts
+the round trips and the calls they carried; the sender counts the
+VOLUME_UPDATE packets it receives, which should be one per effective change
+(plus the initial volume), not one per packet.
+
+Usage: python benchmarks/bench_control.py [--volumes 100] [--gap 0.005] [--asyncio]
+"""
+import argparse
+import socket
+import struct
+import sys
+import threading
+import time
+from typing import Dict
+
+import headless
+
+import xbmc
+from fcast_plugin.FCastCodec import encode_packet, json_loads
+from fcast_plugin.FCastPackets import *
+
+class Receiver(threading.Thread):
+    """Counts the packets the receiver sends to the sender, by opcode"""
+
+    def __init__(self, sock: socket.socket):
+        super().__init__(name='sender-reader', daemon=True)
+        self.sock = sock
+        self.counts: Dict[int, int] = {}
+        self.last_volume = None
+        self.last_speed = None
+
+    def run(self):
+        buffer = bytearray()
+        while True:
+            try:
+                data = self.sock.recv(65536)
+            except OSError:
+                return
+            if not data:
+                return
+            buffer += data
+            while len(buffer) >= 5:
+                length = struct.unpack_from('<I', buffer)[0]
+                if len(buffer) < 4 + length:
+                    break
+                opcode = buffer[4]
+                body = bytes(buffer[5:4 + length])
+                del buffer[:4 + length]
+                self.counts[opcode] = self.counts.get(opcode, 0) + 1
+                if opcode == OpCode.VOLUME_UPDATE:
+                    self.last_volume = json_loads(body)['volume']
+                elif opcode == OpCode.PLAYBACK_UPDATE:
+                    self.last_speed = json_loads(body).get('speed')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--volumes', type=int, default=100)
+    parser.add_argument('--gap', type=float, default=0.005)
+    parser.add_argument('--asyncio', action='store_true', help='serve clients from the asyncio transport')
+    args = parser.parse_args()
+    sys.argv = [sys.argv[0]]
+
+    receiver = headless.start_receiver(use_asyncio=args.asyncio)
+    headless.wait_for_port()
+    sock = socket.create_connection(('127.0.0.1', headless.FCAST_PORT))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    reader = Receiver(sock)
+    reader.start()
+    sock.sendall(encode_packet(OpCode.VERSION, VersionMessage(3)))
+    sock.sendall(encode_packet(OpCode.PLAY, PlayMessage('video/mp4', url='file:///tmp/video.mp4')))
+    time.sleep(0.5)
+    round_trips = xbmc.rpc_round_trips
+
+    start = time.perf_counter()
+    for index in range(args.volumes):
+        # Slider moving down from 100% to 0%
+        sock.sendall(encode_packet(OpCode.SET_VOLUME, SetVolumeMessage(1 - (index + 1) / args.volumes)))
+        time.sleep(args.gap)
+    for speed in (1.5, 2.0, 2.0, 1.0):
+        sock.sendall(encode_packet(OpCode.SET_SPEED, SetSpeedMessage(speed)))
+    burst = time.perf_counter() - start
+    time.sleep(0.5)
+
+    print('%-32s %d packets in %.0f ms' % ('SET_VOLUME burst', args.volumes, burst * 1000))
+    print('%-32s %d' % ('JSON-RPC round trips', xbmc.rpc_round_trips - round_trips))
+    for method, count in sorted(xbmc.rpc_calls.items()):
+        print('%-32s %d' % ('  ' + method, count))
+    print('%-32s %d (last volume %s)' % ('VOLUME_UPDATE received', reader.counts.get(OpCode.VOLUME_UPDATE, 0), reader.last_volume))
+    print('%-32s %d (last speed %s)' % ('PLAYBACK_UPDATE received', reader.counts.get(OpCode.PLAYBACK_UPDATE, 0), reader.last_speed))
+
+    headless.stop_receiver(receiver)
+    sock.close()
+
+if __name__ == '__main__':
+    main()
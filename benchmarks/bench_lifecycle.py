@@ -0,0 +1,100 @@
+"""
+Startup and shutdown timing of the receiver against the headless Kodi stub.
+
+- import: importing fcast_plugin.main in a fresh interpreter
+- startup: from calling main() until port 46899 accepts connections
+- shutdown: from Kodi's abort request until main() returned, with connected
+  clients and, with --play, the lazily started subsystems (HTTP server,
+  playback reporter) running
+- threads left: threads of this process still alive after shutdown
+
+Usage: python benchmarks/bench_lifecycle.py [--runs 5] [--clients 5] [--play] [--asyncio]
+"""
+import argparse
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from typing import List
+
+import headless
+
+import xbmc
+from fcast_plugin.FCastCodec import encode_packet
+from fcast_plugin.FCastPackets import *
+
+DASH_MANIFEST = '<?xml version="1.0"?><MPD><BaseURL>http://127.0.0.1:9/</BaseURL></MPD>'
+
+def import_time() -> float:
+    code = 'import time, headless; start = time.perf_counter(); import fcast_plugin.main; print(time.perf_counter() - start)'
+    output = subprocess.check_output([sys.executable, '-c', code], cwd=headless.BENCHMARKS_DIR)
+    return float(output.decode().strip())
+
+def wait_until_listening(timeout: float = 10) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', headless.FCAST_PORT), timeout=0.5).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise TimeoutError('Receiver did not start listening')
+            time.sleep(0.001)
+
+def receiver_threads() -> int:
+    # Threads of the simulated Kodi player are not the receiver's
+    return sum(1 for thread in threading.enumerate() if not thread.name.startswith(xbmc.KODI_THREAD_PREFIX))
+
+def run_once(args: argparse.Namespace):
+    baseline = receiver_threads()
+
+    start = time.perf_counter()
+    receiver = headless.start_receiver(use_asyncio=args.asyncio)
+    wait_until_listening()
+    startup = time.perf_counter() - start
+
+    clients: List[socket.socket] = []
+    for index in range(args.clients):
+        client = socket.create_connection(('127.0.0.1', headless.FCAST_PORT))
+        client.sendall(encode_packet(OpCode.VERSION, VersionMessage(1)))
+        if args.play and index == 0:
+            client.sendall(encode_packet(OpCode.PLAY, PlayMessage('application/dash+xml', content=DASH_MANIFEST)))
+        clients.append(client)
+    # Let the receiver handle the packets and start what they need
+    time.sleep(0.3)
+    threads_running = receiver_threads() - baseline
+
+    start = time.perf_counter()
+    headless.stop_receiver(receiver)
+    shutdown = time.perf_counter() - start
+
+    for client in clients:
+        client.close()
+    return startup, shutdown, threads_running, receiver_threads() - baseline
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--clients', type=int, default=5)
+    parser.add_argument('--play', action='store_true', help='send an inline DASH PLAY, which starts the HTTP server')
+    parser.add_argument('--asyncio', action='store_true', help='serve clients from the asyncio transport')
+    args = parser.parse_args()
+    sys.argv = [sys.argv[0]]
+
+    imports = [import_time() for _ in range(args.runs)]
+    results = [run_once(args) for _ in range(args.runs)]
+
+    def row(name: str, values: List[float], scale: float = 1000, unit: str = 'ms'):
+        print('%-26s median %8.2f %s   max %8.2f %s' % (name, statistics.median(values) * scale, unit, max(values) * scale, unit))
+
+    row('import fcast_plugin.main', imports)
+    row('startup (main -> listening)', [result[0] for result in results])
+    row('shutdown (abort -> return)', [result[1] for result in results])
+    row('threads while serving', [result[2] for result in results], 1, '')
+    row('threads left after stop', [result[3] for result in results], 1, '')
+    print('Kodi API calls: %s' % dict(sorted(xbmc.calls.items())))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""
+Measures the per-packet cost of FCastSession's framing parser.
+
+Feeds bursts of SEEK packets and 32 KB reads full of PINGs of growing size into a
+session; with the iterative bytearray/memoryview parser the cost per packet
+must stay flat as the burst grows.
+
+Usage: python benchmarks/bench_parser.py
+"""
+import json
+import struct
+import time
+
+import headless # Kodi stub modules
+
+from fcast_plugin.FCastSession import Event, FCastSession, OpCode
+
+class NullClient:
+    sent: int = 0
+
+    def send(self, data) -> int:
+        self.sent += 1
+        return len(data)
+
+    sendall = send
+
+    def close(self):
+        pass
+
+def packet(opcode: OpCode, body = None) -> bytes:
+    payload = json.dumps(body).encode('utf-8') if body is not None else b''
+    return struct.pack('<IB', len(payload) + 1, opcode.value) + payload
+
+def run(data: bytes, chunk_size: int, expected: int) -> float:
+    """Feed data in chunk_size reads, expecting one SEEK event or PONG reply per packet"""
+    client = NullClient()
+    session = FCastSession(client) # type: ignore[arg-type]
+    seeks = []
+    session.on(Event.SEEK, lambda s, message: seeks.append(message))
+
+    view = memoryview(data)
+    start = time.perf_counter()
+    for offset in range(0, len(data), chunk_size):
+        session.process_bytes(view[offset:offset + chunk_size])
+    elapsed = time.perf_counter() - start
+
+    assert len(seeks) + client.sent == expected, (len(seeks), client.sent, expected)
+    return elapsed
+
+def main():
+    print('%-28s %10s %12s %14s' % ('scenario', 'packets', 'total (ms)', 'per packet (us)'))
+    for count in (100, 1000, 10000, 50000):
+        seeks = b''.join(packet(OpCode.SEEK, {'time': i / 10}) for i in range(count))
+        elapsed = run(seeks, len(seeks), count)
+        print('%-28s %10d %12.2f %14.3f' % ('SEEK burst, single read', count, elapsed * 1000, elapsed / count * 1e6))
+
+    for count in (1000, 10000, 100000):
+        pings = packet(OpCode.PING) * count
+        elapsed = run(pings, 32000, count)
+        print('%-28s %10d %12.2f %14.3f' % ('PING flood, 32 KB reads', count, elapsed * 1000, elapsed / count * 1e6))
+
+    count = 2000
+    seeks = b''.join(packet(OpCode.SEEK, {'time': i / 10}) for i in range(count))
+    elapsed = run(seeks, 7, count)
+    print('%-28s %10d %12.2f %14.3f' % ('SEEK burst, 7 byte reads', count, elapsed * 1000, elapsed / count * 1e6))
+
+if __name__ == '__main__':
+    main()
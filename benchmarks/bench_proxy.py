@@ -0,0 +1,171 @@
+"""
+HLS proxy against a local stand-in origin.
+
+The origin serves a media playlist of --segments small segments and one
+--file-mb MiB file, answers Range and If-None-Match requests, and counts the
+requests and body bytes it sends. A player then goes through FCastProxy:
+
+- playlist and segments in order: every origin URL should be fetched once,
+  with the sender's headers, and prefetched segments served from cache
+- a byte range of the large file: 206 with the origin's Content-Range, and
+  only the range sent by the origin
+- the whole large file: streamed, reported as time to first byte and total
+- If-None-Match with the origin's ETag: 304 relayed from the origin
+
+Usage: python benchmarks/bench_proxy.py [--segments 20] [--file-mb 48]
+"""
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import re
+import threading
+import time
+from typing import Dict, List, Optional
+import urllib.error
+import urllib.request
+
+import headless # Kodi stub modules
+
+from fcast_plugin.FCastHTTPServer import FCastHTTPServer
+
+SEGMENT_BYTES = 256 * 1024
+SENDER_HEADER = 'X-Sender-Token'
+ETAG = '"bench-file"'
+
+class Origin(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, segments: int, file_bytes: int):
+        super().__init__(('127.0.0.1', 0), OriginHandler)
+        self.segments = segments
+        self.file = bytes(range(256)) * (file_bytes // 256)
+        self.requests: Dict[str, int] = {}
+        self.bytes_sent = 0
+        self.missing_header = 0
+        self.lock = threading.Lock()
+
+    def base_url(self) -> str:
+        return 'http://127.0.0.1:%d' % self.server_address[1]
+
+    def playlist(self) -> bytes:
+        lines = ['#EXTM3U', '#EXT-X-VERSION:3', '#EXT-X-TARGETDURATION:2']
+        for index in range(self.segments):
+            lines += ['#EXTINF:2.0,', 'seg%d.ts' % index]
+        return ('\n'.join(lines + ['#EXT-X-ENDLIST']) + '\n').encode()
+
+class OriginHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        origin: Origin = self.server # type: ignore[assignment]
+        with origin.lock:
+            origin.requests[self.path] = origin.requests.get(self.path, 0) + 1
+            if not self.headers.get(SENDER_HEADER):
+                origin.missing_header += 1
+
+        if self.path == '/live/index.m3u8':
+            self.send_body(200, 'application/vnd.apple.mpegurl', origin.playlist())
+        elif re.match(r'^/live/seg\d+\.ts$', self.path):
+            self.send_body(200, 'video/mp2t', b'\x47' * SEGMENT_BYTES)
+        elif self.path == '/file.mp4':
+            self.send_file(origin.file)
+        else:
+            self.send_body(404, 'text/plain', b'')
+
+    def send_file(self, body: bytes):
+        if self.headers.get('If-None-Match') == ETAG:
+            self.send_response(304)
+            self.send_header('ETag', ETAG)
+            self.end_headers()
+            return
+        match = re.match(r'^bytes=(\d+)-(\d*)$', self.headers.get('Range') or '')
+        if not match:
+            self.send_body(200, 'video/mp4', body, {'ETag': ETAG, 'Accept-Ranges': 'bytes'})
+            return
+        start = int(match.group(1))
+        end = min(int(match.group(2)) if match.group(2) else len(body) - 1, len(body) - 1)
+        self.send_body(206, 'video/mp4', body[start:end + 1], {
+            'ETag': ETAG,
+            'Content-Range': 'bytes %d-%d/%d' % (start, end, len(body)),
+        })
+
+    def send_body(self, status: int, content_type: str, body: bytes, headers: Optional[Dict[str, str]] = None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        with self.server.lock: # type: ignore[attr-defined]
+            self.server.bytes_sent += len(body) # type: ignore[attr-defined]
+        self.wfile.write(body)
+
+def get(url: str, headers: Optional[Dict[str, str]] = None):
+    """(status, headers, body, seconds to first byte, seconds in total)"""
+    start = time.perf_counter()
+    try:
+        response = urllib.request.urlopen(urllib.request.Request(url, headers=headers or {}), timeout=30)
+    except urllib.error.HTTPError as e:
+        return e.code, e.headers, e.read(), time.perf_counter() - start, time.perf_counter() - start
+    with response:
+        chunks: List[bytes] = [response.read(1)]
+        first_byte = time.perf_counter() - start
+        chunks.append(response.read())
+        return response.status, response.headers, b''.join(chunks), first_byte, time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--segments', type=int, default=20)
+    parser.add_argument('--file-mb', type=int, default=48)
+    args = parser.parse_args()
+
+    origin = Origin(args.segments, args.file_mb * 1024 * 1024)
+    threading.Thread(target=origin.serve_forever, daemon=True).start()
+    server = FCastHTTPServer(host='127.0.0.1')
+    server.start()
+    sender_headers = {SENDER_HEADER: 'secret'}
+
+    # Playlist, then every segment in order, with time for the prefetches to land
+    playlist_url = server.proxy_url(origin.base_url() + '/live/index.m3u8', sender_headers)
+    status, _, playlist, _, _ = get(playlist_url)
+    segment_urls = [line for line in playlist.decode().splitlines() if line and not line.startswith('#')]
+    start = time.perf_counter()
+    segment_errors = 0
+    for url in segment_urls:
+        status, _, body, _, _ = get(url)
+        segment_errors += status != 200 or len(body) != SEGMENT_BYTES
+        time.sleep(0.02)
+    segments_elapsed = time.perf_counter() - start
+    duplicates = sum(count - 1 for path, count in origin.requests.items() if path.startswith('/live/'))
+
+    print('%-32s %s' % ('playlist rewritten', all(url.startswith(server.get_base_url()) for url in segment_urls)))
+    print('%-32s %d in %.0f ms, %d errors' % ('segments played', len(segment_urls), segments_elapsed * 1000, segment_errors))
+    print('%-32s %d' % ('duplicate origin fetches', duplicates))
+    print('%-32s %d' % ('origin requests without headers', origin.missing_header))
+    print('%-32s %d hits, %d misses, %d prefetched' % ('segment cache', server.proxy.cache.hits, server.proxy.cache.misses, server.proxy.prefetched))
+
+    file_url = server.proxy_url(origin.base_url() + '/file.mp4', sender_headers)
+    sent = origin.bytes_sent
+    status, headers, body, _, elapsed = get(file_url, {'Range': 'bytes=1000-1999'})
+    expected = origin.file[1000:2000]
+    print('%-32s %d %s, %d bytes, correct %s, origin sent %d bytes in %.1f ms' % (
+        'byte range', status, headers.get('Content-Range'), len(body), body == expected, origin.bytes_sent - sent, elapsed * 1000
+    ))
+
+    sent = origin.bytes_sent
+    status, headers, body, first_byte, elapsed = get(file_url)
+    print('%-32s %d, %d bytes, correct %s, first byte %.1f ms, total %.0f ms, origin sent %d bytes' % (
+        'whole file', status, len(body), body == origin.file, first_byte * 1000, elapsed * 1000, origin.bytes_sent - sent
+    ))
+
+    status, headers, _, _, _ = get(file_url, {'If-None-Match': ETAG})
+    print('%-32s %d, ETag %s' % ('revalidation', status, headers.get('ETag')))
+
+    server.stop()
+    origin.shutdown()
+    origin.server_close()
+
+if __name__ == '__main__':
+    main()
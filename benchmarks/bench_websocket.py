@@ -0,0 +1,70 @@
+"""
+Micro-benchmark of the WebSocket transport.
+
+unmask compares the integer XOR used by FCastWebSocketSession with a per-byte
+Python loop, for typical FCast message sizes. receive measures a full
+process_bytes() pass for one masked binary frame carrying an FCast packet,
+next to the same packet on the raw TCP session.
+
+Usage: python benchmarks/bench_websocket.py [iterations]
+"""
+import base64
+import os
+import sys
+import time
+
+import headless # Kodi stub modules
+
+from fcast_plugin.FCastCodec import encode_packet
+from fcast_plugin.FCastPackets import *
+from fcast_plugin.FCastSession import Event, FCastSession
+from fcast_plugin.FCastWebSocket import FCastWebSocketSession, unmask
+from bench_codec import NullClient, rate
+
+MASK = b'\x1f\x2e\x3d\x4c'
+HANDSHAKE = (
+    b'GET / HTTP/1.1\r\nHost: receiver\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+    b'Sec-WebSocket-Key: ' + base64.b64encode(os.urandom(16)) + b'\r\nSec-WebSocket-Version: 13\r\n\r\n'
+)
+
+def unmask_loop(payload: bytes, mask: bytes) -> bytes:
+    return bytes(byte ^ mask[index % 4] for index, byte in enumerate(payload))
+
+def masked_frame(payload: bytes) -> bytes:
+    length = len(payload)
+    header = bytes([0x82, 0x80 | length]) if length < 126 else bytes([0x82, 0x80 | 126]) + length.to_bytes(2, 'big')
+    return header + MASK + unmask(payload, MASK)
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    print('%-8s %-24s %12s %12s' % ('', 'case', 'ops/s', 'us/op'))
+
+    for size in (16, 128, 1024, 16384):
+        payload = os.urandom(size)
+        for name, func in (('int xor', unmask), ('byte loop', unmask_loop)):
+            count = max(iterations // max(size // 64, 1), 100)
+            start = time.perf_counter()
+            for _ in range(count):
+                func(payload, MASK)
+            print('%-8s %-24s %s' % ('unmask', '%s %d B' % (name, size), rate(count, time.perf_counter() - start)))
+
+    messages = [
+        ('SEEK', encode_packet(OpCode.SEEK, SeekMessage(42.5))),
+        ('PLAY', encode_packet(OpCode.PLAY, PlayMessage('video/mp4', url='https://example.com/video.mp4', time=10, headers={'User-Agent': 'FCast'}))),
+    ]
+    for name, packet in messages:
+        for transport, session, data in (
+            ('tcp', FCastSession(NullClient()), packet), # type: ignore[arg-type]
+            ('websocket', FCastWebSocketSession(NullClient()), masked_frame(packet)),
+        ):
+            for event in Event:
+                session.on(event, lambda s, m: None)
+            if transport == 'websocket':
+                session.process_bytes(HANDSHAKE)
+            start = time.perf_counter()
+            for _ in range(iterations):
+                session.process_bytes(data)
+            print('%-8s %-24s %s' % ('receive', '%s %s' % (name, transport), rate(iterations, time.perf_counter() - start)))
+
+if __name__ == '__main__':
+    main()
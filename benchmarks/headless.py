@@ -0,0 +1,70 @@
+"""
+Runs the receiver outside Kodi against the stub modules in benchmarks/kodistub.
+
+Importing this module puts the stubs and resources/lib on sys.path. Run it as a
+script to start a headless receiver process (used by the load generator):
+
+    python benchmarks/headless.py [--record PATH] [--asyncio]
+
+With --record, the traffic of every session is recorded to PATH for replay.py.
+With --asyncio, clients are served by the asyncio transport instead of the
+selector loop (FCAST_USE_ASYNCIO in main.py).
+"""
+import argparse
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+from typing import Optional
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCHMARKS_DIR)
+
+for path in (os.path.join(ROOT_DIR, 'resources', 'lib'), os.path.join(BENCHMARKS_DIR, 'kodistub')):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+import xbmc
+
+FCAST_PORT = 46899
+
+def wait_for_port(port: int = FCAST_PORT, host: str = '127.0.0.1', timeout: float = 10) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection((host, port), timeout=0.5).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise TimeoutError('Receiver did not start listening on port %d' % port)
+            time.sleep(0.02)
+
+def start_receiver(record: Optional[str] = None, use_asyncio: bool = False) -> threading.Thread:
+    """Run fcast_plugin.main.main() in a background thread of this process"""
+    from fcast_plugin import main
+
+    xbmc.reset()
+    main.FCAST_RECORDING_PATH = record
+    main.FCAST_USE_ASYNCIO = use_asyncio
+    # main() ends with exit(), which only ends its thread here
+    thread = threading.Thread(target=main.main, name='fcast-main', daemon=True)
+    thread.start()
+    return thread
+
+def stop_receiver(thread: threading.Thread, timeout: float = 10) -> None:
+    xbmc.abort()
+    thread.join(timeout)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Headless FCast receiver')
+    parser.add_argument('--record', help='record session traffic to this file')
+    parser.add_argument('--asyncio', action='store_true', help='serve clients from the asyncio transport')
+    args = parser.parse_args()
+    sys.argv = [sys.argv[0]]
+    receiver = start_receiver(args.record, args.asyncio)
+    signal.signal(signal.SIGTERM, lambda signum, frame: xbmc.abort())
+    signal.signal(signal.SIGINT, lambda signum, frame: xbmc.abort())
+    while receiver.is_alive():
+        receiver.join(0.2)
@@ -0,0 +1,347 @@
+"""
+Headless stand-in for Kodi's xbmc module.
+
+Only what the receiver uses is implemented. Player keeps a simulated media
+clock and fires its callbacks from a separate thread, as Kodi does. When an item
+ends it moves on to the next entry of the PlayList it was started with. Monitor's
+abort flag is shared by every instance and raised with abort().
+
+executeJSONRPC is a test double for the few methods the receiver calls: it
+keeps Kodi's volume, applies Player.SetSpeed to the playing Player, notifies
+Monitors of volume changes, and counts round trips and batched calls.
+"""
+import json
+import os
+import sys
+import threading
+import time
+import weakref
+from typing import Any, Dict, Optional
+
+LOGDEBUG = 0
+LOGINFO = 1
+LOGWARNING = 2
+LOGERROR = 3
+LOGFATAL = 4
+LOGNONE = 5
+
+# Threads of the simulated Kodi itself, told apart from the receiver's own
+KODI_THREAD_PREFIX = 'kodi-'
+
+PLAYLIST_MUSIC = 0
+PLAYLIST_VIDEO = 1
+
+# Set FCAST_STUB_LOG=1 to print receiver logs to stderr
+_print_logs = os.environ.get('FCAST_STUB_LOG') == '1'
+_abort = threading.Event()
+
+# Number of calls into the stubbed Kodi API, by function name
+calls: Dict[str, int] = {}
+
+def _count(name: str):
+    calls[name] = calls.get(name, 0) + 1
+
+def abort():
+    """Request the service to stop, like Kodi does on shutdown"""
+    _abort.set()
+
+def reset():
+    global rpc_round_trips, _active_player
+    _abort.clear()
+    calls.clear()
+    _playlists.clear()
+    rpc_calls.clear()
+    rpc_round_trips = 0
+    _rpc_state.update(volume=100, muted=False)
+    _active_player = None
+
+def log(msg: str, level: int = LOGDEBUG) -> None:
+    _count('log')
+    if _print_logs:
+        print('[%d] %s' % (level, msg), file=sys.stderr)
+
+def sleep(timemillis: int) -> None:
+    time.sleep(timemillis / 1000)
+
+def executebuiltin(function: str, wait: bool = False) -> None:
+    _count('executebuiltin')
+
+def getInfoLabel(cstring: str) -> str:
+    _count('getInfoLabel')
+    return 'Headless Kodi' if cstring == 'System.FriendlyName' else ''
+
+def getCondVisibility(condition: str) -> bool:
+    _count('getCondVisibility')
+    return False
+
+# executeJSONRPC invocations, and the calls they carried by method
+rpc_round_trips = 0
+rpc_calls: Dict[str, int] = {}
+_rpc_state: Dict[str, Any] = {'volume': 100, 'muted': False}
+_rpc_lock = threading.Lock()
+
+def executeJSONRPC(jsonrpccommand: str) -> str:
+    global rpc_round_trips
+    _count('executeJSONRPC')
+    with _rpc_lock:
+        rpc_round_trips += 1
+    request = json.loads(jsonrpccommand)
+    if isinstance(request, list):
+        return json.dumps([_rpc(item) for item in request])
+    return json.dumps(_rpc(request))
+
+def _rpc(request: Dict[str, Any]) -> Dict[str, Any]:
+    method = request.get('method', '')
+    params = request.get('params') or {}
+    with _rpc_lock:
+        rpc_calls[method] = rpc_calls.get(method, 0) + 1
+    response: Dict[str, Any] = {'id': request.get('id'), 'jsonrpc': '2.0'}
+    if method == 'Application.SetVolume':
+        volume = max(0, min(int(params.get('volume', 0)), 100))
+        if volume != _rpc_state['volume']:
+            _rpc_state['volume'] = volume
+            _notify('Application.OnVolumeChanged', {'volume': volume, 'muted': _rpc_state['muted']})
+        response['result'] = volume
+    elif method == 'Application.GetProperties':
+        response['result'] = {name: _rpc_state[name] for name in params.get('properties', []) if name in _rpc_state}
+    elif method == 'Player.SetSpeed':
+        player = _active_player
+        if not player or not player.isPlaying():
+            response['error'] = {'code': -32100, 'message': 'Failed to execute method.'}
+        else:
+            response['result'] = {'speed': player._set_speed(int(params.get('speed', 1)))}
+    elif method == 'JSONRPC.Ping':
+        response['result'] = 'pong'
+    else:
+        response['error'] = {'code': -32601, 'message': 'Method not found.'}
+    return response
+
+# Monitors receiving notifications, as Kodi delivers them to every add-on
+_monitors: 'weakref.WeakSet[Monitor]' = weakref.WeakSet()
+
+def _notify(method: str, data: Dict[str, Any]):
+    for monitor in list(_monitors):
+        threading.Thread(
+            target=monitor.onNotification, args=('xbmc', method, json.dumps(data)),
+            name=KODI_THREAD_PREFIX + 'notification', daemon=True,
+        ).start()
+
+class Monitor:
+    def __init__(self):
+        _monitors.add(self)
+
+    def onNotification(self, sender: str, method: str, data: str) -> None:
+        pass
+
+    def abortRequested(self) -> bool:
+        return _abort.is_set()
+
+    def waitForAbort(self, timeout: Optional[float] = None) -> bool:
+        return _abort.wait(timeout)
+
+# Playlist id -> [entries as (url, listitem), current position], shared like Kodi's playlists
+_playlists: Dict[int, list] = {}
+
+# Player that started the current item, the target of Player.* JSON-RPC methods
+_active_player: Optional['Player'] = None
+
+class PlayList:
+    def __init__(self, playList: int):
+        self._id = playList
+        self._state = _playlists.setdefault(playList, [[], -1])
+
+    def add(self, url: str, listitem: Any = None, index: int = -1) -> None:
+        _count('PlayList.add')
+        entries = self._state[0]
+        entries.insert(index if index >= 0 else len(entries), (url, listitem))
+
+    def clear(self) -> None:
+        self._state[0].clear()
+        self._state[1] = -1
+
+    def size(self) -> int:
+        return len(self._state[0])
+
+    def __len__(self) -> int:
+        return self.size()
+
+    def getposition(self) -> int:
+        return self._state[1]
+
+    def getPlayListId(self) -> int:
+        return self._id
+
+class Player:
+    """Simulated player: media time advances with the wall clock times the playback speed"""
+
+    # Delay between play() and onAVStarted, i.e. the simulated time to first frame
+    start_delay = 0.05
+    media_duration = 600.0
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._playlist: Optional[PlayList] = None
+        self._end_timer: Optional[threading.Timer] = None
+        self._item: Optional[str] = None
+        self._position = 0.0
+        self._anchor = 0.0
+        self._speed = 1.0
+        self._paused = False
+
+    def _now(self) -> float:
+        if not self._item or self._paused:
+            return self._position
+        elapsed = max(time.monotonic() - self._anchor, 0.0)
+        return min(self._position + elapsed * self._speed, self.media_duration)
+
+    def _rebase(self):
+        self._position = self._now()
+        self._anchor = time.monotonic()
+
+    def _callback(self, name: str, *args):
+        threading.Thread(target=lambda: getattr(self, name)(*args), name=KODI_THREAD_PREFIX + name, daemon=True).start()
+
+    def _schedule_end(self):
+        """Called with the lock held after every change of the media clock"""
+        if self._end_timer:
+            self._end_timer.cancel()
+            self._end_timer = None
+        if not self._item or self._paused or self._speed <= 0:
+            return
+        delay = max(self._anchor - time.monotonic(), 0.0) + (self.media_duration - self._position) / self._speed
+        self._end_timer = threading.Timer(delay + 0.001, self._ended)
+        self._end_timer.name = KODI_THREAD_PREFIX + 'clock'
+        self._end_timer.daemon = True
+        self._end_timer.start()
+
+    def _ended(self):
+        with self._lock:
+            if not self._item or self._now() < self.media_duration:
+                self._schedule_end()
+                return
+            playlist = self._playlist
+            if playlist and playlist.getposition() + 1 < playlist.size():
+                # Like Kodi, continue with the next entry without an onPlayBackEnded
+                position = playlist.getposition() + 1
+            else:
+                self._item = None
+                self._position = 0.0
+                position = -1
+        if position >= 0:
+            self.playselected(position)
+        else:
+            self._callback('onPlayBackEnded')
+
+    def _start(self, item: str, listitem: Any):
+        global _active_player
+        _active_player = self
+        with self._lock:
+            self._item = item
+            offset = listitem.getProperty('StartOffset') if listitem is not None and hasattr(listitem, 'getProperty') else ''
+            self._position = float(offset) if offset else 0.0
+            self._anchor = time.monotonic() + self.start_delay
+            self._paused = False
+            self._speed = 1.0
+            self._schedule_end()
+        self._callback('onPlayBackStarted')
+        timer = threading.Timer(self.start_delay, self.onAVStarted)
+        timer.name = KODI_THREAD_PREFIX + 'onAVStarted'
+        timer.daemon = True
+        timer.start()
+
+    def _set_speed(self, speed: int) -> int:
+        with self._lock:
+            self._rebase()
+            self._speed = float(speed)
+            self._schedule_end()
+        self._callback('onPlayBackSpeedChanged', speed)
+        return speed
+
+    def play(self, item: Any = '', listitem: Any = None, windowed: bool = False, startpos: int = -1) -> None:
+        _count('play')
+        if isinstance(item, PlayList):
+            self._playlist = item
+            self.playselected(max(startpos, 0))
+            return
+        self._playlist = None
+        self._start(item if isinstance(item, str) else str(item), listitem)
+
+    def playselected(self, selected: int) -> None:
+        _count('playselected')
+        playlist = self._playlist
+        if not playlist or not 0 <= selected < playlist.size():
+            return
+        playlist._state[1] = selected
+        url, listitem = playlist._state[0][selected]
+        self._start(url, listitem)
+
+    def stop(self) -> None:
+        _count('stop')
+        with self._lock:
+            was_playing = self._item is not None
+            self._item = None
+            self._position = 0.0
+            self._schedule_end()
+        if was_playing:
+            self._callback('onPlayBackStopped')
+
+    def pause(self) -> None:
+        _count('pause')
+        with self._lock:
+            if not self._item:
+                return
+            self._rebase()
+            self._paused = not self._paused
+            paused = self._paused
+            self._schedule_end()
+        self._callback('onPlayBackPaused' if paused else 'onPlayBackResumed')
+
+    def seekTime(self, seekTime: float) -> None:
+        _count('seekTime')
+        with self._lock:
+            if not self._item:
+                return
+            self._position = max(0.0, min(float(seekTime), self.media_duration))
+            self._anchor = time.monotonic()
+            self._schedule_end()
+        self._callback('onPlayBackSeek', int(seekTime * 1000), 0)
+
+    def isPlaying(self) -> bool:
+        _count('isPlaying')
+        return self._item is not None
+
+    def isPlayingVideo(self) -> bool:
+        return self.isPlaying()
+
+    def isPlayingAudio(self) -> bool:
+        return False
+
+    def getTime(self) -> float:
+        _count('getTime')
+        with self._lock:
+            if not self._item:
+                raise RuntimeError('Kodi is not playing any media file')
+            return self._now()
+
+    def getTotalTime(self) -> float:
+        _count('getTotalTime')
+        if not self._item:
+            raise RuntimeError('Kodi is not playing any media file')
+        return self.media_duration
+
+    def getPlayingFile(self) -> str:
+        if not self._item:
+            raise RuntimeError('Kodi is not playing any media file')
+        return self._item
+
+    # Callbacks, overridden by the receiver
+    def onPlayBackStarted(self) -> None: pass
+    def onAVStarted(self) -> None: pass
+    def onAVChange(self) -> None: pass
+    def onPlayBackEnded(self) -> None: pass
+    def onPlayBackStopped(self) -> None: pass
+    def onPlayBackError(self) -> None: pass
+    def onPlayBackPaused(self) -> None: pass
+    def onPlayBackResumed(self) -> None: pass
+    def onPlayBackSeek(self, time: int, seekOffset: int) -> None: pass
+    def onPlayBackSpeedChanged(self, speed: int) -> None: pass
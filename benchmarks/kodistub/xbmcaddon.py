@@ -0,0 +1,21 @@
+"""Headless stand-in for Kodi's xbmcaddon module"""
+from typing import Dict
+
+_info: Dict[str, str] = {
+    'id': 'c4valli.fcast.receiver',
+    'name': 'Kodi FCast Receiver',
+    'version': '0.0.1',
+}
+
+class Addon:
+    def __init__(self, id: str = ''):
+        self._settings: Dict[str, str] = {}
+
+    def getAddonInfo(self, id: str) -> str:
+        return _info.get(id, '')
+
+    def getSetting(self, id: str) -> str:
+        return self._settings.get(id, '')
+
+    def setSetting(self, id: str, value: str) -> None:
+        self._settings[id] = value
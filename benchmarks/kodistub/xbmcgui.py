@@ -0,0 +1,42 @@
+"""Headless stand-in for Kodi's xbmcgui module"""
+from typing import Dict, List, Tuple
+
+NOTIFICATION_INFO = 'info'
+NOTIFICATION_WARNING = 'warning'
+NOTIFICATION_ERROR = 'error'
+
+# Every notification shown, as (heading, message)
+notifications: List[Tuple[str, str]] = []
+
+class Dialog:
+    def notification(self, heading: str, message: str, icon: str = NOTIFICATION_INFO, time: int = 5000, sound: bool = True) -> None:
+        notifications.append((heading, message))
+
+class ListItem:
+    def __init__(self, label: str = '', label2: str = '', path: str = '', offscreen: bool = False):
+        self.label = label
+        self.path = path
+        self.mime_type = ''
+        self.content_lookup = True
+        self.properties: Dict[str, str] = {}
+
+    def setPath(self, path: str) -> None:
+        self.path = path
+
+    def getPath(self) -> str:
+        return self.path
+
+    def setMimeType(self, mimetype: str) -> None:
+        self.mime_type = mimetype
+
+    def setContentLookup(self, enable: bool) -> None:
+        self.content_lookup = enable
+
+    def setProperty(self, key: str, value: str) -> None:
+        self.properties[key.lower()] = value
+
+    def getProperty(self, key: str) -> str:
+        return self.properties.get(key.lower(), '')
+
+    def setInfo(self, type: str, infoLabels: Dict) -> None:
+        pass
@@ -0,0 +1,254 @@
+"""
+FCast load generator.
+
+Starts a headless receiver (benchmarks/headless.py) in a child process, opens N
+TCP clients against port 46899 and replays sender traffic: VERSION, a PLAY per
+client, bursts of SEEK packets as produced by scrubbing, and PING/PONG round
+trips. Reports packets/s, PING->PONG latency percentiles and the receiver's
+thread count, CPU and RSS.
+
+With --flood N, N more clients send SEEK and unknown opcode packets as fast as
+the receiver reads them, reconnecting when they are dropped. Admission control
+should keep the receiver's CPU and the other clients' latency bounded.
+
+With --asyncio, the receiver serves clients from the asyncio transport instead
+of the selector loop.
+
+Usage: python benchmarks/loadgen.py [--clients 20] [--duration 10] [--seek-burst 20] [--flood 0] [--asyncio]
+       python benchmarks/loadgen.py --external --host 192.168.1.10   (no process stats)
+"""
+import argparse
+import json
+import os
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+from typing import Dict, List, Optional
+
+import headless
+
+from fcast_plugin.FCastCodec import encode_packet
+from fcast_plugin.FCastPackets import *
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+
+class ProcessStats:
+    """Samples CPU time, RSS and thread count of a process from /proc (Linux only)"""
+
+    def __init__(self, pid: int):
+        self.pid = pid
+
+    def cpu_seconds(self) -> Optional[float]:
+        try:
+            with open('/proc/%d/stat' % self.pid) as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            # utime and stime are fields 14 and 15 of the whole line
+            return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+        except (OSError, IndexError, ValueError):
+            return None
+
+    def status(self) -> Dict[str, int]:
+        values = {}
+        try:
+            with open('/proc/%d/status' % self.pid) as f:
+                for line in f:
+                    key, _, value = line.partition(':')
+                    if key in ('VmRSS', 'Threads'):
+                        values[key] = int(value.split()[0])
+        except OSError:
+            pass
+        return values
+
+class Client(threading.Thread):
+
+    def __init__(self, index: int, args: argparse.Namespace, stop: threading.Event):
+        super().__init__(name='client-%d' % index, daemon=True)
+        self.index = index
+        self.args = args
+        self.stop_event = stop
+        self.sent = 0
+        self.received = 0
+        self.latencies: List[float] = []
+        self.error: Optional[str] = None
+        self.buffer = bytearray()
+
+    def send(self, sock: socket.socket, opcode: OpCode, message = None):
+        sock.sendall(encode_packet(opcode, message))
+        self.sent += 1
+
+    def read_until(self, sock: socket.socket, opcode: OpCode):
+        """Read packets until one with the given opcode arrives"""
+        while True:
+            while len(self.buffer) >= 5:
+                length = struct.unpack_from('<I', self.buffer)[0]
+                if len(self.buffer) < 4 + length:
+                    break
+                received = self.buffer[4]
+                del self.buffer[:4 + length]
+                self.received += 1
+                if received == opcode:
+                    return
+            data = sock.recv(65536)
+            if not data:
+                raise ConnectionError('Receiver closed the connection')
+            self.buffer += data
+
+    def run(self):
+        try:
+            sock = socket.create_connection((self.args.host, self.args.port), timeout=10)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.send(sock, OpCode.VERSION, VersionMessage(1))
+            self.read_until(sock, OpCode.VERSION)
+
+            if self.index < self.args.players:
+                self.send(sock, OpCode.PLAY, PlayMessage('video/mp4', url='http://127.0.0.1/video-%d.mp4' % self.index))
+
+            position = 0.0
+            while not self.stop_event.is_set():
+                # Scrubbing: a burst of seeks a few milliseconds apart
+                for _ in range(self.args.seek_burst):
+                    position = (position + 1.5) % 600
+                    self.send(sock, OpCode.SEEK, SeekMessage(position))
+                    time.sleep(self.args.seek_gap)
+
+                start = time.perf_counter()
+                self.send(sock, OpCode.PING)
+                self.read_until(sock, OpCode.PONG)
+                self.latencies.append(time.perf_counter() - start)
+
+                self.stop_event.wait(self.args.ping_interval)
+            sock.close()
+        except Exception as e:
+            self.error = str(e)
+
+class Flooder(threading.Thread):
+    """Misbehaving sender: writes packets back to back and never reads"""
+
+    # Unknown to the receiver, it must ignore these cheaply
+    UNKNOWN_OPCODE = 200
+
+    def __init__(self, index: int, args: argparse.Namespace, stop: threading.Event):
+        super().__init__(name='flooder-%d' % index, daemon=True)
+        self.args = args
+        self.stop_event = stop
+        self.sent_bytes = 0
+        self.connections = 0
+        packet = encode_packet(OpCode.SEEK, SeekMessage(12.5)) + struct.pack('<IB', 1, self.UNKNOWN_OPCODE)
+        self.chunk = packet * (16384 // len(packet))
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                sock = socket.create_connection((self.args.host, self.args.port), timeout=1)
+            except OSError:
+                time.sleep(0.01)
+                continue
+            self.connections += 1
+            try:
+                while not self.stop_event.is_set():
+                    self.sent_bytes += sock.send(self.chunk)
+            except OSError:
+                # Dropped, or the send timed out while the receiver throttles us
+                pass
+            sock.close()
+
+def percentile(values: List[float], fraction: float) -> float:
+    if not values:
+        return float('nan')
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--clients', type=int, default=20)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--players', type=int, default=1, help='number of clients sending a PLAY')
+    parser.add_argument('--seek-burst', type=int, default=20, help='SEEK packets per burst')
+    parser.add_argument('--seek-gap', type=float, default=0.005, help='seconds between SEEKs of a burst')
+    parser.add_argument('--ping-interval', type=float, default=0.2, help='seconds between bursts')
+    parser.add_argument('--flood', type=int, default=0, help='number of clients flooding the receiver')
+    parser.add_argument('--record', help='have the receiver record session traffic to this file, see replay.py')
+    parser.add_argument('--asyncio', action='store_true', help='have the receiver use the asyncio transport')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=headless.FCAST_PORT)
+    parser.add_argument('--external', action='store_true', help='use an already running receiver')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    receiver = None
+    stats = None
+    if not args.external:
+        command = [sys.executable, os.path.join(headless.BENCHMARKS_DIR, 'headless.py')]
+        if args.record:
+            command += ['--record', args.record]
+        if args.asyncio:
+            command.append('--asyncio')
+        receiver = subprocess.Popen(command)
+        stats = ProcessStats(receiver.pid)
+    try:
+        headless.wait_for_port(args.port, args.host)
+
+        idle_start = stats.cpu_seconds() if stats else None
+        time.sleep(1)
+        idle_cpu = (stats.cpu_seconds() - idle_start) if stats and idle_start is not None else None
+
+        stop = threading.Event()
+        clients = [Client(i, args, stop) for i in range(args.clients)]
+        flooders = [Flooder(i, args, stop) for i in range(args.flood)]
+        cpu_start = stats.cpu_seconds() if stats else None
+        start = time.perf_counter()
+        for client in clients + flooders:
+            client.start()
+
+        max_threads = 0
+        max_rss = 0
+        while time.perf_counter() - start < args.duration:
+            if stats:
+                status = stats.status()
+                max_threads = max(max_threads, status.get('Threads', 0))
+                max_rss = max(max_rss, status.get('VmRSS', 0))
+            time.sleep(0.1)
+
+        stop.set()
+        for client in clients + flooders:
+            client.join(10)
+        elapsed = time.perf_counter() - start
+        cpu = (stats.cpu_seconds() - cpu_start) if stats and cpu_start is not None else None
+    finally:
+        if receiver:
+            receiver.terminate()
+            receiver.wait(10)
+
+    latencies = [latency for client in clients for latency in client.latencies]
+    errors = [client.error for client in clients if client.error]
+    results = {
+        'clients': args.clients,
+        'duration_s': round(elapsed, 2),
+        'packets_sent': sum(client.sent for client in clients),
+        'packets_received': sum(client.received for client in clients),
+        'packets_per_s': round(sum(client.sent for client in clients) / elapsed, 1),
+        'ping_pong_p50_ms': round(percentile(latencies, 0.5) * 1000, 3),
+        'ping_pong_p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        'receiver_threads_max': max_threads if stats else None,
+        'receiver_cpu_percent': round(cpu / elapsed * 100, 1) if cpu is not None else None,
+        'receiver_idle_cpu_percent': round(idle_cpu * 100, 2) if idle_cpu is not None else None,
+        'receiver_rss_max_kb': max_rss if stats else None,
+        'client_errors': len(errors),
+    }
+    if flooders:
+        results['flood_mb_sent'] = round(sum(flooder.sent_bytes for flooder in flooders) / 1e6, 1)
+        results['flood_connections'] = sum(flooder.connections for flooder in flooders)
+
+    if args.json:
+        print(json.dumps(results))
+    else:
+        for key, value in results.items():
+            print('%-28s %s' % (key, value))
+        for error in errors[:5]:
+            print('error: %s' % error)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+"""
+Replays a session recording into a headless receiver and reports handling latency.
+
+Recordings are written by the receiver when FCAST_RECORDING_PATH is set in
+main.py (or with headless.py/loadgen.py --record PATH). Every recorded session
+is recreated in this process with the session class it used (raw TCP or
+WebSocket) and the receiver's own handlers, on top of the stub xbmc modules.
+Its received bytes are fed back chunk by chunk, at the recorded pace divided
+by --speed (0 replays as fast as possible).
+
+Reported per opcode: count and dispatch latency percentiles, i.e. decoding the
+body and running the session's handler with the receiver's listeners, plus the
+time spent in process_bytes() per received chunk. Rotated files (PATH.1,
+PATH.2 ...) are replayed first.
+
+Usage: python benchmarks/replay.py PATH [--speed 1] [--json]
+"""
+import argparse
+import json
+import sys
+import time
+from typing import Dict, List, Optional
+
+import headless
+
+import xbmc
+from fcast_plugin.FCastPackets import OpCode
+from fcast_plugin.FCastRecorder import RecordKind, read_recording, recording_files
+from fcast_plugin.FCastSession import FCastSession
+from fcast_plugin.FCastWebSocket import FCastWebSocketSession
+from bench_codec import NullClient
+from loadgen import percentile
+
+SESSION_CLASSES = {cls.__name__: cls for cls in (FCastSession, FCastWebSocketSession)}
+
+def latency_stats(latencies: List[float]) -> Dict[str, float]:
+    return {
+        'count': len(latencies),
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        'max_ms': round(max(latencies) * 1000, 3) if latencies else float('nan'),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('path')
+    parser.add_argument('--speed', type=float, default=1.0, help='replay speed factor, 0 for as fast as possible')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+    files = recording_files(args.path)
+    if not files:
+        parser.error('no recording at %s' % args.path)
+    sys.argv = [sys.argv[0]]
+
+    receiver = headless.start_receiver()
+    headless.wait_for_port()
+    from fcast_plugin import main as receiver_main
+
+    latencies: Dict[str, List[float]] = {}
+    chunk_latencies: List[float] = []
+    def timed(opcode: int, handler):
+        samples = latencies.setdefault(OpCode(opcode).name.lower(), [])
+        def handle(session: FCastSession, body: Optional[bytes]):
+            start = time.perf_counter()
+            try:
+                handler(session, body)
+            finally:
+                samples.append(time.perf_counter() - start)
+        return handle
+    # The dispatch table __handle_packet looks up, so that opcodes handled by the session
+    # itself (PING, VERSION, SUBSCRIBE_EVENT ...) are timed like those it emits as events
+    dispatch = {
+        opcode: timed(opcode, handler)
+        for opcode, handler in FCastSession._FCastSession__opcode_handlers.items() # type: ignore[attr-defined]
+    }
+
+    sessions: Dict[int, FCastSession] = {}
+    counts = {kind: 0 for kind in RecordKind}
+    start = time.perf_counter()
+    first = None
+    for path in files:
+        for timestamp, session_id, kind, data in read_recording(path):
+            counts[kind] += 1
+            if first is None:
+                first = timestamp
+            if args.speed > 0:
+                delay = (timestamp - first) / args.speed - (time.perf_counter() - start)
+                if delay > 0:
+                    time.sleep(delay)
+
+            if kind == RecordKind.OPEN:
+                session = SESSION_CLASSES.get(data.decode(), FCastSession)(NullClient()) # type: ignore[arg-type]
+                session._FCastSession__opcode_handlers = dispatch # type: ignore[attr-defined]
+                receiver_main.register_session_handlers(session)
+                receiver_main.open_session(session, ('replay-%d' % session_id, 0))
+                sessions[session_id] = session
+            elif kind == RecordKind.INBOUND and session_id in sessions:
+                chunk_start = time.perf_counter()
+                try:
+                    sessions[session_id].process_bytes(data)
+                except Exception as e:
+                    # The receiver closed this session when it was recorded too
+                    receiver_main.end_session(sessions.pop(session_id), ('replay-%d' % session_id, 0))
+                    print('session %d closed: %s' % (session_id, e), file=sys.stderr)
+                chunk_latencies.append(time.perf_counter() - chunk_start)
+            elif kind == RecordKind.CLOSE and session_id in sessions:
+                receiver_main.end_session(sessions.pop(session_id), ('replay-%d' % session_id, 0))
+    elapsed = time.perf_counter() - start
+    recorded = (timestamp - first) if first is not None else 0.0
+
+    for session_id, session in list(sessions.items()):
+        receiver_main.end_session(session, ('replay-%d' % session_id, 0))
+    headless.stop_receiver(receiver)
+
+    results = {
+        'files': len(files),
+        'sessions': counts[RecordKind.OPEN],
+        'inbound_chunks': counts[RecordKind.INBOUND],
+        'outbound_packets_recorded': counts[RecordKind.OUTBOUND],
+        'recorded_s': round(recorded, 3),
+        'replayed_s': round(elapsed, 3),
+        'process_bytes': latency_stats(chunk_latencies),
+        'opcodes': {name: latency_stats(values) for name, values in sorted(latencies.items()) if values},
+        'kodi_calls': dict(sorted(xbmc.calls.items())),
+    }
+    if args.json:
+        print(json.dumps(results))
+        return
+
+    for key in ('files', 'sessions', 'inbound_chunks', 'outbound_packets_recorded', 'recorded_s', 'replayed_s'):
+        print('%-28s %s' % (key, results[key]))
+    print('%-28s %8s %10s %10s %10s' % ('latency', 'count', 'p50 ms', 'p99 ms', 'max ms'))
+    for name, stats in [('process_bytes', results['process_bytes'])] + list(results['opcodes'].items()):
+        print('%-28s %8d %10.3f %10.3f %10.3f' % (name, stats['count'], stats['p50_ms'], stats['p99_ms'], stats['max_ms']))
+    print('Kodi API calls: %s' % results['kodi_calls'])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+import ipaddress
+from threading import Lock
+import time
+from typing import Dict
+
+from .FCastMetrics import CONNECTIONS_REJECTED, PACKETS_THROTTLED
+
+# Connections accepted at once over every port, and from a single address.
+# Loopback clients (local tools, benchmarks) only count towards the global limit
+ADMISSION_MAX_CONNECTIONS = 64
+ADMISSION_MAX_CONNECTIONS_PER_IP = 4
+# Sustained rate and burst allowed to each session, in packets and in received bytes per second
+SESSION_PACKET_RATE = 100.0
+SESSION_PACKET_BURST = 200
+SESSION_BYTE_RATE = 256 * 1024.0
+SESSION_BYTE_BURST = 512 * 1024
+# Sessions are closed once this many of their packets were discarded for exceeding the packet rate
+SESSION_MAX_THROTTLED_PACKETS = 1000
+# Seconds during which an address whose session was closed for flooding cannot reconnect,
+# otherwise every reconnection would start with a full burst allowance
+ADMISSION_PENALTY = 10.0
+
+class TokenBucket:
+    """Allows `rate` units per second on average, and bursts of up to `burst` units"""
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def __refill(self, now: float):
+        self.tokens = min(self.tokens + (now - self.updated) * self.rate, self.burst)
+        self.updated = now
+
+    def take(self, amount: float, now: float) -> bool:
+        """Take `amount` tokens if there are enough"""
+        self.__refill(now)
+        if self.tokens < amount:
+            return False
+        self.tokens -= amount
+        return True
+
+    def debit(self, amount: float, now: float):
+        """Take `amount` tokens even if that leaves the bucket in debt"""
+        self.__refill(now)
+        self.tokens -= amount
+
+    def delay(self, amount: float = 0) -> float:
+        """Seconds until `amount` tokens are available, as of the last update"""
+        return max(amount - self.tokens, 0.0) / self.rate
+
+class SessionLimiter:
+    """
+    Rate limits of one session, checked by FCastSession. Received bytes are
+    always counted; once the byte or packet bucket is exhausted, the server
+    stops reading from the client until it refilled, so a flooding client is
+    held back by TCP flow control instead of costing receiver CPU. Packets
+    over the packet rate that were already received are discarded after
+    framing, before being decoded or dispatched.
+    """
+    __slots__ = ('packets', 'bytes', 'throttled')
+
+    def __init__(self, packet_rate: float, packet_burst: float, byte_rate: float, byte_burst: float):
+        self.packets = TokenBucket(packet_rate, packet_burst)
+        self.bytes = TokenBucket(byte_rate, byte_burst)
+        # Packets discarded so far
+        self.throttled = 0
+
+    def receive(self, length: int, now: float):
+        self.bytes.debit(length, now)
+
+    def admit_packet(self, now: float) -> bool:
+        if self.packets.take(1, now):
+            return True
+        self.throttled += 1
+        PACKETS_THROTTLED.inc()
+        return False
+
+    def exceeded(self) -> bool:
+        """Whether the client kept sending over the packet rate for so long that it should be dropped"""
+        return self.throttled >= SESSION_MAX_THROTTLED_PACKETS
+
+    def read_delay(self) -> float:
+        """Seconds the server should wait before reading from the client again"""
+        return max(self.bytes.delay(), self.packets.delay(1) if self.packets.tokens < 1 else 0.0)
+
+class AdmissionControl:
+    """
+    Connection limits shared by every listener of a server, and the rate
+    limits given to each accepted session.
+    """
+
+    def __init__(self,
+        max_connections: int = ADMISSION_MAX_CONNECTIONS,
+        max_connections_per_ip: int = ADMISSION_MAX_CONNECTIONS_PER_IP,
+        penalty: float = ADMISSION_PENALTY,
+        packet_rate: float = SESSION_PACKET_RATE,
+        packet_burst: float = SESSION_PACKET_BURST,
+        byte_rate: float = SESSION_BYTE_RATE,
+        byte_burst: float = SESSION_BYTE_BURST
+    ):
+        self.max_connections = max_connections
+        self.max_connections_per_ip = max_connections_per_ip
+        self.penalty = penalty
+        self.rates = (packet_rate, packet_burst, byte_rate, byte_burst)
+        # Connections currently admitted, in total and by address
+        self.connections = 0
+        self.per_ip: Dict[str, int] = {}
+        # Address -> monotonic time until which it is refused, see penalize()
+        self.penalized: Dict[str, float] = {}
+        self._lock = Lock()
+
+    def admit(self, address: str) -> bool:
+        """Count a new connection from `address`, False if it must be refused"""
+        with self._lock:
+            if self.penalized and self.__is_penalized(address):
+                CONNECTIONS_REJECTED['penalty'].inc()
+                return False
+            if self.max_connections and self.connections >= self.max_connections:
+                CONNECTIONS_REJECTED['global_limit'].inc()
+                return False
+            count = self.per_ip.get(address, 0)
+            if self.max_connections_per_ip and count >= self.max_connections_per_ip and not is_loopback(address):
+                CONNECTIONS_REJECTED['ip_limit'].inc()
+                return False
+            self.connections += 1
+            self.per_ip[address] = count + 1
+            return True
+
+    def release(self, address: str):
+        """Forget a connection admitted by admit()"""
+        with self._lock:
+            count = self.per_ip.get(address, 0)
+            if count <= 0:
+                return
+            self.connections -= 1
+            if count == 1:
+                del self.per_ip[address]
+            else:
+                self.per_ip[address] = count - 1
+
+    def penalize(self, address: str):
+        """Refuse `address` for a while, after its session was closed for exceeding its limits"""
+        if self.penalty:
+            with self._lock:
+                self.penalized[address] = time.monotonic() + self.penalty
+
+    def session_limiter(self) -> SessionLimiter:
+        return SessionLimiter(*self.rates)
+
+    def __is_penalized(self, address: str) -> bool:
+        now = time.monotonic()
+        for expired in [other for other, until in self.penalized.items() if until <= now]:
+            del self.penalized[expired]
+        return address in self.penalized
+
+def is_loopback(address: str) -> bool:
+    try:
+        return ipaddress.ip_address(address).is_loopback
+    except ValueError:
+        return False
@@ -0,0 +1,294 @@
+import asyncio
+import threading
+import time
+from typing import Any, Callable, List, Optional, Set, Tuple, Type
+
+import xbmc
+
+from .FCastAdmission import AdmissionControl
+from .FCastMetrics import READS_THROTTLED
+from .FCastSession import FCastSession
+from .FCastTimerWheel import TimerWheel
+from .FCastWebSocket import FCastWebSocketSession
+from .util import DaemonExecutor, log
+
+SessionCallback = Callable[[FCastSession, Any], None]
+
+class AsyncTransportClient:
+    """
+    Socket-like adapter used as FCastSession.client on the asyncio transport.
+    Only used from the event loop thread: sessions queue their output and have
+    the loop flush it, like the selector loop does.
+    """
+
+    def __init__(self, server: 'FCastAsyncServer', transport: asyncio.Transport):
+        self.server = server
+        self.loop = server.loop
+        self.transport = transport
+        self.paused = False
+
+    def send(self, data) -> int:
+        if self.transport.is_closing():
+            raise ConnectionError("Transport is closed")
+        if self.paused:
+            # Above the transport's high-water mark, keep the rest in the session queue
+            raise BlockingIOError()
+        self.transport.write(data)
+        return len(data)
+
+    def close(self):
+        if self.server.in_loop_thread():
+            self.transport.close()
+        elif not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.transport.close)
+
+class FCastAsyncSession(FCastSession):
+    """FCastSession bound to an event loop, flushed by that loop."""
+
+    def __init__(self, client: AsyncTransportClient):
+        super().__init__(client) # type: ignore[arg-type]
+        self.server = client.server
+        self.loop = client.loop
+        self.adapter = client
+        self.wakeup = self.__request_flush
+
+    def schedule(self, coroutine):
+        asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def pause_writing(self):
+        self.adapter.paused = True
+
+    def resume_writing(self):
+        self.adapter.paused = False
+        self.__flush_in_loop()
+
+    def __request_flush(self, session: FCastSession):
+        if self.server.in_loop_thread():
+            self.__flush_in_loop()
+        elif not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.__flush_in_loop)
+
+    def __flush_in_loop(self):
+        if self.evicted:
+            self.adapter.transport.close()
+        elif self.client:
+            self.flush()
+
+class FCastAsyncWebSocketSession(FCastWebSocketSession, FCastAsyncSession):
+    """WebSocket framing on top of the event loop bound session"""
+
+class FCastProtocol(asyncio.Protocol):
+
+    session: Optional[FCastAsyncSession] = None
+    transport: Optional[asyncio.Transport] = None
+    # Set while reading is paused by the session's rate limits
+    throttled: bool = False
+
+    def __init__(self, server: 'FCastAsyncServer', session_class: Type[FCastAsyncSession] = FCastAsyncSession):
+        self.server = server
+        self.session_class = session_class
+
+    def connection_made(self, transport: asyncio.BaseTransport):
+        self.transport = transport # type: ignore[assignment]
+        self.addr = transport.get_extra_info('peername')
+        admission = self.server.admission
+        if admission and not admission.admit(self.addr[0]):
+            # No session is created, so the other callbacks ignore this connection
+            transport.abort() # type: ignore[attr-defined]
+            return
+        self.session = self.session_class(AsyncTransportClient(self.server, self.transport)) # type: ignore[arg-type]
+        if admission:
+            self.session.limiter = admission.session_limiter()
+        self.server.sessions.add(self.session)
+        self.server.watch(self.session)
+        if self.server.on_connect:
+            self.server.on_connect(self.session, self.addr)
+
+    def data_received(self, data: bytes):
+        if not self.session or not self.transport:
+            return
+        try:
+            self.session.process_bytes(data)
+        except Exception as e:
+            log("Closing client after a processing error", xbmc.LOGERROR, error=e)
+            limiter = self.session.limiter
+            if self.server.admission and limiter and limiter.exceeded():
+                self.server.admission.penalize(self.addr[0])
+            self.transport.close()
+            return
+
+        limiter = self.session.limiter
+        delay = limiter.read_delay() if limiter else 0
+        if delay > 0 and not self.throttled and not self.transport.is_closing():
+            READS_THROTTLED.inc()
+            self.throttled = True
+            self.transport.pause_reading()
+            self.server.loop.call_later(delay, self.__resume_reading)
+
+    def __resume_reading(self):
+        self.throttled = False
+        if self.transport and not self.transport.is_closing():
+            self.transport.resume_reading()
+
+    def pause_writing(self):
+        if self.session:
+            self.session.pause_writing()
+
+    def resume_writing(self):
+        if self.session:
+            self.session.resume_writing()
+
+    def connection_lost(self, exc: Optional[Exception]):
+        if not self.session:
+            return
+        self.server.sessions.discard(self.session)
+        self.server.unwatch(self.session)
+        if self.server.admission:
+            self.server.admission.release(self.addr[0])
+        if self.server.on_disconnect:
+            self.server.on_disconnect(self.session, self.addr)
+        self.session.close()
+        self.session = None
+
+class FCastAsyncServer:
+    """
+    asyncio variant of the FCast TCP receiver. Runs its own event loop in a
+    background thread; each connection is served by an FCastProtocol.
+    """
+
+    loop: asyncio.AbstractEventLoop
+    server: Optional[asyncio.AbstractServer] = None
+    extra_servers: List[asyncio.AbstractServer]
+    server_thread: Optional[threading.Thread] = None
+    loop_thread_id: Optional[int] = None
+
+    def __init__(self,
+        host: str = '',
+        port: int = 0,
+        on_connect: Optional[SessionCallback] = None,
+        on_disconnect: Optional[SessionCallback] = None,
+        ping_interval: float = 20,
+        idle_timeout: float = 60,
+        admission: Optional[AdmissionControl] = None
+    ):
+        self.host = host
+        self.port = port
+        self.on_connect = on_connect
+        self.on_disconnect = on_disconnect
+        self.sessions: Set[FCastAsyncSession] = set()
+        # Further (port, session type) pairs served by the same loop, see listen()
+        self.listeners: List[Tuple[int, Type[FCastAsyncSession]]] = []
+        self.extra_servers = []
+        self.ping_interval = ping_interval
+        self.idle_timeout = idle_timeout
+        # Connection and rate limits of every listener, see FCastAdmission
+        self.admission = admission
+        # Next liveness check of every session, advanced by a single loop callback
+        self.timers = TimerWheel()
+        self._tick: Optional[asyncio.TimerHandle] = None
+        self.loop = asyncio.new_event_loop()
+        # Kodi calls are blocking and must not be reordered, so async handlers share one worker
+        self.executor = DaemonExecutor(max_workers=1, thread_name_prefix='fcast-handler')
+        self._started = threading.Event()
+        self._error: Optional[BaseException] = None
+
+    def listen(self, port: int, session_class: Type[FCastAsyncSession] = FCastAsyncSession):
+        """Also accept clients on `port`, served with `session_class`. Call before start()"""
+        self.listeners.append((port, session_class))
+
+    def to_async(self, handler: SessionCallback) -> Callable[[FCastSession, Any], Any]:
+        """Wrap a blocking event handler so that it runs off the event loop"""
+        async def async_handler(session: FCastSession, message = None):
+            await self.loop.run_in_executor(self.executor, handler, session, message)
+        return async_handler
+
+    def in_loop_thread(self) -> bool:
+        return self.loop_thread_id == threading.get_ident()
+
+    def get_port(self) -> int:
+        if self.server and self.server.sockets:
+            return int(self.server.sockets[0].getsockname()[1])
+        return self.port
+
+    def watch(self, session: FCastAsyncSession):
+        if self.idle_timeout:
+            self.timers.schedule(session, min(self.ping_interval, self.idle_timeout), self.__check_liveness)
+            if not self._tick:
+                self.__schedule_tick()
+
+    def unwatch(self, session: FCastAsyncSession):
+        self.timers.cancel(session)
+
+    def __schedule_tick(self):
+        timeout = self.timers.timeout()
+        self._tick = self.loop.call_later(timeout, self.__advance) if timeout is not None else None
+
+    def __advance(self):
+        self.timers.advance()
+        self.__schedule_tick()
+
+    def __check_liveness(self, session: FCastAsyncSession):
+        if session not in self.sessions:
+            return
+        delay = session.check_liveness(time.monotonic(), self.ping_interval, self.idle_timeout)
+        if delay is None:
+            log("Client timed out")
+            session.adapter.transport.close()
+        else:
+            self.timers.schedule(session, delay, self.__check_liveness)
+
+    async def serve(self):
+        self.server = await self.loop.create_server(
+            lambda: FCastProtocol(self),
+            self.host if len(self.host) > 0 else None,
+            self.port,
+            reuse_address=True,
+        )
+        for port, session_class in self.listeners:
+            try:
+                self.extra_servers.append(await self.loop.create_server(
+                    lambda session_class=session_class: FCastProtocol(self, session_class),
+                    self.host if len(self.host) > 0 else None,
+                    port,
+                    reuse_address=True,
+                ))
+            except OSError as e:
+                # The main port is enough to serve senders
+                log("Could not listen on additional port", xbmc.LOGWARNING, port=port, error=e)
+
+    def __run(self):
+        self.loop_thread_id = threading.get_ident()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self.serve())
+        except BaseException as e:
+            self._error = e
+            self._started.set()
+            return
+        self._started.set()
+        self.loop.run_forever()
+
+        # Loop stopped: close remaining connections and the listener
+        if self._tick:
+            self._tick.cancel()
+        self.timers.clear()
+        for session in list(self.sessions):
+            session.close()
+        for server in ([self.server] if self.server else []) + self.extra_servers:
+            server.close()
+            self.loop.run_until_complete(server.wait_closed())
+        self.loop.run_until_complete(self.loop.shutdown_asyncgens())
+        self.loop.close()
+
+    def start(self):
+        self.server_thread = threading.Thread(target=self.__run, name='fcast-asyncio', daemon=True)
+        self.server_thread.start()
+        self._started.wait()
+        if self._error:
+            raise self._error
+
+    def stop(self, timeout: Optional[float] = None):
+        if self.server_thread and self.server_thread.is_alive():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.server_thread.join(timeout)
+        self.executor.shutdown(wait=False)
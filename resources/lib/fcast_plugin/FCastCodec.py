@@ -0,0 +1,52 @@
+import json
+import struct
+from typing import Any, Optional, Type
+
+from .FCastMetrics import PARSE_ERRORS
+from .FCastPackets import *
+
+# Use a faster JSON backend when one is installed, the standard library otherwise
+try:
+    import orjson # type: ignore[import]
+
+    JSON_BACKEND = 'orjson'
+    json_dumps = orjson.dumps
+    json_loads = orjson.loads
+except ImportError:
+    try:
+        import ujson # type: ignore[import]
+
+        JSON_BACKEND = 'ujson'
+
+        def json_dumps(obj: Any) -> bytes:
+            return ujson.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+        json_loads = ujson.loads
+    except ImportError:
+        JSON_BACKEND = 'json'
+        _encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+
+        def json_dumps(obj: Any) -> bytes:
+            return _encoder.encode(obj).encode('utf-8')
+
+        json_loads = json.loads
+
+LENGTH_BYTES = 4
+
+pack_header = struct.Struct("<IB").pack
+unpack_length = struct.Struct("<I").unpack_from
+
+def encode_packet(opcode: OpCode, message: Optional[FCastMessage] = None) -> bytes:
+    """Serialize an FCast packet (header and JSON body) into a single buffer"""
+    body = json_dumps(message.to_wire()) if message else b""
+    return pack_header(len(body) + 1, opcode) + body
+
+def decode_message(message_type: Optional[Type[FCastMessage]], body: Optional[bytes]):
+    """Decode a packet body into its message type, None when there is nothing to decode"""
+    if not body or not message_type:
+        return None
+    try:
+        return message_type.from_wire(json_loads(body))
+    except Exception:
+        PARSE_ERRORS.inc()
+        raise
@@ -0,0 +1,118 @@
+from collections import OrderedDict
+import gzip
+import hashlib
+import secrets
+from threading import Lock
+import time
+from typing import Dict, Optional, Tuple
+
+# Bodies smaller than this are not worth compressing
+GZIP_MIN_SIZE = 512
+
+# Default memory budget and idle lifetime of stored manifests
+CONTENT_STORE_MAX_BYTES = 8 * 1024 * 1024
+CONTENT_STORE_TTL = 6 * 60 * 60
+
+class ManifestContent:
+    """Manifest encoded once when it is stored, so that each request only writes bytes"""
+
+    __slots__ = ('content_type', 'body', 'gzip_body', 'etag', 'size', 'references')
+
+    def __init__(self, content_type: str, body: bytes, digest: str):
+        self.content_type = content_type
+        self.body = body
+        self.gzip_body = gzip.compress(body, mtime=0) if len(body) >= GZIP_MIN_SIZE else None
+        self.etag = '"%s"' % digest
+        self.size = len(body) + (len(self.gzip_body) if self.gzip_body else 0)
+        # Number of tokens pointing at this content
+        self.references = 0
+
+class ContentStore:
+    """
+    Manifests served by the HTTP server, addressed by a random token per play request.
+    Identical manifests share one stored copy. Tokens are evicted least recently used
+    first once the memory budget is exceeded, or after being idle for `ttl` seconds.
+    """
+
+    def __init__(self, max_bytes: int = CONTENT_STORE_MAX_BYTES, ttl: float = CONTENT_STORE_TTL):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.deduplicated = 0
+        self._lock = Lock()
+        # token -> (digest, last access), least recently used first
+        self._tokens: 'OrderedDict[str, Tuple[str, float]]' = OrderedDict()
+        # digest -> content
+        self._contents: Dict[str, ManifestContent] = {}
+
+    def __len__(self) -> int:
+        return len(self._tokens)
+
+    def add(self, content_type: str, content: str) -> str:
+        """Store a manifest and return the token it is served under"""
+        body = content.encode('utf-8')
+        digest = hashlib.sha1(content_type.encode('utf-8') + b'\0' + body).hexdigest()
+        token = secrets.token_urlsafe(12)
+        now = time.monotonic()
+
+        with self._lock:
+            stored = self._contents.get(digest)
+            if stored:
+                self.deduplicated += 1
+            else:
+                stored = ManifestContent(content_type, body, digest)
+                self._contents[digest] = stored
+                self.size += stored.size
+            stored.references += 1
+            self._tokens[token] = (digest, now)
+
+            self.__expire(now)
+            # Never evict the manifest that was just added
+            while self.size > self.max_bytes and len(self._tokens) > 1:
+                self.__evict(next(iter(self._tokens)))
+
+        return token
+
+    def get(self, token: str) -> Optional[ManifestContent]:
+        now = time.monotonic()
+        with self._lock:
+            self.__expire(now)
+            entry = self._tokens.get(token)
+            if not entry:
+                self.misses += 1
+                return None
+            self._tokens[token] = (entry[0], now)
+            self._tokens.move_to_end(token)
+            self.hits += 1
+            return self._contents[entry[0]]
+
+    def remove(self, token: str) -> None:
+        with self._lock:
+            if token in self._tokens:
+                self.__evict(token)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._tokens.clear()
+            self._contents.clear()
+            self.size = 0
+
+    def __expire(self, now: float):
+        # Tokens are ordered by last access, so expired ones are at the front
+        while self._tokens:
+            token, (digest, last_access) = next(iter(self._tokens.items()))
+            if now - last_access < self.ttl:
+                break
+            self.__evict(token)
+
+    def __evict(self, token: str):
+        digest, _ = self._tokens.pop(token)
+        self.evictions += 1
+        stored = self._contents[digest]
+        stored.references -= 1
+        if stored.references <= 0:
+            del self._contents[digest]
+            self.size -= stored.size
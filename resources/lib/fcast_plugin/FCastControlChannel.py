@@ -0,0 +1,138 @@
+import json
+import math
+from threading import Condition, Thread
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+import xbmc
+
+from .util import log
+
+# Minimum seconds between two JSON-RPC round trips, calls made in between are batched
+CONTROL_BATCH_INTERVAL = 0.1
+# Kodi's player ids for Player.* methods
+KODI_AUDIO_PLAYER_ID = 0
+KODI_VIDEO_PLAYER_ID = 1
+# Forward speeds accepted by Player.SetSpeed, Kodi has no fractional playback speed
+KODI_SPEEDS = (1, 2, 4, 8, 16, 32)
+
+ResultCallback = Callable[[Any], None]
+
+def kodi_speed(speed: float) -> int:
+    """Closest speed Player.SetSpeed accepts, on a logarithmic scale"""
+    if speed <= 1:
+        return KODI_SPEEDS[0]
+    step = min(max(round(math.log2(speed)), 0), len(KODI_SPEEDS) - 1)
+    return KODI_SPEEDS[step]
+
+class ControlCall:
+    __slots__ = ('method', 'params', 'callback')
+
+    def __init__(self, method: str, params: Optional[Dict[str, Any]], callback: Optional[ResultCallback]):
+        self.method = method
+        self.params = params
+        # Called with the result from the channel thread, not on errors
+        self.callback = callback
+
+class ControlChannel:
+    """
+    Kodi JSON-RPC calls made on behalf of senders, sent by one long-lived thread.
+    A call replaces the pending call with the same key, so a burst of volume
+    changes only sends the latest value. Everything pending when the thread
+    wakes goes out as one JSON-RPC batch, i.e. a single executeJSONRPC round
+    trip, and round trips are at least `interval` apart. A call made while idle
+    is sent right away. The thread is only started by the first call.
+    """
+
+    thread: Optional[Thread] = None
+
+    def __init__(self, interval: float = CONTROL_BATCH_INTERVAL):
+        self.interval = interval
+        # Calls made, calls sent to Kodi after coalescing, and batches sent
+        self.submitted = 0
+        self.sent = 0
+        self.round_trips = 0
+        self.errors = 0
+        self._pending: Dict[str, ControlCall] = {}
+        self._cond = Condition()
+        self._stopped = False
+        self._last_round_trip = -interval
+
+    def call(self, method: str, params: Optional[Dict[str, Any]] = None, callback: Optional[ResultCallback] = None, key: Optional[str] = None):
+        """Queue a call, replacing the pending one with the same `key` (the method by default)"""
+        with self._cond:
+            if self._stopped:
+                return
+            self.submitted += 1
+            key = key or method
+            # Reinserted so that the batch keeps the order of the latest calls
+            self._pending.pop(key, None)
+            self._pending[key] = ControlCall(method, params, callback)
+            if not self.thread:
+                self.thread = Thread(target=self.__run, name='fcast-control', daemon=True)
+                self.thread.start()
+            self._cond.notify()
+
+    def stop(self, timeout: Optional[float] = None):
+        """Stop the thread, dropping calls that were not sent yet"""
+        with self._cond:
+            self._stopped = True
+            self._pending.clear()
+            self._cond.notify()
+            thread = self.thread
+        if thread:
+            thread.join(timeout)
+
+    def stats(self) -> Dict[str, int]:
+        return {'submitted': self.submitted, 'sent': self.sent, 'round_trips': self.round_trips, 'errors': self.errors}
+
+    def __run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._stopped:
+                    self._cond.wait()
+                # Let calls made until the interval elapsed join the batch
+                delay = self._last_round_trip + self.interval - time.monotonic()
+                while delay > 0 and not self._stopped:
+                    self._cond.wait(delay)
+                    delay = self._last_round_trip + self.interval - time.monotonic()
+                if self._stopped:
+                    return
+                calls = list(self._pending.values())
+                self._pending.clear()
+                self._last_round_trip = time.monotonic()
+            self.__send(calls)
+
+    def __send(self, calls: List[ControlCall]):
+        requests = []
+        for request_id, call in enumerate(calls):
+            request: Dict[str, Any] = {'jsonrpc': '2.0', 'id': request_id, 'method': call.method}
+            if call.params is not None:
+                request['params'] = call.params
+            requests.append(request)
+
+        self.sent += len(calls)
+        self.round_trips += 1
+        try:
+            # Kodi answers a batch with a list of responses, in any order
+            response = json.loads(xbmc.executeJSONRPC(json.dumps(requests if len(requests) > 1 else requests[0])))
+        except Exception as e:
+            self.errors += len(calls)
+            log("JSON-RPC request failed", xbmc.LOGERROR, error=e)
+            return
+        responses = {
+            item.get('id'): item for item in (response if isinstance(response, list) else [response])
+            if isinstance(item, dict)
+        }
+
+        for request_id, call in enumerate(calls):
+            item = responses.get(request_id)
+            if not item or 'error' in item:
+                self.errors += 1
+                log("JSON-RPC call failed", xbmc.LOGWARNING, method=call.method, error=item.get('error') if item else 'no response')
+                continue
+            if call.callback:
+                try:
+                    call.callback(item.get('result'))
+                except Exception as e:
+                    log("JSON-RPC result handler failed", xbmc.LOGERROR, method=call.method, error=e)
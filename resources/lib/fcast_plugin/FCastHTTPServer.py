@@ -1,79 +1,251 @@
 
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import re
+import socket
 from threading import Thread
-from typing import cast, Dict, Optional
-
-class FCastHTTPServer(HTTPServer):
-
-    _content: Dict[str, Optional[str]] = {
-        'content-type': None,
-        'content': None,
-    }
-
-    def is_valid_content(self) -> bool:
-        if self._content.get('content-type') and self._content.get('content'):
-            return True
+import time
+from typing import cast, Optional, Tuple
+from urllib.parse import urlsplit
+
+from .FCastContentStore import ContentStore, ManifestContent
+from .FCastMetrics import metrics as default_metrics, MetricsRegistry
+from .FCastProxy import FCastProxy, ProxyResponse, PROXY_CHUNK_SIZE, PROXY_PATH
+from .util import log
+
+RANGE_PATTERN = re.compile(r'^bytes=(\d*)-(\d*)$')
+MANIFEST_PATH = '/manifest/'
+METRICS_PATH = '/metrics'
+
+class FCastHTTPServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    content_store: ContentStore
+    proxy: FCastProxy
+    metrics: MetricsRegistry
+
+    def add_content(self, content_type: str, content: str) -> str:
+        """Store a manifest and return the URL it is served at"""
+        token = self.content_store.add(content_type, content)
+        return f'{self.get_base_url()}{MANIFEST_PATH}{token}'
+
+    def proxy_url(self, url: str, headers = None) -> str:
+        """Local URL proxying a remote playlist or manifest, fetched with the sender's headers"""
+        token = self.proxy.register(headers)
+        return self.proxy.local_url(self.get_base_url(), token, url)
+
+    def preload(self, url: str) -> None:
+        """Fetch a URL returned by proxy_url() in the background, before the player asks for it"""
+        base_url = self.get_base_url()
+        if url.startswith(base_url):
+            self.proxy.preload(base_url, url[len(base_url):])
+
+    def proxy_content(self, content_type: str, content: str, headers = None) -> str:
+        """Store an inline HLS playlist or DASH manifest whose absolute URLs go through the proxy"""
+        token = self.proxy.register(headers)
+        if content.lstrip('\ufeff \t\r\n').startswith('#EXTM3U'):
+            session = self.proxy.get_session(token)
+            content = self.proxy.rewrite_hls(content, '', self.get_base_url(), token, session)
         else:
-            return False
-
-    def set_content(self, content_type: str, content: str) -> None:
-        self._content['content-type'] = content_type
-        self._content['content'] = content
+            content = self.proxy.rewrite_dash(content, None, self.get_base_url(), token)
+        return self.add_content(content_type, content)
 
     def clear_content(self) -> None:
-        self._content['content-type'] = None
-        self._content['content'] = None
+        self.content_store.clear()
 
-    def get_content(self) -> str:
-        return self._content.get('content') or ""
-    
-    def get_content_type(self) -> str:
-        return self._content.get('content-type') or ""
+    def get_content(self, path: str) -> Optional[ManifestContent]:
+        path = urlsplit(path).path
+        if not path.startswith(MANIFEST_PATH):
+            return None
+        return self.content_store.get(path[len(MANIFEST_PATH):])
 
     def get_host(self) -> str:
         return self.host if len(self.host) > 0 else 'localhost'
-    
+
     def get_port(self) -> int:
         return self.port if self.port else int(self.socket.getsockname()[1])
-    
-    def __init__(self, host: str = '', port: int = 0):
+
+    def get_base_url(self) -> str:
+        return f'http://{self.get_host()}:{self.get_port()}'
+
+    def __init__(self,
+        host: str = '',
+        port: int = 0,
+        content_store: Optional[ContentStore] = None,
+        proxy: Optional[FCastProxy] = None,
+        metrics: Optional[MetricsRegistry] = None
+    ):
 
         super().__init__((host, port), FCastWebRequestHandler)
 
+        self.content_store = content_store if content_store is not None else ContentStore()
+        self.proxy = proxy if proxy is not None else FCastProxy()
+        self.metrics = metrics if metrics is not None else default_metrics
+
         self.host = host if len(host) > 0 else 'localhost'
         self.port = port if port else int(self.socket.getsockname()[1])
 
     def start(self):
-        self.server_thread = Thread(target=self.serve_forever)
+        self.server_thread = Thread(target=self.serve_forever, name='fcast-http', daemon=True)
         self.server_thread.start()
 
-    def stop(self):
-        server_shutdown_thread = Thread(target=self.shutdown)
+    def stop(self, timeout: Optional[float] = None):
+        deadline = time.monotonic() + (timeout if timeout is not None else 5)
+        server_shutdown_thread = Thread(target=self.shutdown, daemon=True)
         server_shutdown_thread.start()
-        server_shutdown_thread.join()
+        # serve_forever only notices the shutdown request within its poll interval,
+        # a connection wakes it up right away
+        while server_shutdown_thread.is_alive() and time.monotonic() < deadline:
+            try:
+                socket.create_connection(('127.0.0.1', self.get_port()), timeout=0.1).close()
+            except OSError:
+                pass
+            server_shutdown_thread.join(min(0.05, max(deadline - time.monotonic(), 0)))
+        self.server_close()
+        self.proxy.close()
 
 class FCastWebRequestHandler(BaseHTTPRequestHandler):
 
+    # HTTP/1.1 keeps connections alive between manifest polls
+    protocol_version = 'HTTP/1.1'
+
     def get_fcast_server(self) -> FCastHTTPServer:
         return cast(FCastHTTPServer, self.server)
-    
-    def do_HEAD(self):
-        if not self.get_fcast_server().is_valid_content():
-            self.send_error(404, 'Not found')
+
+    def log_message(self, format: str, *args):
+        # The default writes a line to stderr per request, i.e. per segment and manifest poll
+        log("HTTP request", key='http', client=self.client_address[0], request=format % args)
+
+    def parse_range(self, length: int) -> Optional[Tuple[int, int]]:
+        """Parse a single-range Range header into inclusive (start, end), None if the whole body is wanted"""
+        header = self.headers.get('Range')
+        if not header:
+            return None
+        match = RANGE_PATTERN.match(header.strip())
+        if not match or (not match.group(1) and not match.group(2)):
+            # Multiple or malformed ranges are ignored and the full body is sent
+            return None
+
+        if not match.group(1):
+            # Suffix range: the last N bytes
+            start = max(length - int(match.group(2)), 0)
+            end = length - 1
+        else:
+            start = int(match.group(1))
+            end = min(int(match.group(2)), length - 1) if match.group(2) else length - 1
+        return (start, end)
+
+    def accepts_gzip(self) -> bool:
+        return 'gzip' in (self.headers.get('Accept-Encoding') or '')
+
+    def send_content(self, send_body: bool):
+        if self.path.startswith(PROXY_PATH):
+            self.send_proxied(send_body)
+            return
+        if urlsplit(self.path).path == METRICS_PATH:
+            body = self.get_fcast_server().metrics.render().encode('utf-8')
+            self.send_bytes('text/plain; version=0.0.4; charset=utf-8', body, send_body, cache_control='no-store')
             return
-        
-        self.send_response(200)
-        self.send_header('Content-Type', self.get_fcast_server().get_content_type())
-        self.send_header('Content-Length', str(len(self.get_fcast_server().get_content())))
-        self.end_headers()
 
-    def do_GET(self):
-        if not self.get_fcast_server().is_valid_content():
+        content = self.get_fcast_server().get_content(self.path)
+        if not content or not content.content_type or not content.body:
             self.send_error(404, 'Not found')
             return
 
-        self.send_response(200)
-        self.send_header('Content-Type', self.get_fcast_server().get_content_type())
+        if self.headers.get('If-None-Match') == content.etag:
+            self.send_response(304)
+            self.send_header('ETag', content.etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        # Players may keep polling a live manifest, let them revalidate through the ETag
+        self.send_bytes(content.content_type, content.body, send_body, content.etag, content.gzip_body, 'no-cache')
+
+    def send_proxied(self, send_body: bool):
+        server = self.get_fcast_server()
+        response = server.proxy.handle(server.get_base_url(), self.path, self.headers)
+        if response.stream is not None or response.status in (206, 304, 412, 416):
+            self.send_relayed(response, send_body)
+            return
+        if response.status != 200:
+            self.send_error(response.status)
+            return
+        self.send_bytes(response.content_type, response.body, send_body)
+
+    def send_relayed(self, response: ProxyResponse, send_body: bool):
+        """Send an origin response with its status and headers, streaming its body if it was not read"""
+        try:
+            self.send_response(response.status)
+            if response.status != 304:
+                self.send_header('Content-Type', response.content_type)
+            for name, value in response.headers.items():
+                if name != 'Content-Length' or response.stream is not None:
+                    self.send_header(name, value)
+            if response.stream is None:
+                self.send_header('Content-Length', str(len(response.body)))
+            elif 'Content-Length' not in response.headers:
+                # Without a length, the end of the body is the end of the connection
+                self.close_connection = True
+            self.end_headers()
+
+            if not send_body:
+                return
+            if response.stream is None:
+                self.wfile.write(response.body)
+                return
+            while True:
+                chunk = response.stream.read(PROXY_CHUNK_SIZE)
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+        finally:
+            response.close()
+
+    def send_bytes(self,
+        content_type: str,
+        body: bytes,
+        send_body: bool,
+        etag: Optional[str] = None,
+        gzip_body: Optional[bytes] = None,
+        cache_control: Optional[str] = None
+    ):
+        byte_range = self.parse_range(len(body))
+        payload = memoryview(body)
+
+        if byte_range:
+            start, end = byte_range
+            if start >= len(body) or start > end:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */%d' % len(body))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, len(body)))
+            payload = payload[start:end + 1]
+        else:
+            self.send_response(200)
+            if gzip_body and self.accepts_gzip():
+                payload = memoryview(gzip_body)
+                self.send_header('Content-Encoding', 'gzip')
+
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(payload)))
+        if etag:
+            self.send_header('ETag', etag)
+        self.send_header('Accept-Ranges', 'bytes')
+        if gzip_body:
+            self.send_header('Vary', 'Accept-Encoding')
+        if cache_control:
+            self.send_header('Cache-Control', cache_control)
         self.end_headers()
-        self.wfile.write(self.get_fcast_server().get_content().encode('utf-8'))
 
+        if send_body:
+            self.wfile.write(payload)
+
+    def do_HEAD(self):
+        self.send_content(send_body=False)
+
+    def do_GET(self):
+        self.send_content(send_body=True)
@@ -0,0 +1,157 @@
+from bisect import bisect_left
+from threading import active_count, get_ident, Lock
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from .FCastPackets import OpCode
+
+# Seconds, from 10 µs to 1 s
+LATENCY_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)
+# Seconds, for playback startup
+STARTUP_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0)
+
+class Counter:
+    """
+    Monotonic counter sharded per thread. Each thread only ever updates its own
+    cell, so inc() needs no lock; the cells are summed when the counter is read.
+    """
+    __slots__ = ('name', 'labels', '_cells')
+
+    def __init__(self, name: str, labels: Optional[Dict[str, str]] = None):
+        self.name = name
+        self.labels = labels or {}
+        self._cells: Dict[int, List[float]] = {}
+
+    def inc(self, amount: float = 1):
+        cell = self._cells.get(get_ident())
+        if cell is None:
+            cell = self._cells[get_ident()] = [0]
+        cell[0] += amount
+
+    @property
+    def value(self) -> float:
+        # list() copies the cells atomically, even while a new thread adds one
+        return sum(cell[0] for cell in list(self._cells.values()))
+
+class Histogram:
+    """Histogram with fixed buckets, sharded per thread like Counter"""
+    __slots__ = ('name', 'labels', 'buckets', '_cells')
+
+    def __init__(self, name: str, buckets: Sequence[float] = LATENCY_BUCKETS, labels: Optional[Dict[str, str]] = None):
+        self.name = name
+        self.labels = labels or {}
+        self.buckets = tuple(buckets)
+        # Per thread: one count per bucket, the +Inf count, then the sum of observations
+        self._cells: Dict[int, List[float]] = {}
+
+    def observe(self, value: float):
+        cell = self._cells.get(get_ident())
+        if cell is None:
+            cell = self._cells[get_ident()] = [0] * (len(self.buckets) + 2)
+        cell[bisect_left(self.buckets, value)] += 1
+        cell[-1] += value
+
+    def snapshot(self) -> Tuple[List[float], float]:
+        """Cumulative bucket counts (the last one is +Inf) and the sum"""
+        totals = [0.0] * (len(self.buckets) + 2)
+        for cell in list(self._cells.values()):
+            for index, value in enumerate(cell):
+                totals[index] += value
+        cumulative = []
+        count = 0.0
+        for value in totals[:-1]:
+            count += value
+            cumulative.append(count)
+        return cumulative, totals[-1]
+
+Collector = Callable[[], float]
+
+class MetricsRegistry:
+    """Metrics exposed in the Prometheus text format on /metrics"""
+
+    def __init__(self):
+        self._lock = Lock()
+        # name -> (type, help, metrics or collectors with their labels)
+        self._families: Dict[str, Tuple[str, str, list]] = {}
+
+    def counter(self, name: str, help: str, **labels: str) -> Counter:
+        counter = Counter(name, labels)
+        self.__add(name, 'counter', help, counter)
+        return counter
+
+    def histogram(self, name: str, help: str, buckets: Sequence[float] = LATENCY_BUCKETS, **labels: str) -> Histogram:
+        histogram = Histogram(name, buckets, labels)
+        self.__add(name, 'histogram', help, histogram)
+        return histogram
+
+    def collect(self, name: str, help: str, func: Collector, type: str = 'gauge', **labels: str):
+        """Expose a value read when /metrics is requested, e.g. a counter kept by another object"""
+        self.__add(name, type, help, (func, labels))
+
+    def render(self) -> str:
+        with self._lock:
+            families = list(self._families.items())
+
+        lines = []
+        for name, (type, help, members) in families:
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {type}')
+            for member in members:
+                if isinstance(member, Counter):
+                    lines.append(f'{name}{format_labels(member.labels)} {format_value(member.value)}')
+                elif isinstance(member, Histogram):
+                    cumulative, total = member.snapshot()
+                    for bound, count in zip(member.buckets + (float('inf'),), cumulative):
+                        labels = dict(member.labels, le='+Inf' if bound == float('inf') else repr(bound))
+                        lines.append(f'{name}_bucket{format_labels(labels)} {format_value(count)}')
+                    lines.append(f'{name}_sum{format_labels(member.labels)} {format_value(total)}')
+                    lines.append(f'{name}_count{format_labels(member.labels)} {format_value(cumulative[-1])}')
+                else:
+                    func, labels = member
+                    try:
+                        value = func()
+                    except Exception:
+                        continue
+                    lines.append(f'{name}{format_labels(labels)} {format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+    def __add(self, name: str, type: str, help: str, member):
+        with self._lock:
+            family = self._families.setdefault(name, (type, help, []))
+            family[2].append(member)
+
+def format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"')) for key, value in labels.items()) + '}'
+
+def format_value(value: float) -> str:
+    value = float(value)
+    if value != value:
+        return 'NaN'
+    if value in (float('inf'), float('-inf')):
+        return '+Inf' if value > 0 else '-Inf'
+    return str(int(value)) if value.is_integer() else repr(value)
+
+metrics = MetricsRegistry()
+
+# Indexed by the raw opcode byte
+PACKETS_RECEIVED = [metrics.counter('fcast_packets_received_total', 'FCast packets received', opcode=op.name.lower()) for op in OpCode]
+PACKETS_SENT = [metrics.counter('fcast_packets_sent_total', 'FCast packets queued for sending', opcode=op.name.lower()) for op in OpCode]
+BYTES_RECEIVED = metrics.counter('fcast_bytes_received_total', 'Bytes received from FCast clients')
+BYTES_SENT = metrics.counter('fcast_bytes_sent_total', 'Bytes written to FCast clients')
+CONNECTIONS = metrics.counter('fcast_connections_total', 'FCast client connections accepted')
+PARSE_ERRORS = metrics.counter('fcast_parse_errors_total', 'Empty packets and packets with an invalid body')
+UNKNOWN_OPCODES = metrics.counter('fcast_unknown_opcodes_total', 'Packets ignored for having an unknown opcode')
+CONNECTIONS_REJECTED = {
+    reason: metrics.counter('fcast_connections_rejected_total', 'Connections refused by admission control', reason=reason)
+    for reason in ('global_limit', 'ip_limit', 'penalty')
+}
+PACKETS_THROTTLED = metrics.counter('fcast_packets_throttled_total', 'Packets discarded for exceeding the session packet rate')
+READS_THROTTLED = metrics.counter('fcast_reads_throttled_total', 'Times reading from a client was paused for exceeding its rate limits')
+SESSIONS_DROPPED = metrics.counter('fcast_sessions_dropped_total', 'Sessions closed for exceeding their packet rate')
+OVERSIZED_PACKETS = metrics.counter('fcast_oversized_packets_total', 'Connections closed for exceeding the maximum packet length')
+BROADCAST_LATENCY = metrics.histogram('fcast_broadcast_seconds', 'Time to encode a player update and queue it for every session')
+# Its sum over its count is the mean time to first frame
+TIME_TO_FIRST_FRAME = metrics.histogram('fcast_play_startup_seconds', 'Time from a PLAY request to playback start', STARTUP_BUCKETS)
+
+metrics.collect('fcast_threads', 'Threads running in the receiver process', active_count)
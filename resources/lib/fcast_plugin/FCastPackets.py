@@ -1,20 +1,75 @@
-from datetime import datetime, timezone
 from enum import Enum
-from typing import Optional
+from time import time as wall_clock
+from typing import Any, Dict, List, Optional
+
+class OpCode(int, Enum):
+    NONE = 0
+    PLAY = 1
+    PAUSE = 2
+    RESUME = 3
+    STOP = 4
+    SEEK = 5
+    PLAYBACK_UPDATE = 6
+    VOLUME_UPDATE = 7
+    SET_VOLUME = 8
+    PLAYBACK_ERROR = 9
+    SET_SPEED = 10
+    VERSION = 11
+    PING = 12
+    PONG = 13
+    # Version 3
+    INITIAL = 14
+    PLAY_UPDATE = 15
+    SET_PLAYLIST_ITEM = 16
+    SUBSCRIBE_EVENT = 17
+    UNSUBSCRIBE_EVENT = 18
+    EVENT = 19
 
 class PlayBackState(int, Enum):
     IDLE = 0
     PLAYING = 1
     PAUSED = 2
 
-class PlayMessage:
+class ContentType(int, Enum):
+    PLAYLIST = 0
+
+class EventType(int, Enum):
+    MEDIA_ITEM_START = 0
+    MEDIA_ITEM_END = 1
+    MEDIA_ITEM_CHANGE = 2
+    KEY_DOWN = 3
+    KEY_UP = 4
+
+# Container of a PLAY message whose content is a PlaylistContent
+PLAYLIST_CONTAINER = 'application/json'
+
+class FCastMessage:
+    """
+    Base class of FCast message bodies. Subclasses list their wire fields in __slots__,
+    which doubles as the field order used by to_wire and the keys accepted by from_wire.
+    """
+    __slots__ = ()
+
+    def to_wire(self) -> Dict[str, Any]:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    @classmethod
+    def from_wire(cls, obj: Dict[str, Any]):
+        # Unknown keys (e.g. fields from newer protocol versions) are ignored
+        return cls(**{name: obj[name] for name in cls.__slots__ if name in obj})
+
+class PlayMessage(FCastMessage):
+    __slots__ = ('container', 'url', 'content', 'time', 'speed', 'headers', 'volume', 'metadata')
+
     def __init__(self,
         container: str,
         url: Optional[str] = None,
         time: Optional[float] = None,
         content: Optional[str] = None,
         speed: float = 1.0,
-        headers = None
+        headers = None,
+        volume: Optional[float] = None,
+        metadata: Optional[Dict[str, Any]] = None
     ) -> None:
         self.container = container
         self.url = url
@@ -22,45 +77,237 @@ class PlayMessage:
         self.time = time
         self.speed = speed
         self.headers = headers
+        # Version 3
+        self.volume = volume
+        self.metadata = metadata
+
+class SeekMessage(FCastMessage):
+    __slots__ = ('time',)
 
-class SeekMessage:
     def __init__(self, time: float) -> None:
         self.time = time
 
-class PlayBackUpdateMessage:
+    def to_wire(self) -> Dict[str, Any]:
+        return {'time': self.time}
+
+    @classmethod
+    def from_wire(cls, obj: Dict[str, Any]):
+        return cls(obj['time'])
+
+class PlayBackUpdateMessage(FCastMessage):
+    __slots__ = ('time', 'duration', 'speed', 'state', 'generationTime', 'itemIndex')
+
     def __init__(self,
         time: float,
         state: PlayBackState,
         speed: float = 1.0,
         duration: Optional[float] = None,
-        generationTime: Optional[int] = None
+        generationTime: Optional[int] = None,
+        itemIndex: Optional[int] = None
     ) -> None:
         self.time = time
         self.duration = duration
         self.speed = speed
         self.state = state
-        self.generationTime = generationTime if generationTime else datetime.now(timezone.utc).timestamp() * 1000
+        self.generationTime = generationTime if generationTime else wall_clock() * 1000
+        # Version 3, index of the playing playlist item
+        self.itemIndex = itemIndex
+
+    def to_wire(self) -> Dict[str, Any]:
+        wire = {
+            'time': self.time,
+            'duration': self.duration,
+            'speed': self.speed,
+            'state': int(self.state),
+            'generationTime': self.generationTime,
+        }
+        if self.itemIndex is not None:
+            wire['itemIndex'] = self.itemIndex
+        return wire
+
+class VolumeUpdateMessage(FCastMessage):
+    __slots__ = ('volume', 'generationTime')
 
-class VolumeUpdateMessage:
     def __init__(self,
         volume: float,
         generationTime: Optional[float] = None
     ) -> None:
         self.volume = volume
-        self.generationTime = generationTime if generationTime else datetime.now(timezone.utc).timestamp() * 1000
+        self.generationTime = generationTime if generationTime else wall_clock() * 1000
+
+class SetVolumeMessage(FCastMessage):
+    __slots__ = ('volume',)
 
-class SetVolumeMessage:
     def __init__(self, volume: float) -> None:
         self.volume = volume
 
-class SetSpeedMessage:
+class SetSpeedMessage(FCastMessage):
+    __slots__ = ('speed',)
+
     def __init__(self, speed: float = 1.0) -> None:
         self.speed = speed
 
-class PlaybackErrorMessage:
+class PlaybackErrorMessage(FCastMessage):
+    __slots__ = ('message',)
+
     def __init__(self, message: str) -> None:
         self.message = message
 
-class VersionMessage:
+class VersionMessage(FCastMessage):
+    __slots__ = ('version',)
+
     def __init__(self, version: float) -> None:
         self.version = version
+
+class MediaItem(FCastMessage):
+    """Version 3 playlist entry"""
+    __slots__ = ('container', 'url', 'content', 'time', 'volume', 'speed', 'cache', 'showDuration', 'headers', 'metadata')
+
+    def __init__(self,
+        container: str,
+        url: Optional[str] = None,
+        content: Optional[str] = None,
+        time: Optional[float] = None,
+        volume: Optional[float] = None,
+        speed: Optional[float] = None,
+        cache: Optional[bool] = None,
+        showDuration: Optional[float] = None,
+        headers: Optional[Dict[str, str]] = None,
+        metadata: Optional[Dict[str, Any]] = None
+    ) -> None:
+        self.container = container
+        self.url = url
+        self.content = content
+        self.time = time
+        self.volume = volume
+        self.speed = speed
+        # Whether the sender wants the item preloaded
+        self.cache = cache
+        # Seconds an image item is shown
+        self.showDuration = showDuration
+        self.headers = headers
+        self.metadata = metadata
+
+    def to_play_message(self) -> PlayMessage:
+        return PlayMessage(
+            self.container,
+            url=self.url,
+            time=self.time,
+            content=self.content,
+            speed=self.speed if self.speed is not None else 1.0,
+            headers=self.headers,
+            volume=self.volume,
+            metadata=self.metadata,
+        )
+
+class PlaylistContent(FCastMessage):
+    """Version 3 content of a PLAY message with the PLAYLIST_CONTAINER container"""
+    __slots__ = ('contentType', 'items', 'offset', 'volume', 'speed', 'forwardCache', 'backwardCache', 'metadata')
+
+    def __init__(self,
+        items: List[MediaItem],
+        contentType: ContentType = ContentType.PLAYLIST,
+        offset: Optional[int] = None,
+        volume: Optional[float] = None,
+        speed: Optional[float] = None,
+        forwardCache: Optional[int] = None,
+        backwardCache: Optional[int] = None,
+        metadata: Optional[Dict[str, Any]] = None
+    ) -> None:
+        self.contentType = contentType
+        self.items = items
+        self.offset = offset
+        self.volume = volume
+        self.speed = speed
+        # Number of items after (before) the current one to preload
+        self.forwardCache = forwardCache
+        self.backwardCache = backwardCache
+        self.metadata = metadata
+
+    def to_wire(self) -> Dict[str, Any]:
+        wire = super().to_wire()
+        wire['contentType'] = int(self.contentType)
+        wire['items'] = [item.to_wire() for item in self.items]
+        return wire
+
+    @classmethod
+    def from_wire(cls, obj: Dict[str, Any]):
+        fields = {name: obj[name] for name in cls.__slots__ if name in obj}
+        fields['contentType'] = ContentType(fields.get('contentType', ContentType.PLAYLIST))
+        fields['items'] = [MediaItem.from_wire(item) for item in obj.get('items') or ()]
+        return cls(**fields)
+
+class InitialSenderMessage(FCastMessage):
+    __slots__ = ('displayName', 'appName', 'appVersion')
+
+    def __init__(self,
+        displayName: Optional[str] = None,
+        appName: Optional[str] = None,
+        appVersion: Optional[str] = None
+    ) -> None:
+        self.displayName = displayName
+        self.appName = appName
+        self.appVersion = appVersion
+
+class InitialReceiverMessage(FCastMessage):
+    __slots__ = ('displayName', 'appName', 'appVersion', 'playData')
+
+    def __init__(self,
+        displayName: Optional[str] = None,
+        appName: Optional[str] = None,
+        appVersion: Optional[str] = None,
+        playData: Optional[PlayMessage] = None
+    ) -> None:
+        self.displayName = displayName
+        self.appName = appName
+        self.appVersion = appVersion
+        # What is playing, so that a sender joining mid-playback can show it
+        self.playData = playData
+
+    def to_wire(self) -> Dict[str, Any]:
+        wire = super().to_wire()
+        wire['playData'] = self.playData.to_wire() if self.playData else None
+        return wire
+
+class PlayUpdateMessage(FCastMessage):
+    __slots__ = ('generationTime', 'playData')
+
+    def __init__(self, playData: Optional[PlayMessage] = None, generationTime: Optional[float] = None) -> None:
+        self.generationTime = generationTime if generationTime else wall_clock() * 1000
+        self.playData = playData
+
+    def to_wire(self) -> Dict[str, Any]:
+        return {
+            'generationTime': self.generationTime,
+            'playData': self.playData.to_wire() if self.playData else None,
+        }
+
+class SetPlaylistItemMessage(FCastMessage):
+    __slots__ = ('itemIndex',)
+
+    def __init__(self, itemIndex: int) -> None:
+        self.itemIndex = itemIndex
+
+class SubscribeEventMessage(FCastMessage):
+    __slots__ = ('event',)
+
+    def __init__(self, event: Dict[str, Any]) -> None:
+        # {"type": EventType, "keys": [...]} where keys only apply to key events
+        self.event = event
+
+class UnsubscribeEventMessage(FCastMessage):
+    __slots__ = ('event',)
+
+    def __init__(self, event: Dict[str, Any]) -> None:
+        self.event = event
+
+class EventMessage(FCastMessage):
+    __slots__ = ('generationTime', 'event')
+
+    def __init__(self, event: Dict[str, Any], generationTime: Optional[float] = None) -> None:
+        self.generationTime = generationTime if generationTime else wall_clock() * 1000
+        self.event = event
+
+    @classmethod
+    def media_item(cls, type: EventType, item: MediaItem) -> 'EventMessage':
+        return cls({'type': int(type), 'mediaItem': item.to_wire()})
@@ -0,0 +1,97 @@
+from threading import Lock
+import time
+from typing import Any, List, Optional, Tuple
+
+from .FCastPackets import OpCode, PlayBackState, PlayBackUpdateMessage, VolumeUpdateMessage
+
+class PlaybackStateStore:
+    """
+    Last known playback state, updated from player callbacks and occasional
+    position samples. While playing, the position is extrapolated from the
+    last sample with the monotonic clock and the playback speed, so reading it
+    never calls into Kodi. Wall clock timestamps (generationTime) are derived
+    from the monotonic clock through an offset taken once.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self.state = PlayBackState.IDLE
+        self.duration: Optional[float] = None
+        self.speed = 1.0
+        self.volume: Optional[float] = None
+        # Playing item of a version 3 playlist
+        self.item_index: Optional[int] = None
+        # Media position at the monotonic time `sampled_at`
+        self.sampled_position = 0.0
+        self.sampled_at = time.monotonic()
+        self._wall_offset = time.time() - time.monotonic()
+
+    def wall_time_ms(self, monotonic: Optional[float] = None) -> float:
+        return ((time.monotonic() if monotonic is None else monotonic) + self._wall_offset) * 1000
+
+    def position(self, now: Optional[float] = None) -> float:
+        with self._lock:
+            return self.__position(time.monotonic() if now is None else now)
+
+    def sample_age(self, now: Optional[float] = None) -> float:
+        """Seconds since the position was last sampled from the player"""
+        return (time.monotonic() if now is None else now) - self.sampled_at
+
+    def update(self,
+        state: Optional[PlayBackState] = None,
+        position: Optional[float] = None,
+        duration: Any = ...,
+        speed: Optional[float] = None,
+        item_index: Any = ...
+    ):
+        """Apply what a player callback reported, keeping the other fields (duration or item_index None clears it)"""
+        now = time.monotonic()
+        with self._lock:
+            # Anchor the extrapolated position before the state or speed it depends on changes
+            self.sampled_position = self.__position(now) if position is None else position
+            self.sampled_at = now
+            if state is not None:
+                self.state = state
+            if duration is not ...:
+                self.duration = duration
+            if speed is not None:
+                self.speed = speed
+            if item_index is not ...:
+                self.item_index = item_index
+
+    def set_volume(self, volume: float) -> bool:
+        """Record the volume, return whether it differs from the known one"""
+        with self._lock:
+            changed = self.volume != volume
+            self.volume = volume
+            return changed
+
+    def playback_update(self, now: Optional[float] = None) -> PlayBackUpdateMessage:
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            return PlayBackUpdateMessage(
+                round(self.__position(now), 3),
+                self.state,
+                speed=self.speed,
+                duration=self.duration,
+                generationTime=self.wall_time_ms(now),
+                itemIndex=self.item_index,
+            )
+
+    def volume_update(self) -> Optional[VolumeUpdateMessage]:
+        volume = self.volume
+        return VolumeUpdateMessage(volume, generationTime=self.wall_time_ms()) if volume is not None else None
+
+    def snapshot(self) -> List[Tuple[OpCode, Any]]:
+        """Messages bringing a newly connected sender up to date"""
+        messages: List[Tuple[OpCode, Any]] = [(OpCode.PLAYBACK_UPDATE, self.playback_update())]
+        volume = self.volume_update()
+        if volume:
+            messages.append((OpCode.VOLUME_UPDATE, volume))
+        return messages
+
+    def __position(self, now: float) -> float:
+        if self.state != PlayBackState.PLAYING:
+            return self.sampled_position
+        position = max(self.sampled_position + (now - self.sampled_at) * self.speed, 0.0)
+        return min(position, self.duration) if self.duration else position
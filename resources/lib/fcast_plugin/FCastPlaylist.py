@@ -0,0 +1,113 @@
+from threading import Lock
+from typing import Any, Callable, List, Optional, Set, Tuple
+
+from .FCastPackets import MediaItem, PlaylistContent
+from .util import DaemonExecutor, log
+
+# Items prepared ahead of the playing one at most, whatever forwardCache asks for
+PLAYLIST_MAX_PRELOAD = 3
+
+# Makes an item playable: (URL, ListItem) to queue in Kodi, None if it cannot be played
+Preparer = Callable[[MediaItem], Optional[Tuple[str, Any]]]
+
+class Playlist:
+    """
+    Version 3 playlist received in a PLAY message. Kodi plays it from its own
+    playlist (`kodi_playlist`), which only ever holds prepared items: while one
+    item plays, the next ones are resolved, detected and their manifests fetched
+    into the local HTTP server by `prepare`, then appended. Kodi moves on to
+    them by itself, without a stop/start round trip through the receiver.
+    """
+
+    def __init__(self, content: PlaylistContent, prepare: Preparer, kodi_playlist):
+        self.content = content
+        self.items: List[MediaItem] = content.items
+        self.index = min(max(content.offset or 0, 0), max(len(self.items) - 1, 0))
+        self.preload_count = min(max(content.forwardCache or 1, 1), PLAYLIST_MAX_PRELOAD)
+        self.prepare = prepare
+        self.kodi_playlist = kodi_playlist
+        # Item index of each entry of Kodi's playlist, by position
+        self.queued: List[int] = []
+        self._submitted: Set[int] = set()
+        # Incremented by restart(), preparations started before are discarded
+        self._generation = 0
+        self._lock = Lock()
+        self._executor: Optional[DaemonExecutor] = None
+        self._closed = False
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def item(self, index: Optional[int] = None) -> Optional[MediaItem]:
+        index = self.index if index is None else index
+        return self.items[index] if 0 <= index < len(self.items) else None
+
+    def position_of(self, index: int) -> Optional[int]:
+        """Position of an item in Kodi's playlist, None if it is not queued"""
+        with self._lock:
+            return self.queued.index(index) if index in self.queued else None
+
+    def index_at(self, position: int) -> Optional[int]:
+        with self._lock:
+            return self.queued[position] if 0 <= position < len(self.queued) else None
+
+    def restart(self, index: int):
+        """Empty Kodi's playlist to start over from `index`"""
+        with self._lock:
+            self._generation += 1
+            self.index = index
+            self.queued = []
+            self._submitted = set()
+            self.kodi_playlist.clear()
+
+    def queue(self, index: int, url: str, list_item) -> None:
+        with self._lock:
+            self.__append(index, url, list_item)
+
+    def preload(self):
+        """Prepare the items following the current one in the background"""
+        with self._lock:
+            if self._closed:
+                return
+            # Kodi plays its playlist in order, so only items after the last queued one can be appended
+            first = max(self.index, self.queued[-1] if self.queued else -1) + 1
+            upcoming = [
+                index for index in range(first, min(self.index + 1 + self.preload_count, len(self.items)))
+                if index not in self._submitted
+            ]
+            self._submitted.update(upcoming)
+            if upcoming and not self._executor:
+                # One worker keeps the items appended in playlist order
+                self._executor = DaemonExecutor(max_workers=1, thread_name_prefix='fcast-playlist')
+            executor = self._executor
+            generation = self._generation
+        for index in upcoming:
+            executor.submit(self.__prepare, index, generation)
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            executor = self._executor
+        if executor:
+            executor.shutdown(wait=False)
+
+    def __prepare(self, index: int, generation: int):
+        if self._closed or generation != self._generation:
+            return
+        try:
+            prepared = self.prepare(self.items[index])
+        except Exception as e:
+            log("Preparing playlist item failed", index=index, error=e)
+            return
+        if not prepared:
+            return
+        with self._lock:
+            if self._closed or generation != self._generation or (self.queued and index <= self.queued[-1]):
+                return
+            self.__append(index, *prepared)
+        log("Preloaded playlist item", index=index)
+
+    def __append(self, index: int, url: str, list_item):
+        self.kodi_playlist.add(url, list_item)
+        self.queued.append(index)
+        self._submitted.add(index)
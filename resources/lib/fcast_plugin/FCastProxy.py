@@ -0,0 +1,424 @@
+from collections import OrderedDict
+from concurrent.futures import Future
+import re
+import secrets
+from threading import Lock
+from typing import BinaryIO, Dict, List, Mapping, Optional, Set, Tuple
+import urllib.error
+import urllib.request
+from urllib.parse import urljoin, urlsplit
+
+from .util import DaemonExecutor, log
+
+PROXY_PATH = '/proxy/'
+
+# Default segment cache budget and number of segments fetched ahead of the player
+PROXY_CACHE_MAX_BYTES = 64 * 1024 * 1024
+PROXY_PREFETCH_COUNT = 3
+PROXY_PREFETCH_WORKERS = 3
+PROXY_TIMEOUT = 10
+# Bytes copied at a time when a body is streamed from the origin to the player
+PROXY_CHUNK_SIZE = 64 * 1024
+# Proxy sessions (one per play request) kept alive at most
+PROXY_MAX_SESSIONS = 16
+
+HLS_URI_ATTRIBUTE = re.compile(r'URI="([^"]+)"')
+DASH_BASE_URL = re.compile(r'(<BaseURL[^>]*>)\s*([^<\s]+)\s*(</BaseURL>)')
+DASH_URL_ATTRIBUTE = re.compile(r'\b(media|initialization|sourceURL)="([^"]+)"')
+# Player request headers forwarded to the origin, so that ranges and revalidation are answered upstream
+FORWARDED_HEADERS = ('Range', 'If-Range', 'If-None-Match', 'If-Modified-Since', 'If-Match', 'If-Unmodified-Since')
+# Origin response headers relayed to the player
+RELAYED_HEADERS = ('Content-Length', 'Content-Range', 'Content-Encoding', 'Accept-Ranges', 'ETag', 'Last-Modified')
+
+class ProxyResponse:
+    __slots__ = ('status', 'content_type', 'body', 'headers', 'stream')
+
+    def __init__(self,
+        status: int,
+        content_type: str,
+        body: bytes,
+        headers: Optional[Dict[str, str]] = None,
+        stream: Optional[BinaryIO] = None
+    ):
+        self.status = status
+        self.content_type = content_type
+        self.body = body
+        # Origin headers relayed to the player, only set for responses that are not rewritten or cached
+        self.headers = headers or {}
+        # Unread origin body, for bodies too large to buffer. Whoever gets the response must close it
+        self.stream = stream
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.close()
+
+class SegmentCache:
+    """Thread-safe LRU cache of segment bodies bounded by their total size"""
+
+    def __init__(self, max_bytes: int = PROXY_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._lock = Lock()
+        self._entries: 'OrderedDict[str, ProxyResponse]' = OrderedDict()
+
+    def __contains__(self, url: str) -> bool:
+        return url in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, url: str) -> Optional[ProxyResponse]:
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(url)
+            self.hits += 1
+            return entry
+
+    def accepts(self, length: int) -> bool:
+        # Entries that would flush most of the cache are not worth keeping
+        return length <= self.max_bytes // 4
+
+    def put(self, url: str, response: ProxyResponse) -> None:
+        if not self.accepts(len(response.body)):
+            return
+        with self._lock:
+            previous = self._entries.pop(url, None)
+            if previous:
+                self.size -= len(previous.body)
+            self._entries[url] = response
+            self.size += len(response.body)
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted.body)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+class ProxySession:
+    """Sender headers and known segment order of one proxied play request"""
+
+    def __init__(self, headers: Optional[Dict[str, str]]):
+        self.headers = dict(headers) if headers else {}
+        # Media playlist URL -> its segment URLs, in playback order
+        self.playlists: Dict[str, List[str]] = {}
+        # Segment URL -> (media playlist URL, index in that playlist)
+        self.positions: Dict[str, Tuple[str, int]] = {}
+        # URLs whose bodies were too large to cache, e.g. files addressed by EXT-X-BYTERANGE
+        self.streamed: Set[str] = set()
+
+    def set_segments(self, playlist_url: str, segments: List[str]):
+        for segment in self.playlists.get(playlist_url, []):
+            self.positions.pop(segment, None)
+        self.playlists[playlist_url] = segments
+        for index, segment in enumerate(segments):
+            self.positions[segment] = (playlist_url, index)
+
+    def next_segments(self, url: str, count: int) -> List[str]:
+        position = self.positions.get(url)
+        if not position:
+            return []
+        segments = self.playlists.get(position[0], [])
+        return segments[position[1] + 1:position[1] + 1 + count]
+
+class FCastProxy:
+    """
+    Local caching proxy for HLS and DASH streams. Playlists and manifests are
+    fetched with the sender's headers and rewritten so that every URL points
+    back at the proxy; segments are cached and the next ones prefetched, so
+    that seeks inside the buffered window are served locally.
+
+    Proxied URLs keep the origin URL in their path
+    (/proxy/<token>/<scheme>/<host>/<path>), so relative URLs resolve as usual.
+
+    Range and conditional requests that the cache cannot answer are forwarded
+    to the origin, and bodies too large to cache are streamed to the player
+    instead of being buffered.
+    """
+
+    def __init__(self,
+        cache: Optional[SegmentCache] = None,
+        prefetch_count: int = PROXY_PREFETCH_COUNT,
+        prefetch_workers: int = PROXY_PREFETCH_WORKERS,
+        timeout: float = PROXY_TIMEOUT
+    ):
+        self.cache = cache if cache is not None else SegmentCache()
+        self.prefetch_count = prefetch_count
+        self.timeout = timeout
+        self.prefetched = 0
+        self.executor = DaemonExecutor(max_workers=prefetch_workers, thread_name_prefix='fcast-prefetch')
+        self._lock = Lock()
+        self._sessions: 'OrderedDict[str, ProxySession]' = OrderedDict()
+        # URL -> pending fetch, so a segment is never downloaded twice at the same time
+        self._pending: Dict[str, Future] = {}
+        # Local path -> manifest fetched by preload(), served once to the player
+        self._preloaded: 'OrderedDict[str, ProxyResponse]' = OrderedDict()
+
+    def register(self, headers: Optional[Dict[str, str]] = None) -> str:
+        token = secrets.token_urlsafe(12)
+        with self._lock:
+            self._sessions[token] = ProxySession(headers)
+            while len(self._sessions) > PROXY_MAX_SESSIONS:
+                self._sessions.popitem(last=False)
+        return token
+
+    def get_session(self, token: str) -> Optional[ProxySession]:
+        with self._lock:
+            return self._sessions.get(token)
+
+    @staticmethod
+    def local_url(base_url: str, token: str, url: str) -> str:
+        parts = urlsplit(url)
+        local = f'{base_url}{PROXY_PATH}{token}/{parts.scheme}/{parts.netloc}{parts.path or "/"}'
+        return local + ('?' + parts.query if parts.query else '')
+
+    @staticmethod
+    def parse_path(path: str) -> Optional[Tuple[str, str]]:
+        """Split a local proxy path into (token, origin URL)"""
+        if not path.startswith(PROXY_PATH):
+            return None
+        path, _, query = path[len(PROXY_PATH):].partition('?')
+        parts = path.split('/', 3)
+        if len(parts) < 3 or parts[1] not in ('http', 'https'):
+            return None
+        url = f'{parts[1]}://{parts[2]}/{parts[3] if len(parts) > 3 else ""}'
+        return parts[0], url + ('?' + query if query else '')
+
+    def preload(self, base_url: str, path: str):
+        """
+        Fetch a proxied playlist or manifest ahead of playback (e.g. the next playlist
+        item), with the first variant playlist and segments, so that the player's own
+        requests are answered locally.
+        """
+        try:
+            self.executor.submit(self.__preload, base_url, path)
+        except RuntimeError:
+            # Executor already shut down
+            pass
+
+    def handle(self, base_url: str, path: str, request_headers: Optional[Mapping[str, str]] = None) -> ProxyResponse:
+        """Serve a local proxy path. A response with a stream must be closed once sent"""
+        with self._lock:
+            preloaded = self._preloaded.pop(path, None)
+        if preloaded:
+            return preloaded
+
+        parsed = self.parse_path(path)
+        session = self.get_session(parsed[0]) if parsed else None
+        if not parsed or not session:
+            return ProxyResponse(404, 'text/plain', b'Not found')
+        token, url = parsed
+        forwarded = {
+            name: request_headers[name] for name in FORWARDED_HEADERS
+            if request_headers and request_headers.get(name)
+        }
+
+        # Ranges of a cached body are cut locally, conditional requests go to the origin
+        cached = self.cache.get(url) if forwarded.keys() <= {'Range'} else None
+        if cached:
+            self.__prefetch_after(session, url)
+            return cached
+
+        if forwarded:
+            # Partial or conditional responses are neither shared with prefetches nor cached
+            response = self.__download(session, url, forwarded)
+        else:
+            response = self.__fetch(session, url)
+
+        if response.stream is None and is_hls(url, response):
+            text = self.rewrite_hls(response.body.decode('utf-8', 'replace'), url, base_url, token, session)
+            return ProxyResponse(response.status, response.content_type, text.encode('utf-8'))
+        if response.stream is None and is_dash(url, response):
+            text = self.rewrite_dash(response.body.decode('utf-8', 'replace'), url, base_url, token)
+            return ProxyResponse(response.status, response.content_type, text.encode('utf-8'))
+
+        if response.status == 200 and response.stream is None:
+            self.cache.put(url, response)
+        elif response.stream is not None:
+            with self._lock:
+                session.streamed.add(url)
+        self.__prefetch_after(session, url)
+        return response
+
+    def rewrite_hls(self, text: str, url: str, base_url: str, token: str, session: Optional[ProxySession] = None) -> str:
+        def proxied(value: str) -> str:
+            target = urljoin(url, value)
+            # Without a playlist URL (inline playlists) relative URLs cannot be resolved
+            if not target.startswith(('http://', 'https://')):
+                return value
+            return self.local_url(base_url, token, target)
+
+        lines = []
+        segments = []
+        for line in text.splitlines():
+            stripped = line.strip()
+            if not stripped:
+                lines.append(line)
+            elif stripped.startswith('#'):
+                lines.append(HLS_URI_ATTRIBUTE.sub(
+                    lambda m: 'URI="%s"' % proxied(m.group(1)),
+                    line
+                ))
+            else:
+                target = urljoin(url, stripped)
+                segments.append(target)
+                lines.append(proxied(stripped))
+
+        # Media playlists list segments, master playlists list other playlists
+        if session and '#EXTINF' in text:
+            with self._lock:
+                session.set_segments(url, segments)
+        return '\n'.join(lines) + '\n'
+
+    def rewrite_dash(self, text: str, url: Optional[str], base_url: str, token: str) -> str:
+        def proxied(value: str) -> Optional[str]:
+            # Relative URLs already resolve against the proxied manifest URL
+            if value.startswith(('http://', 'https://')):
+                return self.local_url(base_url, token, value)
+            if url and value.startswith('/'):
+                return self.local_url(base_url, token, urljoin(url, value))
+            return None
+
+        def base_url_element(m: 're.Match') -> str:
+            value = proxied(m.group(2))
+            return m.group(1) + value + m.group(3) if value else m.group(0)
+
+        def url_attribute(m: 're.Match') -> str:
+            value = proxied(m.group(2))
+            return '%s="%s"' % (m.group(1), value) if value else m.group(0)
+
+        text = DASH_BASE_URL.sub(base_url_element, text)
+        return DASH_URL_ATTRIBUTE.sub(url_attribute, text)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        self.cache.clear()
+
+    def __fetch(self, session: ProxySession, url: str) -> ProxyResponse:
+        with self._lock:
+            pending = self._pending.get(url)
+            if not pending:
+                pending = Future()
+                self._pending[url] = pending
+                owner = True
+            else:
+                owner = False
+
+        # Another thread (usually a prefetch) is already downloading this URL.
+        # A streamed body can only be read once, the waiter then downloads it itself
+        if not owner:
+            shared = pending.result()
+            return shared if shared is not None else self.__download(session, url)
+
+        try:
+            response = self.__download(session, url)
+            pending.set_result(response if response.stream is None else None)
+            return response
+        except BaseException as e:
+            pending.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._pending.pop(url, None)
+
+    def __download(self, session: ProxySession, url: str, forwarded: Optional[Dict[str, str]] = None) -> ProxyResponse:
+        request = urllib.request.Request(url, headers={**session.headers, **(forwarded or {})})
+        try:
+            upstream = urllib.request.urlopen(request, timeout=self.timeout)
+        except urllib.error.HTTPError as e:
+            # 304, 412 and 416 from forwarded headers land here as well
+            headers = relayed_headers(e.headers)
+            e.close()
+            return ProxyResponse(e.code, 'text/plain', b'', headers)
+        except Exception as e:
+            log("Proxy request failed", url=url, error=e)
+            return ProxyResponse(502, 'text/plain', b'')
+
+        content_type = upstream.headers.get('Content-Type', 'application/octet-stream')
+        headers = relayed_headers(upstream.headers)
+        length = headers.get('Content-Length', '')
+        # Playlists and manifests are always read, to be rewritten
+        if not is_manifest(url, content_type) and not (length.isdigit() and self.cache.accepts(int(length))):
+            return ProxyResponse(upstream.status, content_type, b'', headers, upstream)
+        try:
+            with upstream:
+                return ProxyResponse(upstream.status, content_type, upstream.read(), headers)
+        except Exception as e:
+            log("Proxy request failed", url=url, error=e)
+            return ProxyResponse(502, 'text/plain', b'')
+
+    def __prefetch_after(self, session: ProxySession, url: str):
+        if self.prefetch_count <= 0:
+            return
+        with self._lock:
+            upcoming = [
+                segment for segment in session.next_segments(url, self.prefetch_count)
+                if segment not in self.cache and segment not in self._pending and segment not in session.streamed
+            ]
+        for segment in upcoming:
+            try:
+                self.executor.submit(self.__prefetch, session, segment)
+            except RuntimeError:
+                # Executor already shut down
+                return
+
+    def __preload(self, base_url: str, path: str, depth: int = 0):
+        parsed = self.parse_path(path)
+        session = self.get_session(parsed[0]) if parsed else None
+        if not parsed or not session:
+            return
+        response = self.handle(base_url, path)
+        if response.stream is not None or response.status != 200 or not (is_hls(parsed[1], response) or is_dash(parsed[1], response)):
+            response.close()
+            return
+
+        with self._lock:
+            self._preloaded[path] = response
+            while len(self._preloaded) > PROXY_MAX_SESSIONS:
+                self._preloaded.popitem(last=False)
+            segments = session.playlists.get(parsed[1], [])[:self.prefetch_count]
+
+        if segments:
+            for segment in segments:
+                self.__prefetch(session, segment)
+        elif depth == 0 and is_hls(parsed[1], response):
+            # Master playlist: the player starts with one of the variants, usually the first
+            for line in response.body.decode('utf-8', 'replace').splitlines():
+                line = line.strip()
+                if line and not line.startswith('#') and line.startswith(base_url):
+                    self.__preload(base_url, line[len(base_url):], depth + 1)
+                    break
+
+    def __prefetch(self, session: ProxySession, url: str):
+        if url in self.cache:
+            return
+        response = self.__fetch(session, url)
+        if response.stream is not None:
+            # Too large to cache, the player's own request streams it
+            response.close()
+            with self._lock:
+                session.streamed.add(url)
+        elif response.status == 200:
+            self.cache.put(url, response)
+            self.prefetched += 1
+
+def is_hls(url: str, response: ProxyResponse) -> bool:
+    return 'mpegurl' in response.content_type.lower() or response.body[:7] == b'#EXTM3U'
+
+def is_dash(url: str, response: ProxyResponse) -> bool:
+    return 'dash+xml' in response.content_type.lower() or urlsplit(url).path.endswith('.mpd')
+
+def is_manifest(url: str, content_type: str) -> bool:
+    """Whether a response is a playlist or manifest, before its body was read"""
+    content_type = content_type.lower()
+    path = urlsplit(url).path
+    return 'mpegurl' in content_type or 'dash+xml' in content_type or path.endswith(('.m3u8', '.m3u', '.mpd'))
+
+def relayed_headers(headers: Mapping[str, str]) -> Dict[str, str]:
+    return {name: headers[name] for name in RELAYED_HEADERS if headers.get(name)}
@@ -0,0 +1,152 @@
+from enum import IntEnum
+import os
+import struct
+from threading import Lock
+import time
+from typing import BinaryIO, Iterator, List, Optional, Tuple
+
+import xbmc
+
+from .util import log
+
+# Start of every recording file, followed by the wall clock time the recorder started
+RECORDING_MAGIC = b'FCREC\x01'
+RECORDING_FILE_HEADER = struct.Struct('<6sd')
+# Each record: seconds since the recorder started, session id, RecordKind, payload length
+RECORD_HEADER = struct.Struct('<dIBI')
+# Size at which the file is rotated, and rotated files kept (path.1 is the most recent)
+RECORDING_MAX_BYTES = 16 * 1024 * 1024
+RECORDING_BACKUPS = 3
+# Bytes buffered before they are written out
+RECORDING_BUFFER_SIZE = 64 * 1024
+
+class RecordKind(IntEnum):
+    # Payload: the session class name
+    OPEN = 0
+    # Payload: bytes as received from the client, transport framing included
+    INBOUND = 1
+    # Payload: one FCast packet queued for the client, before transport framing
+    OUTBOUND = 2
+    CLOSE = 3
+
+Record = Tuple[float, int, RecordKind, bytes]
+
+class SessionRecorder:
+    """
+    Appends the traffic of every session to a compact binary log, for replaying
+    it later (benchmarks/replay.py). Writes are buffered and serialized by a
+    lock, since packets are sent from player threads too. The file is rotated
+    once it exceeds `max_bytes`; session ids and timestamps continue across
+    rotated files. Sessions only check FCastSession.recorder when none is set.
+    """
+
+    def __init__(self, path: str, max_bytes: int = RECORDING_MAX_BYTES, backups: int = RECORDING_BACKUPS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.records = 0
+        self._lock = Lock()
+        self._file: Optional[BinaryIO] = None
+        self._size = 0
+        self._next_id = 1
+        self._started = time.monotonic()
+        self._started_wall = time.time()
+        with self._lock:
+            self.__open_file()
+
+    def open(self, session) -> int:
+        """Record a new session, return the id its records are tagged with"""
+        with self._lock:
+            session_id = self._next_id
+            self._next_id += 1
+        self.record(session_id, RecordKind.OPEN, type(session).__name__.encode())
+        return session_id
+
+    def inbound(self, session_id: int, data):
+        self.record(session_id, RecordKind.INBOUND, data)
+
+    def outbound(self, session_id: int, packet: bytes):
+        self.record(session_id, RecordKind.OUTBOUND, packet)
+
+    def end(self, session_id: int):
+        self.record(session_id, RecordKind.CLOSE)
+
+    def record(self, session_id: int, kind: RecordKind, data = b''):
+        with self._lock:
+            file = self._file
+            if not file:
+                return
+            try:
+                file.write(RECORD_HEADER.pack(time.monotonic() - self._started, session_id, kind, len(data)))
+                file.write(data)
+            except (OSError, ValueError) as e:
+                log("Recording failed, stopping the recorder", xbmc.LOGERROR, path=self.path, error=e)
+                self.__close_file()
+                return
+            self.records += 1
+            self._size += RECORD_HEADER.size + len(data)
+            if self._size >= self.max_bytes:
+                self.__rotate()
+
+    def flush(self):
+        with self._lock:
+            if self._file:
+                self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self.__close_file()
+
+    def __open_file(self):
+        try:
+            self._file = open(self.path, 'wb', buffering=RECORDING_BUFFER_SIZE)
+            self._file.write(RECORDING_FILE_HEADER.pack(RECORDING_MAGIC, self._started_wall))
+            self._size = RECORDING_FILE_HEADER.size
+        except OSError as e:
+            log("Cannot open recording file", xbmc.LOGERROR, path=self.path, error=e)
+            self._file = None
+
+    def __close_file(self):
+        if self._file:
+            try:
+                self._file.close()
+            except OSError:
+                pass
+        self._file = None
+
+    def __rotate(self):
+        self.__close_file()
+        try:
+            for index in range(self.backups - 1, 0, -1):
+                if os.path.exists('%s.%d' % (self.path, index)):
+                    os.replace('%s.%d' % (self.path, index), '%s.%d' % (self.path, index + 1))
+            if self.backups:
+                os.replace(self.path, self.path + '.1')
+        except OSError as e:
+            log("Rotating the recording failed", xbmc.LOGWARNING, path=self.path, error=e)
+        self.__open_file()
+
+def recording_files(path: str) -> List[str]:
+    """Files of a recording from the oldest to the most recent"""
+    rotated = []
+    index = 1
+    while os.path.exists('%s.%d' % (path, index)):
+        rotated.append('%s.%d' % (path, index))
+        index += 1
+    return rotated[::-1] + ([path] if os.path.exists(path) else [])
+
+def read_recording(path: str) -> Iterator[Record]:
+    """Records of one recording file, up to the first incomplete one"""
+    with open(path, 'rb') as file:
+        header = file.read(RECORDING_FILE_HEADER.size)
+        if len(header) < RECORDING_FILE_HEADER.size or RECORDING_FILE_HEADER.unpack(header)[0] != RECORDING_MAGIC:
+            raise ValueError("%s is not an FCast recording" % path)
+        while True:
+            header = file.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            timestamp, session_id, kind, length = RECORD_HEADER.unpack(header)
+            data = file.read(length)
+            if len(data) < length:
+                return
+            yield timestamp, session_id, RecordKind(kind), data
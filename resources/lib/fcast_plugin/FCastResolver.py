@@ -0,0 +1,162 @@
+from collections import OrderedDict
+from concurrent.futures import Future
+from threading import Lock
+import time
+from typing import Dict, Optional
+import urllib.error
+import urllib.request
+
+from .util import DaemonExecutor, log
+
+RESOLVER_TIMEOUT = 5
+# Redirect targets are often signed and short-lived, so resolutions are only reused briefly
+RESOLVER_CACHE_TTL = 60
+RESOLVER_CACHE_MAX_ENTRIES = 32
+RESOLVER_WORKERS = 2
+# Bytes of the body read when sniffing the stream format
+RESOLVER_SNIFF_BYTES = 512
+
+class HeadRedirectHandler(urllib.request.HTTPRedirectHandler):
+    """urllib turns redirected HEAD requests into GET requests, keep them HEAD"""
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        request = super().redirect_request(req, fp, code, msg, headers, newurl)
+        if request is not None and req.get_method() == 'HEAD':
+            request.method = 'HEAD'
+        return request
+
+class Resolution:
+    __slots__ = ('url', 'final_url', 'status', 'mime_type', 'content_length', 'head', 'elapsed', 'resolved_at')
+
+    def __init__(self,
+        url: str,
+        final_url: str,
+        status: int,
+        mime_type: Optional[str] = None,
+        content_length: Optional[int] = None,
+        head: Optional[bytes] = None,
+        elapsed: float = 0.0
+    ):
+        self.url = url
+        self.final_url = final_url
+        self.status = status
+        self.mime_type = mime_type
+        self.content_length = content_length
+        # First bytes of the body, when sniffed
+        self.head = head
+        # Seconds spent resolving
+        self.elapsed = elapsed
+        self.resolved_at = time.monotonic()
+
+    @property
+    def ok(self) -> bool:
+        return 200 <= self.status < 300
+
+class MediaResolver:
+    """
+    Resolves media URLs ahead of playback: follows redirects with the sender's
+    headers and reads the MIME type from a HEAD request (or a one byte GET when
+    HEAD is refused). With `sniff`, the first bytes of the body are fetched
+    instead, to recognize playlists and manifests served under generic URLs.
+    Resolving also warms the DNS cache and the origin before Kodi opens the URL
+    itself. Runs on a small worker pool so it overlaps with stopping the previous
+    item; recent results are cached by URL.
+    """
+
+    def __init__(self,
+        timeout: float = RESOLVER_TIMEOUT,
+        cache_ttl: float = RESOLVER_CACHE_TTL,
+        max_entries: int = RESOLVER_CACHE_MAX_ENTRIES,
+        workers: int = RESOLVER_WORKERS
+    ):
+        self.timeout = timeout
+        self.cache_ttl = cache_ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.failures = 0
+        self.executor = DaemonExecutor(max_workers=workers, thread_name_prefix='fcast-resolver')
+        self.opener = urllib.request.build_opener(HeadRedirectHandler)
+        self._lock = Lock()
+        self._cache: 'OrderedDict[str, Resolution]' = OrderedDict()
+
+    def resolve_async(self, url: str, headers: Optional[Dict[str, str]] = None, sniff: bool = False) -> 'Future[Optional[Resolution]]':
+        cached = self.get(url, sniff)
+        if cached:
+            future: 'Future[Optional[Resolution]]' = Future()
+            future.set_result(cached)
+            return future
+        return self.executor.submit(self.resolve, url, headers, sniff)
+
+    def get(self, url: str, sniff: bool = False) -> Optional[Resolution]:
+        with self._lock:
+            resolution = self._cache.get(url)
+            if resolution and sniff and resolution.head is None:
+                return None
+            if resolution and time.monotonic() - resolution.resolved_at < self.cache_ttl:
+                self._cache.move_to_end(url)
+                self.hits += 1
+                return resolution
+            if resolution:
+                del self._cache[url]
+            return None
+
+    def resolve(self, url: str, headers: Optional[Dict[str, str]] = None, sniff: bool = False) -> Optional[Resolution]:
+        with self._lock:
+            self.misses += 1
+        start = time.monotonic()
+        try:
+            if sniff:
+                resolution = self.__request(url, headers, 'GET', RESOLVER_SNIFF_BYTES)
+            else:
+                resolution = self.__request(url, headers, 'HEAD')
+                if resolution.status in (403, 405, 501):
+                    # Some CDNs refuse HEAD, ask for the first byte instead
+                    resolution = self.__request(url, headers, 'GET', 1)
+                    resolution.head = None
+        except Exception as e:
+            log("Resolving failed", url=url, error=e)
+            with self._lock:
+                self.failures += 1
+            return None
+
+        resolution.elapsed = time.monotonic() - start
+        if resolution.ok:
+            with self._lock:
+                self._cache[url] = resolution
+                while len(self._cache) > self.max_entries:
+                    self._cache.popitem(last=False)
+        return resolution
+
+    def stats(self) -> Dict[str, int]:
+        return {'hits': self.hits, 'misses': self.misses, 'failures': self.failures}
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        with self._lock:
+            self._cache.clear()
+
+    def __request(self, url: str, headers: Optional[Dict[str, str]], method: str, read: int = 0) -> Resolution:
+        request_headers = dict(headers) if headers else {}
+        if read:
+            request_headers['Range'] = 'bytes=0-%d' % (read - 1)
+        request = urllib.request.Request(url, headers=request_headers, method=method)
+        try:
+            with self.opener.open(request, timeout=self.timeout) as response:
+                # Servers ignoring the range send the whole body, only read what is needed
+                head = response.read(read) if read else None
+                return self.__resolution(url, response.geturl(), response.status, response.headers, head)
+        except urllib.error.HTTPError as e:
+            return self.__resolution(url, e.geturl(), e.code, e.headers)
+
+    def __resolution(self, url: str, final_url: str, status: int, headers, head: Optional[bytes] = None) -> Resolution:
+        mime_type = headers.get_content_type() if headers and headers.get('Content-Type') else None
+        length = headers.get('Content-Length') if headers else None
+        return Resolution(
+            url,
+            final_url or url,
+            status,
+            mime_type,
+            int(length) if length and length.isdigit() else None,
+            head
+        )
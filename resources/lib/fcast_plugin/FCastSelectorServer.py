@@ -0,0 +1,336 @@
+import selectors
+import socket
+from threading import get_ident, Lock, Thread
+import time
+from typing import Any, Callable, Dict, List, Optional, Set, Type
+
+import xbmc
+
+from .FCastAdmission import AdmissionControl
+from .FCastMetrics import READS_THROTTLED
+from .FCastSession import FCastSession
+from .FCastTimerWheel import TimerWheel
+from .util import log
+
+SessionCallback = Callable[[FCastSession, Any], None]
+
+class Listener:
+    __slots__ = ('sock', 'session_class')
+
+    def __init__(self, sock: socket.socket, session_class: Type[FCastSession]):
+        self.sock = sock
+        # Session type speaking this port's transport, e.g. raw TCP or WebSocket
+        self.session_class = session_class
+
+class Connection:
+    __slots__ = ('sock', 'session', 'addr', 'writing', 'throttled', 'events')
+
+    def __init__(self, sock: socket.socket, session: FCastSession, addr):
+        self.sock = sock
+        self.session = session
+        self.addr = addr
+        # Whether output waits for write readiness, and whether reading is paused by the rate limits
+        self.writing = False
+        self.throttled = False
+        # Events the socket is registered for, 0 when unregistered
+        self.events = selectors.EVENT_READ
+
+class FCastSelectorServer:
+    """
+    Single-threaded FCast receiver: one selector owns the listening socket and
+    every client socket. Reads are dispatched when a socket is readable, and
+    queued session output is written by this loop, woken up through a socket pair
+    when other threads (e.g. Kodi player callbacks) queue packets.
+
+    Further ports with their own session type (e.g. WebSocket) are served by the
+    same loop, see listen().
+
+    Silent clients are pinged every `ping_interval` seconds and closed after
+    `idle_timeout` seconds without receiving anything (see
+    FCastSession.check_liveness), tracked by one timer wheel.
+
+    With `admission`, connections over its limits are closed right after accept,
+    and a client exceeding its session rate is not read from until it may send again.
+    """
+
+    sock: Optional[socket.socket] = None
+    loop_thread_id: Optional[int] = None
+
+    def __init__(self,
+        host: str = '',
+        port: int = 0,
+        on_connect: Optional[SessionCallback] = None,
+        on_disconnect: Optional[SessionCallback] = None,
+        buffer_size: int = 32000,
+        select_timeout: float = 0.5,
+        ping_interval: float = 20,
+        idle_timeout: float = 60,
+        admission: Optional[AdmissionControl] = None
+    ):
+        self.host = host
+        self.port = port
+        self.on_connect = on_connect
+        self.on_disconnect = on_disconnect
+        # Fallback bound on how late Kodi's abort request is noticed, the abort watcher wakes the loop
+        self.select_timeout = select_timeout
+        self.ping_interval = ping_interval
+        self.idle_timeout = idle_timeout
+        self.admission = admission
+        self.selector = selectors.DefaultSelector()
+        # Next liveness check of every session
+        self.timers = TimerWheel()
+
+        # Receive buffer shared by every client. Sessions copy whatever they cannot
+        # handle right away, so it can be reused for the next read
+        self.receive_buffer = bytearray(buffer_size)
+        self.receive_view = memoryview(self.receive_buffer)
+
+        self.listeners: List[Listener] = []
+        self.connections: Dict[FCastSession, Connection] = {}
+        # Monotonic time at which reading resumes, for throttled connections
+        self._throttled: Dict[Connection, float] = {}
+        # Sessions with output queued since the last loop iteration
+        self._pending: Set[FCastSession] = set()
+        self._pending_lock = Lock()
+        self._woken = False
+        self._wake_reader, self._wake_writer = socket.socketpair()
+        self._wake_reader.setblocking(False)
+        self._wake_writer.setblocking(False)
+        self.selector.register(self._wake_reader, selectors.EVENT_READ, data=self._wake_reader)
+
+    def bind(self):
+        self.sock = self.listen(self.port)
+
+    def listen(self, port: int, session_class: Type[FCastSession] = FCastSession) -> socket.socket:
+        """Accept clients on another port, served with `session_class`"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            sock.bind((self.host, port))
+            sock.listen()
+        except:
+            sock.close()
+            raise
+        listener = Listener(sock, session_class)
+        self.listeners.append(listener)
+        self.selector.register(sock, selectors.EVENT_READ, data=listener)
+        return sock
+
+    def get_port(self) -> int:
+        return int(self.sock.getsockname()[1]) if self.sock else self.port
+
+    def serve(self, monitor: xbmc.Monitor):
+        self.loop_thread_id = get_ident()
+        # Wake the loop as soon as Kodi requests the abort instead of at the next select timeout
+        Thread(target=self.__wait_for_abort, args=(monitor,), name='fcast-abort', daemon=True).start()
+        while not monitor.abortRequested():
+            timeout = self.timers.timeout()
+            timeout = self.select_timeout if timeout is None else min(timeout, self.select_timeout)
+            if self._throttled:
+                timeout = max(min(timeout, min(self._throttled.values()) - time.monotonic()), 0)
+            for key, mask in self.selector.select(timeout=timeout):
+                if isinstance(key.data, Listener):
+                    self.__accept(key.data)
+                elif key.data is self._wake_reader:
+                    self.__drain_wakeups()
+                else:
+                    if mask & selectors.EVENT_READ:
+                        self.__read(key.data)
+                    if mask & selectors.EVENT_WRITE:
+                        self.__write(key.data)
+            self.timers.advance()
+            if self._throttled:
+                self.__resume_throttled()
+            self.__flush_pending()
+        self.close()
+
+    def close(self):
+        # Close every remaining client
+        for connection in list(self.connections.values()):
+            self.__close(connection)
+        self.timers.clear()
+        self.selector.close()
+        self._wake_reader.close()
+        self._wake_writer.close()
+        for listener in self.listeners:
+            listener.sock.close()
+        self.listeners.clear()
+        self.sock = None
+
+    def wake(self):
+        try:
+            self._wake_writer.send(b'\0')
+        except (BlockingIOError, OSError):
+            pass
+
+    def __wait_for_abort(self, monitor: xbmc.Monitor):
+        monitor.waitForAbort()
+        self.wake()
+
+    def request_flush(self, session: FCastSession):
+        """Session wakeup: called from any thread when the session queued output"""
+        with self._pending_lock:
+            self._pending.add(session)
+            if self._woken or get_ident() == self.loop_thread_id:
+                # The loop flushes pending sessions at the end of its current iteration
+                return
+            self._woken = True
+        self.wake()
+
+    def __accept(self, listener: Listener):
+        try:
+            conn, addr = listener.sock.accept()
+        except (BlockingIOError, socket.timeout):
+            # Another readiness notification already consumed the connection
+            return
+
+        if self.admission and not self.admission.admit(addr[0]):
+            # Refused before any per-connection state exists
+            conn.close()
+            return
+
+        conn.setblocking(False)
+        # Small packets (PONG, playback updates) must not wait for Nagle's algorithm
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        session = listener.session_class(conn)
+        session.wakeup = self.request_flush
+        if self.admission:
+            session.limiter = self.admission.session_limiter()
+        connection = Connection(conn, session, addr)
+        self.connections[session] = connection
+        self.selector.register(conn, selectors.EVENT_READ, data=connection)
+        if self.idle_timeout:
+            self.timers.schedule(session, min(self.ping_interval, self.idle_timeout), self.__check_liveness)
+        if self.on_connect:
+            self.on_connect(session, addr)
+
+    def __read(self, connection: Connection):
+        try:
+            received = connection.sock.recv_into(self.receive_buffer)
+        except (BlockingIOError, InterruptedError):
+            # Spurious wakeup, nothing to read yet
+            return
+        except Exception as e:
+            log("Error reading from client", xbmc.LOGERROR, error=e)
+            self.__close(connection)
+            return
+
+        # An empty read means the client closed the connection
+        if received == 0:
+            self.__close(connection)
+            return
+
+        session = connection.session
+        try:
+            session.process_bytes(self.receive_view[:received])
+        except Exception as e:
+            log("Closing client after a processing error", xbmc.LOGERROR, error=e)
+            if self.admission and session.limiter and session.limiter.exceeded():
+                self.admission.penalize(connection.addr[0])
+            self.__close(connection)
+            return
+
+        delay = session.limiter.read_delay() if session.limiter else 0
+        if delay > 0 and session in self.connections:
+            READS_THROTTLED.inc()
+            self._throttled[connection] = time.monotonic() + delay
+            connection.throttled = True
+            self.__update_events(connection)
+
+    def __resume_throttled(self):
+        now = time.monotonic()
+        for connection, until in list(self._throttled.items()):
+            if until <= now:
+                del self._throttled[connection]
+                connection.throttled = False
+                self.__update_events(connection)
+
+    def __write(self, connection: Connection):
+        session = connection.session
+        if session.evicted:
+            self.__close(connection)
+            return
+        flushed = session.flush()
+        if not session.client:
+            # Sending failed and the session dropped its client
+            self.__close(connection)
+        elif flushed and connection.writing:
+            connection.writing = False
+            self.__update_events(connection)
+
+    def __check_liveness(self, session: FCastSession):
+        connection = self.connections.get(session)
+        if not connection:
+            return
+        delay = session.check_liveness(time.monotonic(), self.ping_interval, self.idle_timeout)
+        if delay is None:
+            log("Client timed out", address=connection.addr[0])
+            self.__close(connection)
+        else:
+            self.timers.schedule(session, delay, self.__check_liveness)
+
+    def __drain_wakeups(self):
+        try:
+            while self._wake_reader.recv(4096):
+                pass
+        except (BlockingIOError, OSError):
+            pass
+
+    def __flush_pending(self):
+        with self._pending_lock:
+            if not self._pending:
+                self._woken = False
+                return
+            pending = self._pending
+            self._pending = set()
+            self._woken = False
+
+        for session in pending:
+            connection = self.connections.get(session)
+            if not connection:
+                continue
+            if session.evicted:
+                self.__close(connection)
+            elif connection.writing:
+                # Already waiting for the socket to become writable
+                continue
+            elif not session.flush():
+                # The socket buffer is full, continue once it is writable
+                connection.writing = True
+                self.__update_events(connection)
+            elif not session.client:
+                self.__close(connection)
+
+    def __update_events(self, connection: Connection):
+        events = (0 if connection.throttled else selectors.EVENT_READ) | (selectors.EVENT_WRITE if connection.writing else 0)
+        if events == connection.events:
+            return
+        try:
+            # A selector cannot watch a socket for no event, so a throttled idle socket is unregistered
+            if not events:
+                self.selector.unregister(connection.sock)
+            elif not connection.events:
+                self.selector.register(connection.sock, events, data=connection)
+            else:
+                self.selector.modify(connection.sock, events, data=connection)
+        except (KeyError, ValueError):
+            pass
+        connection.events = events
+
+    def __close(self, connection: Connection):
+        if self.connections.pop(connection.session, None) is None:
+            return
+        self.timers.cancel(connection.session)
+        self._throttled.pop(connection, None)
+        if self.admission:
+            self.admission.release(connection.addr[0])
+        try:
+            if connection.events:
+                self.selector.unregister(connection.sock)
+        except (KeyError, ValueError):
+            pass
+        if self.on_disconnect:
+            self.on_disconnect(connection.session, connection.addr)
+        connection.session.close()
@@ -1,34 +1,30 @@
+from collections import deque
 from enum import Enum
-import json
 import socket
-import struct
-from typing import Any, Callable, Dict, List, Optional
-
+from threading import Lock
+import time
+from types import CoroutineType
+from typing import Any, Callable, Deque, Dict, List, Optional, Set, Type, TYPE_CHECKING
+
+from .FCastAdmission import SessionLimiter
+from .FCastCodec import LENGTH_BYTES, decode_message, encode_packet, unpack_length
+from .FCastMetrics import (
+    BYTES_RECEIVED, BYTES_SENT, CONNECTIONS, OVERSIZED_PACKETS, PACKETS_RECEIVED, PACKETS_SENT, PARSE_ERRORS,
+    SESSIONS_DROPPED, UNKNOWN_OPCODES,
+)
 from .FCastPackets import *
 from .util import log
 
+# Only imported by the receiver when recording is enabled
+if TYPE_CHECKING:
+    from .FCastRecorder import SessionRecorder
+
 class SessionState(int, Enum):
     IDLE = 0
     WAITING_FOR_LENGTH = 1
     WAITING_FOR_DATA = 2
     DISCONNECTED = 3
 
-class OpCode(int, Enum):
-    NONE = 0
-    PLAY = 1
-    PAUSE = 2
-    RESUME = 3
-    STOP = 4
-    SEEK = 5
-    PLAYBACK_UPDATE = 6
-    VOLUME_UPDATE = 7
-    SET_VOLUME = 8
-    PLAYBACK_ERROR = 9
-    SET_SPEED = 10
-    VERSION = 11
-    PING = 12
-    PONG = 13
-
 class Event(str, Enum):
     PLAY = "play"
     PAUSE = "pause"
@@ -37,144 +33,395 @@ class Event(str, Enum):
     SEEK = "seek"
     SET_VOLUME = "set_volume"
     SET_SPEED = "set_speed"
+    # Version 3
+    VERSION = "version"
+    INITIAL = "initial"
+    SET_PLAYLIST_ITEM = "set_playlist_item"
 
-LENGTH_BYTES = 4
 MAXIMUM_PACKET_LENGTH = 32000
-FCAST_VERSION = 1
+FCAST_VERSION = 3
+
+# Sessions whose unsent output grows past either limit are evicted
+OUTBOUND_QUEUE_MAX_PACKETS = 256
+OUTBOUND_QUEUE_MAX_BYTES = 512 * 1024
 
 class FCastSession:
 
-    buffer: bytes = bytes()
+    buffer: bytearray
     packet_length: int = 0
     client: Optional[socket.socket] = None
     state: SessionState = SessionState.DISCONNECTED
 
-    __listeners: Dict[str, List[Callable[[Any, Any], Any]]] = {}
+    # Called when queued output is waiting, so that the I/O loop drains it with flush().
+    # Without one, output is flushed right away by the sending thread.
+    wakeup: Optional[Callable[['FCastSession'], None]] = None
+
+    # Rate limits given by the server's admission control, none without it
+    limiter: Optional[SessionLimiter] = None
+
+    # Records the traffic of every session when set, see FCastRecorder
+    recorder: Optional['SessionRecorder'] = None
+    recording_id: int = 0
 
     def __init__(self, client: socket.socket):
         self.client = client
         self.state = SessionState.WAITING_FOR_LENGTH
+        # Holds a partially received header or packet, reused for the whole session
+        self.buffer = bytearray()
+        # Event -> listeners registered on this session only
+        self.__listeners: Dict[str, List[Callable[[Any, Any], Any]]] = {}
+
+        # Outbound packets not yet written, each wrapped in a list so that a queued
+        # playback update can be replaced in place by a newer one
+        self._outbound: Deque[List[bytes]] = deque()
+        self._outbound_bytes = 0
+        # Bytes of the first queued packet already written
+        self._outbound_offset = 0
+        self._queued_update: Optional[List[bytes]] = None
+        self._outbound_lock = Lock()
+        self.coalesced = 0
+        self.dropped = 0
+        self.evicted = False
+
+        # Protocol version agreed with the client, 1 until it reports its own
+        self.version = 1
+        self.version_sent = False
+        # Event types (EventType) the client subscribed to
+        self.subscriptions: Set[int] = set()
+        # Packets ignored for having an opcode we do not know
+        self.unknown_opcodes = 0
+
+        # Monotonic time of the last received bytes and of the last PING we sent
+        self.last_activity = time.monotonic()
+        self.ping_sent = 0.0
+        # Whether the client ever answered a PING, i.e. can be expected to answer the next ones
+        self.pong_received = False
+        # Whether the client sent a packet with a known opcode, i.e. is an FCast sender at all
+        self.packet_handled = False
+        CONNECTIONS.inc()
+        if self.recorder:
+            self.recording_id = self.recorder.open(self)
 
     def close(self):
+        if self.recorder and self.recording_id:
+            # Closed more than once, by the server and by the disconnect handler
+            self.recorder.end(self.recording_id)
+            self.recording_id = 0
         if self.client:
             self.client.close()
         self.client = None
         self.state = SessionState.DISCONNECTED
+        with self._outbound_lock:
+            self.dropped += len(self._outbound)
+            self.__clear_outbound()
 
     def send_playback_update(self, value: PlayBackUpdateMessage):
-        self.__send(OpCode.PLAYBACK_UPDATE, value)
+        self.send_packet(encode_packet(OpCode.PLAYBACK_UPDATE, value), coalesce=True)
 
     def send_volume_update(self, value: VolumeUpdateMessage):
         self.__send(OpCode.VOLUME_UPDATE, value)
 
-    def __send(self, opcode: OpCode, message = None):
-        if not self.client:
-            return
-
-        # FCast packet header
-        json_message = json.dumps(message.__dict__) if message else None
-        body_size = (len(json_message) if json_message else 0) + 1
-        header = struct.pack("<IB", body_size, opcode.value)
-
-        packet = header
-
-        # Append data to FCast packet, if any
-        if json_message:
-            packet += json_message.encode("utf-8")
+    def send_version(self):
+        """Announce our version, done on connect so that the client can negotiate right away"""
+        self.version_sent = True
+        self.__send(OpCode.VERSION, VersionMessage(version=FCAST_VERSION))
 
-        # Send the packet
-        try:
-            self.client.send(packet)
-        except Exception as e:
-            log("Error while sending packet to client, destroying socket...")
-            log(str(e))
-            self.client = None
+    def send_event(self, packet: bytes, event_type: EventType):
+        """Send an encoded EVENT packet if the client subscribed to its type"""
+        if event_type in self.subscriptions:
+            self.send_packet(packet)
 
-    def process_bytes(self, received_bytes: bytes):
+    def __send(self, opcode: OpCode, message = None):
+        self.send_packet(encode_packet(opcode, message))
+
+    def send_packet(self, packet: bytes, coalesce: bool = False):
+        """
+        Queue an already encoded FCast packet, e.g. one shared by a broadcast.
+        With `coalesce`, the packet replaces a playback update still waiting in the
+        queue, since only the newest position matters to the sender.
+        """
+        PACKETS_SENT[packet[LENGTH_BYTES]].inc()
+        if self.recorder:
+            self.recorder.outbound(self.recording_id, packet)
+        self._enqueue(self._frame(packet), coalesce)
+
+    def _frame(self, packet: bytes) -> bytes:
+        """Wrap an FCast packet for the transport, raw TCP sends it as is"""
+        return packet
+
+    def _enqueue(self, packet: bytes, coalesce: bool = False):
+        """Queue bytes for the transport, bypassing the FCast packet accounting"""
+        with self._outbound_lock:
+            if not self.client or self.evicted:
+                self.dropped += 1
+                return
+
+            queued = self._queued_update
+            # The head of the queue may be partially written and cannot be replaced
+            if coalesce and queued and not (self._outbound_offset and self._outbound[0] is queued):
+                self._outbound_bytes += len(packet) - len(queued[0])
+                queued[0] = packet
+                self.coalesced += 1
+            else:
+                frame = [packet]
+                self._outbound.append(frame)
+                self._outbound_bytes += len(packet)
+                if coalesce:
+                    self._queued_update = frame
+
+            if len(self._outbound) > OUTBOUND_QUEUE_MAX_PACKETS or self._outbound_bytes > OUTBOUND_QUEUE_MAX_BYTES:
+                # The client stopped reading: drop its output, the I/O loop will disconnect it
+                log("Client is not reading its packets, evicting it")
+                self.evicted = True
+                self.dropped += len(self._outbound)
+                self.__clear_outbound()
+
+        if self.wakeup:
+            self.wakeup(self)
+        else:
+            self.flush()
+
+    def flush(self) -> bool:
+        """Write as much queued output as the socket accepts, return whether everything was written"""
+        with self._outbound_lock:
+            while self._outbound and self.client:
+                frame = self._outbound[0]
+                view = memoryview(frame[0])[self._outbound_offset:]
+                try:
+                    written = self.client.send(view)
+                except (BlockingIOError, InterruptedError):
+                    return False
+                except Exception as e:
+                    log("Error while sending packet to client, destroying socket...", error=e)
+                    self.client = None
+                    self.dropped += len(self._outbound)
+                    self.__clear_outbound()
+                    return True
+
+                BYTES_SENT.inc(written)
+                self._outbound_offset += written
+                if self._outbound_offset < len(frame[0]):
+                    # Partial write, the rest goes out once the socket is writable again
+                    return False
+
+                self._outbound.popleft()
+                self._outbound_bytes -= len(frame[0])
+                self._outbound_offset = 0
+                if frame is self._queued_update:
+                    self._queued_update = None
+            return True
+
+    def queue_stats(self) -> Dict[str, int]:
+        return {
+            'queue_depth': len(self._outbound),
+            'queue_bytes': self._outbound_bytes,
+            'coalesced': self.coalesced,
+            'dropped': self.dropped,
+            'evicted': int(self.evicted),
+        }
+
+    def check_liveness(self, now: float, ping_interval: float, idle_timeout: float) -> Optional[float]:
+        """
+        Send a PING once the client has been silent for `ping_interval`, and again every
+        `ping_interval` while it stays silent. Return the delay until the next check,
+        None once nothing was received for `idle_timeout` and the session should be closed.
+
+        Version 1 senders may neither answer PINGs nor send anything during playback,
+        so a client that already sent a valid packet is only closed for silence from
+        version 2 on, or once it answered a PING. Clients that never sent one are
+        always closed, so that idle sockets cannot hold connection slots.
+        """
+        enforced = self.version >= 2 or self.pong_received or not self.packet_handled
+        if enforced and now - self.last_activity >= idle_timeout:
+            return None
+        last_ping = max(self.last_activity, self.ping_sent)
+        if now - last_ping >= ping_interval:
+            self.ping_sent = last_ping = now
+            self.__send(OpCode.PING)
+        if not enforced:
+            return last_ping + ping_interval - now
+        return min(self.last_activity + idle_timeout, last_ping + ping_interval) - now
+
+    def __clear_outbound(self):
+        self._outbound.clear()
+        self._outbound_bytes = 0
+        self._outbound_offset = 0
+        self._queued_update = None
+
+    def process_bytes(self, received_bytes):
+        """
+        Feed received bytes (bytes, bytearray or memoryview) into the framing state machine.
+        Complete packets are handled in place; only incomplete ones are copied into the session buffer.
+        """
         if not received_bytes or len(received_bytes) <= 0:
             return
-        
-        if self.state == SessionState.WAITING_FOR_LENGTH:
-            self.__handle_length_bytes(received_bytes)
-        elif self.state == SessionState.WAITING_FOR_DATA:
-            self.__handle_packet_bytes(received_bytes)
-        else:
+        self.last_activity = time.monotonic()
+        BYTES_RECEIVED.inc(len(received_bytes))
+        if self.recorder:
+            self.recorder.inbound(self.recording_id, received_bytes)
+        if self.limiter:
+            self.limiter.receive(len(received_bytes), self.last_activity)
+
+        if self.state != SessionState.WAITING_FOR_LENGTH and self.state != SessionState.WAITING_FOR_DATA:
             raise Exception("Data received is unhandled in current session state %s" % self.state)
-        
-    def __handle_length_bytes(self, received_bytes: bytes):
-        bytes_to_read = min(LENGTH_BYTES, len(received_bytes))
-        bytes_remaining = len(received_bytes) - bytes_to_read
 
-        self.buffer += received_bytes[:bytes_to_read]
-
-        if len(self.buffer) >= LENGTH_BYTES:
-            self.state = SessionState.WAITING_FOR_DATA
-            self.packet_length = struct.unpack("<I", self.buffer[:4])[0]
-            self.buffer = bytes()
-
-            if self.packet_length > MAXIMUM_PACKET_LENGTH:
-                if self.client:
-                    self.client.close()
-                self.state = SessionState.DISCONNECTED
-                raise Exception("Packet length %d exceeds maximum packet length %d" % (self.packet_length, MAXIMUM_PACKET_LENGTH))
-            
-            if bytes_remaining > 0:
-                self.__handle_packet_bytes(received_bytes[bytes_to_read:])
-
-    def __handle_packet_bytes(self, received_bytes: bytes):
-        bytes_to_read = min(self.packet_length, len(received_bytes))
-        bytes_remaining = len(received_bytes) - bytes_to_read
-
-        self.buffer += received_bytes[:bytes_to_read]
-
-        # Packet fully received
-        if len(self.buffer) >= self.packet_length:
-
-            self.__handle_packet()
-
-            self.state = SessionState.WAITING_FOR_LENGTH
-            self.packet_length = 0
-            self.buffer = bytes()
-
-            # If there are more bytes to read, treat them as a new packet
-            if bytes_remaining > 0:
-                self.__handle_length_bytes(received_bytes[bytes_to_read:])
+        self._parse_packets(memoryview(received_bytes))
+
+    def _parse_packets(self, data: memoryview):
+        """Split FCast packets out of the byte stream and handle them"""
+        size = len(data)
+        offset = 0
+
+        while offset < size:
+            if self.state == SessionState.WAITING_FOR_LENGTH:
+                if not self.buffer and size - offset >= LENGTH_BYTES:
+                    # Fast path: the whole header is available
+                    self.packet_length = unpack_length(data, offset)[0]
+                    offset += LENGTH_BYTES
+                else:
+                    bytes_to_read = min(LENGTH_BYTES - len(self.buffer), size - offset)
+                    self.buffer += data[offset:offset + bytes_to_read]
+                    offset += bytes_to_read
+                    if len(self.buffer) < LENGTH_BYTES:
+                        break
+                    self.packet_length = unpack_length(self.buffer)[0]
+                    del self.buffer[:]
+
+                if self.packet_length > MAXIMUM_PACKET_LENGTH:
+                    OVERSIZED_PACKETS.inc()
+                    if self.client:
+                        self.client.close()
+                    self.state = SessionState.DISCONNECTED
+                    raise Exception("Packet length %d exceeds maximum packet length %d" % (self.packet_length, MAXIMUM_PACKET_LENGTH))
+
+                self.state = SessionState.WAITING_FOR_DATA
+
+            elif self.state == SessionState.WAITING_FOR_DATA:
+                if not self.buffer and size - offset >= self.packet_length:
+                    # Fast path: the whole packet is available, handle it without copying
+                    packet = data[offset:offset + self.packet_length]
+                    offset += self.packet_length
+                    self.__complete_packet(packet)
+                else:
+                    bytes_to_read = min(self.packet_length - len(self.buffer), size - offset)
+                    self.buffer += data[offset:offset + bytes_to_read]
+                    offset += bytes_to_read
+                    if len(self.buffer) < self.packet_length:
+                        break
+                    with memoryview(self.buffer) as packet:
+                        self.__complete_packet(packet)
+                    del self.buffer[:]
+
+            else:
+                # A listener closed the session, drop the rest of the input
+                break
+
+    def __complete_packet(self, packet: memoryview):
+        self.state = SessionState.WAITING_FOR_LENGTH
+        self.packet_length = 0
+        self.__handle_packet(packet)
 
     def on(self, event: Event, callback: Callable[[Any, Any], Any]):
-        if event not in self.__listeners:
-            self.__listeners[event] = []
-        self.__listeners[event].append(callback)
+        self.__listeners.setdefault(event, []).append(callback)
 
     def __emit(self, event: str, body = None):
-        if event in self.__listeners:
-            for listener in self.__listeners[event]:
-                listener(self, body)
-
-    def __handle_packet(self):
-
-        opcode = OpCode(struct.unpack("<B", self.buffer[:1])[0])
-        body = self.buffer[1:] if len(self.buffer) > 1 else None
-
-        if opcode == OpCode.PLAY:
-            self.__emit(Event.PLAY, PlayMessage(**json.loads(body)) if body else None)
-        elif opcode == OpCode.PAUSE:
-            self.__emit(Event.PAUSE)
-        elif opcode == OpCode.RESUME:
-            self.__emit(Event.RESUME)
-        elif opcode == OpCode.STOP:
-            self.__emit(Event.STOP)
-        elif opcode == OpCode.SEEK:
-            self.__emit(Event.SEEK, SeekMessage(**json.loads(body)) if body else None)
-        elif opcode == OpCode.SET_VOLUME:
-            self.__emit(Event.SET_VOLUME, SetVolumeMessage(**json.loads(body)) if body else None)
-        elif opcode == OpCode.SET_SPEED:
-            self.__emit(Event.SET_SPEED, SetSpeedMessage(**json.loads(body)) if body else None)
-        elif opcode == OpCode.PING:
-            self.__send(OpCode.PONG)
-        elif opcode == OpCode.VERSION:
-            client_version = VersionMessage(**json.loads(body)) if body else None
-            if client_version:
-                log(f"Client reported version: {client_version.version}, sending back our version {FCAST_VERSION}")
-                self.__send(OpCode.VERSION, VersionMessage(version=FCAST_VERSION))
-        else:
-            raise Exception("Unhandled opcode %s" % opcode)
+        for listener in self.__listeners.get(event, ()):
+            result = listener(self, body)
+            # Async listeners return a coroutine that must be scheduled
+            if isinstance(result, CoroutineType):
+                self.schedule(result)
+
+    def schedule(self, coroutine):
+        # Running it on a fresh loop would block the server thread until the listener completes
+        coroutine.close()
+        raise Exception("Async listener on a session without an event loop")
+
+    def __handle_packet(self, packet: memoryview):
+
+        if len(packet) < 1:
+            PARSE_ERRORS.inc()
+            raise Exception("Received empty packet")
+
+        # Every packet is charged, so that unknown opcodes cannot bypass the packet rate
+        if self.limiter and not self.limiter.admit_packet(self.last_activity):
+            if self.limiter.exceeded():
+                SESSIONS_DROPPED.inc()
+                raise Exception("Client exceeded its packet rate for too long")
+            return
+
+        handler = self.__opcode_handlers.get(packet[0])
+        if not handler:
+            # Ignored rather than fatal: cheap to skip, and newer senders may use opcodes we do not know
+            UNKNOWN_OPCODES.inc()
+            self.unknown_opcodes += 1
+            if self.unknown_opcodes == 1:
+                log("Ignoring packets with unknown opcode", opcode=packet[0])
+            return
+        PACKETS_RECEIVED[packet[0]].inc()
+        self.packet_handled = True
+
+        handler(self, bytes(packet[1:]) if len(packet) > 1 else None)
+
+    def __event_handler(event: Event, message_type: Optional[Type[FCastMessage]] = None): # type: ignore[misc]
+        def handle(self: 'FCastSession', body: Optional[bytes]):
+            self.__emit(event, decode_message(message_type, body))
+        return handle
+
+    def __handle_ping(self, body: Optional[bytes]):
+        self.__send(OpCode.PONG)
+
+    def __handle_pong(self, body: Optional[bytes]):
+        # Receiving it already refreshed last_activity
+        self.pong_received = True
+
+    def __handle_version(self, body: Optional[bytes]):
+        client_version = decode_message(VersionMessage, body)
+        if client_version:
+            log("Client reported its version", version=client_version.version, ours=FCAST_VERSION)
+            self.version = max(1, min(int(client_version.version), FCAST_VERSION))
+            if not self.version_sent:
+                self.send_version()
+            # Listeners send version specific greetings, e.g. INITIAL from version 3 on
+            self.__emit(Event.VERSION, self.version)
+
+    def __handle_subscribe(self, body: Optional[bytes]):
+        event_type = subscription_event_type(decode_message(SubscribeEventMessage, body))
+        if event_type is not None:
+            self.subscriptions.add(event_type)
+
+    def __handle_unsubscribe(self, body: Optional[bytes]):
+        event_type = subscription_event_type(decode_message(UnsubscribeEventMessage, body))
+        if event_type is not None:
+            self.subscriptions.discard(event_type)
+
+    # Opcode -> handler, looked up with the raw opcode byte
+    __opcode_handlers: Dict[int, Callable[['FCastSession', Optional[bytes]], None]] = {
+        OpCode.PLAY: __event_handler(Event.PLAY, PlayMessage),
+        OpCode.PAUSE: __event_handler(Event.PAUSE),
+        OpCode.RESUME: __event_handler(Event.RESUME),
+        OpCode.STOP: __event_handler(Event.STOP),
+        OpCode.SEEK: __event_handler(Event.SEEK, SeekMessage),
+        OpCode.SET_VOLUME: __event_handler(Event.SET_VOLUME, SetVolumeMessage),
+        OpCode.SET_SPEED: __event_handler(Event.SET_SPEED, SetSpeedMessage),
+        OpCode.PING: __handle_ping,
+        OpCode.PONG: __handle_pong,
+        OpCode.VERSION: __handle_version,
+        OpCode.INITIAL: __event_handler(Event.INITIAL, InitialSenderMessage),
+        OpCode.SET_PLAYLIST_ITEM: __event_handler(Event.SET_PLAYLIST_ITEM, SetPlaylistItemMessage),
+        OpCode.SUBSCRIBE_EVENT: __handle_subscribe,
+        OpCode.UNSUBSCRIBE_EVENT: __handle_unsubscribe,
+    }
+    del __event_handler
+
+def subscription_event_type(message: Optional[FCastMessage]) -> Optional[EventType]:
+    """EventType of a SUBSCRIBE_EVENT or UNSUBSCRIBE_EVENT message, None if it is missing or unknown"""
+    event = getattr(message, 'event', None)
+    value = event.get('type') if isinstance(event, dict) else None
+    if not isinstance(value, int) or isinstance(value, bool):
+        log("Ignoring event subscription with invalid type", type=value)
+        return None
+    try:
+        return EventType(value)
+    except ValueError:
+        log("Ignoring event subscription with unknown type", type=value)
+        return None
@@ -0,0 +1,52 @@
+from threading import Lock
+from typing import Dict, Iterator, Optional, Tuple
+
+from .FCastSession import FCastSession
+
+class SessionRegistry:
+    """
+    Set of connected sessions shared by the I/O loop and Kodi callbacks.
+    Adding and removing are O(1) under a lock. Readers iterate over an immutable
+    snapshot taken without locking; it is rebuilt at most once per change, on the
+    first read after it, so broadcasts never race with connections coming and going.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        # Insertion-ordered, used as an ordered set
+        self._sessions: Dict[FCastSession, None] = {}
+        self._snapshot: Optional[Tuple[FCastSession, ...]] = ()
+
+    def add(self, session: FCastSession) -> None:
+        with self._lock:
+            if session not in self._sessions:
+                self._sessions[session] = None
+                self._snapshot = None
+
+    def discard(self, session: FCastSession) -> None:
+        with self._lock:
+            if self._sessions.pop(session, False) is not False:
+                self._snapshot = None
+
+    def clear(self) -> None:
+        with self._lock:
+            self._sessions.clear()
+            self._snapshot = ()
+
+    def snapshot(self) -> Tuple[FCastSession, ...]:
+        snapshot = self._snapshot
+        if snapshot is None:
+            with self._lock:
+                if self._snapshot is None:
+                    self._snapshot = tuple(self._sessions)
+                snapshot = self._snapshot
+        return snapshot
+
+    def __contains__(self, session: FCastSession) -> bool:
+        return session in self._sessions
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def __iter__(self) -> Iterator[FCastSession]:
+        return iter(self.snapshot())
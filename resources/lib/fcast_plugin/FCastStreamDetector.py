@@ -0,0 +1,183 @@
+from collections import OrderedDict
+from enum import Enum
+import re
+from threading import Lock
+from typing import Callable, List, Optional
+from urllib.parse import urlsplit
+
+# Number of (host, URL pattern) results remembered
+DETECTOR_MEMO_MAX_ENTRIES = 256
+# Bytes of the body needed to recognize a playlist or manifest
+SNIFF_BYTES = 512
+
+class StreamType(str, Enum):
+    HLS = "hls"
+    DASH = "mpd"
+    SMOOTH = "ism"
+    PROGRESSIVE = "progressive"
+
+HLS_MIME_TYPES = ('application/x-mpegurl', 'application/vnd.apple.mpegurl', 'audio/mpegurl', 'audio/x-mpegurl')
+DASH_MIME_TYPES = ('application/dash+xml', 'application/xml+dash')
+SMOOTH_MIME_TYPES = ('application/vnd.ms-sstr+xml',)
+
+# Matched against the URL path, then against its query
+HLS_PATH_PATTERN = re.compile(r'\.m3u8?$|\(format=m3u8', re.IGNORECASE)
+HLS_QUERY_PATTERN = re.compile(r'(^|&)(format|type|manifest)=(m3u8|hls)\b', re.IGNORECASE)
+DASH_PATH_PATTERN = re.compile(r'\.mpd$|\(format=mpd', re.IGNORECASE)
+DASH_QUERY_PATTERN = re.compile(r'(^|&)(format|type|manifest)=(mpd|dash)\b', re.IGNORECASE)
+SMOOTH_PATH_PATTERN = re.compile(r'\.isml?/manifest$', re.IGNORECASE)
+# Path parts that vary between URLs of the same service: numbers and long ids
+URL_PATTERN_VARIABLE = re.compile(r'[0-9a-f]{8,}|\d+', re.IGNORECASE)
+
+# Manifests may start with a byte order mark or whitespace
+HLS_SIGNATURE = re.compile(rb'^(\xef\xbb\xbf)?\s*#EXTM3U')
+DASH_SIGNATURE = re.compile(rb'^(\xef\xbb\xbf)?\s*(<\?xml[^>]*>\s*)?(<!--.*?-->\s*)*<MPD[\s>]', re.DOTALL)
+SMOOTH_SIGNATURE = re.compile(rb'^(\xef\xbb\xbf)?\s*(<\?xml[^>]*>\s*)?<SmoothStreamingMedia[\s>]')
+
+class Detection:
+    __slots__ = ('stream_type', 'mime_type', 'source')
+
+    def __init__(self, stream_type: StreamType, mime_type: Optional[str] = None, source: str = ''):
+        self.stream_type = stream_type
+        self.mime_type = mime_type
+        # Which detector decided, for logging
+        self.source = source
+
+    @property
+    def adaptive(self) -> bool:
+        return self.stream_type != StreamType.PROGRESSIVE
+
+class StreamContext:
+    """What is known about a play request when detecting its stream type"""
+    __slots__ = ('container', 'url', 'content', 'head', 'mime_type')
+
+    def __init__(self,
+        container: Optional[str] = None,
+        url: Optional[str] = None,
+        content: Optional[str] = None,
+        head: Optional[bytes] = None,
+        mime_type: Optional[str] = None
+    ):
+        self.container = normalize_mime_type(container)
+        self.url = url
+        self.content = content
+        # First bytes of the response body, if the URL was fetched
+        self.head = head
+        # Content-Type of the response, if the URL was fetched
+        self.mime_type = normalize_mime_type(mime_type)
+
+Detector = Callable[[StreamContext], Optional[Detection]]
+
+def normalize_mime_type(mime_type: Optional[str]) -> str:
+    return mime_type.split(';', 1)[0].strip().lower() if mime_type else ''
+
+def url_pattern(url: str) -> str:
+    """host/path with variable parts replaced, so URLs of one service share an entry"""
+    parts = urlsplit(url)
+    return parts.netloc.lower() + URL_PATTERN_VARIABLE.sub('#', parts.path)
+
+def from_mime_type(mime_type: str, source: str) -> Optional[Detection]:
+    if mime_type in HLS_MIME_TYPES:
+        return Detection(StreamType.HLS, 'application/x-mpegURL', source)
+    if mime_type in DASH_MIME_TYPES:
+        return Detection(StreamType.DASH, 'application/dash+xml', source)
+    if mime_type in SMOOTH_MIME_TYPES:
+        return Detection(StreamType.SMOOTH, mime_type, source)
+    if mime_type.startswith(('video/', 'audio/')):
+        return Detection(StreamType.PROGRESSIVE, mime_type, source)
+    return None
+
+def from_bytes(head: bytes, source: str) -> Optional[Detection]:
+    head = head[:SNIFF_BYTES]
+    if HLS_SIGNATURE.match(head):
+        return Detection(StreamType.HLS, 'application/x-mpegURL', source)
+    if DASH_SIGNATURE.match(head):
+        return Detection(StreamType.DASH, 'application/dash+xml', source)
+    if SMOOTH_SIGNATURE.match(head):
+        return Detection(StreamType.SMOOTH, 'application/vnd.ms-sstr+xml', source)
+    return None
+
+def detect_container(context: StreamContext) -> Optional[Detection]:
+    return from_mime_type(context.container, 'container')
+
+def detect_url(context: StreamContext) -> Optional[Detection]:
+    if not context.url:
+        return None
+    parts = urlsplit(context.url)
+    if HLS_PATH_PATTERN.search(parts.path) or HLS_QUERY_PATTERN.search(parts.query):
+        return Detection(StreamType.HLS, 'application/x-mpegURL', 'url')
+    if DASH_PATH_PATTERN.search(parts.path) or DASH_QUERY_PATTERN.search(parts.query):
+        return Detection(StreamType.DASH, 'application/dash+xml', 'url')
+    if SMOOTH_PATH_PATTERN.search(parts.path):
+        return Detection(StreamType.SMOOTH, 'application/vnd.ms-sstr+xml', 'url')
+    return None
+
+def detect_content(context: StreamContext) -> Optional[Detection]:
+    if context.content:
+        return from_bytes(context.content[:SNIFF_BYTES].encode('utf-8', 'replace'), 'content')
+    if context.head:
+        return from_bytes(context.head, 'sniff')
+    return None
+
+def detect_response(context: StreamContext) -> Optional[Detection]:
+    return from_mime_type(context.mime_type, 'response')
+
+class StreamDetector:
+    """
+    Decides how Kodi should open a play request. Detectors run in order until one
+    recognizes the stream; cheap ones (URL patterns, container MIME) come first,
+    then ones needing the first bytes of the body or the response's MIME type.
+
+    What the body and the response revealed is remembered per host and URL
+    pattern, so later URLs of the same service skip fetching anything.
+    """
+
+    def __init__(self, detectors: Optional[List[Detector]] = None, memo_size: int = DETECTOR_MEMO_MAX_ENTRIES):
+        # Cheap detectors need nothing but the play request
+        self.detectors: List[Detector] = detectors if detectors is not None else [detect_url, detect_container]
+        # Detectors looking at fetched data, their results are memoized
+        self.fetch_detectors: List[Detector] = [detect_content, detect_response]
+        self.memo_size = memo_size
+        self.memo_hits = 0
+        self._lock = Lock()
+        self._memo: 'OrderedDict[str, Detection]' = OrderedDict()
+
+    def register(self, detector: Detector, fetched: bool = False, first: bool = False):
+        detectors = self.fetch_detectors if fetched else self.detectors
+        detectors.insert(0 if first else len(detectors), detector)
+
+    def detect(self, context: StreamContext) -> Optional[Detection]:
+        """Detect from what the play request carries, None if the URL has to be fetched"""
+        for detector in self.detectors:
+            detection = detector(context)
+            if detection:
+                return detection
+
+        if context.content:
+            return self.detect_fetched(context)
+
+        if context.url:
+            with self._lock:
+                detection = self._memo.get(url_pattern(context.url))
+                if detection:
+                    self.memo_hits += 1
+                    return Detection(detection.stream_type, detection.mime_type, 'memo')
+        return None
+
+    def detect_fetched(self, context: StreamContext) -> Optional[Detection]:
+        """Detect from the first bytes of the body and the response's MIME type"""
+        for detector in self.fetch_detectors:
+            detection = detector(context)
+            if detection:
+                if context.url:
+                    self.__remember(context.url, detection)
+                return detection
+        return None
+
+    def __remember(self, url: str, detection: Detection):
+        with self._lock:
+            key = url_pattern(url)
+            self._memo[key] = detection
+            self._memo.move_to_end(key)
+            while len(self._memo) > self.memo_size:
+                self._memo.popitem(last=False)
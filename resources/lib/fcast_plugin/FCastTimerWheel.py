@@ -0,0 +1,90 @@
+import time
+from typing import Any, Callable, Dict, Hashable, List, Optional
+
+TimerCallback = Callable[[Any], None]
+
+class TimerEntry:
+    __slots__ = ('key', 'callback', 'slot', 'rounds')
+
+    def __init__(self, key: Hashable, callback: TimerCallback, slot: int, rounds: int):
+        self.key = key
+        self.callback = callback
+        self.slot = slot
+        # Full turns of the wheel left before the entry expires
+        self.rounds = rounds
+
+class TimerWheel:
+    """
+    Hashed timer wheel driven by the I/O loop that owns it (not thread-safe).
+    Timers are keyed, so each key has at most one pending timer: scheduling
+    again replaces it, and cancel() is O(1). Expiry has a resolution of one tick,
+    which is plenty for idle deadlines measured in seconds.
+    """
+
+    def __init__(self, tick: float = 1.0, slots: int = 64):
+        self.tick = tick
+        self.slots: List[Dict[Hashable, TimerEntry]] = [{} for _ in range(slots)]
+        self.entries: Dict[Hashable, TimerEntry] = {}
+        self.position = 0
+        self.next_tick = time.monotonic() + tick
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def schedule(self, key: Hashable, delay: float, callback: TimerCallback):
+        """Call callback(key) once `delay` seconds have passed, replacing any timer of `key`"""
+        self.cancel(key)
+        # Entries never fire early: round up and skip the slot currently being processed
+        ticks = max(int(-(-delay // self.tick)), 1)
+        rounds, offset = divmod(ticks - 1, len(self.slots))
+        slot = (self.position + 1 + offset) % len(self.slots)
+        entry = TimerEntry(key, callback, slot, rounds)
+        self.slots[slot][key] = entry
+        self.entries[key] = entry
+
+    def cancel(self, key: Hashable):
+        entry = self.entries.pop(key, None)
+        if entry:
+            del self.slots[entry.slot][key]
+
+    def clear(self):
+        for slot in self.slots:
+            slot.clear()
+        self.entries.clear()
+
+    def timeout(self, now: Optional[float] = None) -> Optional[float]:
+        """Seconds until the next tick is due, None when no timer is pending"""
+        if not self.entries:
+            return None
+        return max(self.next_tick - (time.monotonic() if now is None else now), 0)
+
+    def advance(self, now: Optional[float] = None) -> int:
+        """Process every tick that elapsed, return the number of expired timers"""
+        now = time.monotonic() if now is None else now
+        if not self.entries:
+            # Nothing to expire, don't walk idle ticks
+            self.next_tick = now + self.tick
+            return 0
+
+        expired = 0
+        while now >= self.next_tick:
+            self.next_tick += self.tick
+            self.position = (self.position + 1) % len(self.slots)
+            slot = self.slots[self.position]
+            due = []
+            for entry in slot.values():
+                if entry.rounds > 0:
+                    entry.rounds -= 1
+                else:
+                    due.append(entry)
+            for entry in due:
+                del slot[entry.key]
+                del self.entries[entry.key]
+            # Callbacks may schedule or cancel timers, so they run once the slot is settled
+            for entry in due:
+                expired += 1
+                entry.callback(entry.key)
+            if not self.entries:
+                self.next_tick = now + self.tick
+                break
+        return expired
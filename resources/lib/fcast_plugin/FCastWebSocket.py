@@ -0,0 +1,255 @@
+from base64 import b64encode
+from enum import Enum
+from hashlib import sha1
+import struct
+from threading import Lock
+import time
+from typing import List, Optional, Tuple
+
+from .FCastCodec import LENGTH_BYTES
+from .FCastSession import MAXIMUM_PACKET_LENGTH, OUTBOUND_QUEUE_MAX_PACKETS, FCastSession
+from .util import log
+
+WEBSOCKET_GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+# Upper bound on the size of the opening HTTP request
+WEBSOCKET_MAX_HANDSHAKE_BYTES = 8192
+# Seconds a client has to complete the upgrade before it is closed
+WEBSOCKET_HANDSHAKE_TIMEOUT = 10.0
+# A message carries one FCast packet, length header included
+WEBSOCKET_MAX_MESSAGE_LENGTH = MAXIMUM_PACKET_LENGTH + LENGTH_BYTES
+
+class WebSocketOpCode(int, Enum):
+    CONTINUATION = 0x0
+    TEXT = 0x1
+    BINARY = 0x2
+    CLOSE = 0x8
+    PING = 0x9
+    PONG = 0xA
+
+class WebSocketError(Exception):
+    """Protocol violation by the client, the connection is closed with `status`"""
+
+    def __init__(self, message: str, status: int = 1002):
+        super().__init__(message)
+        self.status = status
+
+def accept_key(key: bytes) -> bytes:
+    return b64encode(sha1(key.strip() + WEBSOCKET_GUID).digest())
+
+def unmask(payload, mask) -> bytes:
+    """
+    XOR a client payload with its 4 byte masking key. The payload and the repeated
+    key are each read as one big integer, so the work is done in C instead of a
+    Python loop over the bytes.
+    """
+    length = len(payload)
+    if not length:
+        return b''
+    key = (bytes(mask) * (length // 4 + 1))[:length]
+    return (int.from_bytes(payload, 'little') ^ int.from_bytes(key, 'little')).to_bytes(length, 'little')
+
+def encode_frame(opcode: WebSocketOpCode, payload: bytes = b'') -> bytes:
+    """Single unfragmented frame, servers never mask"""
+    length = len(payload)
+    if length < 126:
+        header = struct.pack('!BB', 0x80 | opcode, length)
+    elif length < 0x10000:
+        header = struct.pack('!BBH', 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack('!BBQ', 0x80 | opcode, 127, length)
+    return header + payload
+
+class FCastWebSocketSession(FCastSession):
+    """
+    FCastSession speaking RFC 6455: after the HTTP upgrade, every WebSocket message
+    carries one FCast packet in the same binary format as on the TCP port. Messages
+    are fed to the regular packet parser and outgoing packets are wrapped in binary
+    frames, so handlers and broadcasts work unchanged.
+    """
+
+    def __init__(self, client):
+        super().__init__(client)
+        self.upgraded = False
+        self.closing = False
+        self.opened_at = time.monotonic()
+        # Incomplete frame, and the fragments of a message still being received
+        self._frame_buffer = bytearray()
+        self._fragments: Optional[bytearray] = None
+        # Output queued before the upgrade completed, e.g. the snapshot sent on connect
+        self._held: Optional[List[Tuple[bytes, bool]]] = []
+        self._held_lock = Lock()
+
+    def _frame(self, packet: bytes) -> bytes:
+        return encode_frame(WebSocketOpCode.BINARY, packet)
+
+    def _enqueue(self, packet: bytes, coalesce: bool = False):
+        if self.closing:
+            # Nothing may follow our close frame
+            self.dropped += 1
+            return
+        with self._held_lock:
+            held = self._held is not None
+            evicting = held and not self.evicted and len(self._held) >= OUTBOUND_QUEUE_MAX_PACKETS
+            if held and not self.evicted and not evicting:
+                self._held.append((packet, coalesce))
+                return
+            if evicting:
+                self.evicted = True
+                self.dropped += len(self._held)
+                self._held.clear()
+        if not held:
+            super()._enqueue(packet, coalesce)
+            return
+        # Nothing is queued once evicted, the I/O loop closes the connection
+        self.dropped += 1
+        if evicting:
+            log("WebSocket client is not completing its upgrade, evicting it")
+            if self.wakeup:
+                self.wakeup(self)
+
+    def check_liveness(self, now: float, ping_interval: float, idle_timeout: float) -> Optional[float]:
+        if self.upgraded:
+            return super().check_liveness(now, ping_interval, idle_timeout)
+        # No PING can be sent before the upgrade, a client that does not complete it in time is closed
+        remaining = self.opened_at + WEBSOCKET_HANDSHAKE_TIMEOUT - now
+        return remaining if remaining > 0 else None
+
+    def _parse_packets(self, data: memoryview):
+        if self.closing:
+            return
+        if self._frame_buffer or not self.upgraded:
+            self._frame_buffer += data
+            data = memoryview(bytes(self._frame_buffer))
+            del self._frame_buffer[:]
+
+        try:
+            offset = 0 if self.upgraded else self.__read_handshake(data)
+            if offset is None:
+                return
+            offset = self.__read_frames(data, offset)
+        except WebSocketError as e:
+            self.__fail(e)
+            raise
+        if offset < len(data) and not self.closing:
+            self._frame_buffer += data[offset:]
+
+    def __read_handshake(self, data: memoryview) -> Optional[int]:
+        """Answer the upgrade request, return the offset of the first frame"""
+        end = bytes(data).find(b'\r\n\r\n')
+        if end < 0:
+            if len(data) > WEBSOCKET_MAX_HANDSHAKE_BYTES:
+                raise WebSocketError("Handshake request too large")
+            self._frame_buffer += data
+            return None
+
+        lines = bytes(data[:end]).split(b'\r\n')
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(b':')
+            headers[name.strip().lower()] = value.strip()
+
+        key = headers.get(b'sec-websocket-key')
+        if not lines[0].startswith(b'GET ') or b'websocket' not in headers.get(b'upgrade', b'').lower() or not key:
+            self.__respond(b'HTTP/1.1 400 Bad Request\r\nConnection: close\r\nContent-Length: 0\r\n\r\n')
+            raise WebSocketError("Not a WebSocket upgrade request")
+        if headers.get(b'sec-websocket-version') != b'13':
+            self.__respond(b'HTTP/1.1 426 Upgrade Required\r\nSec-WebSocket-Version: 13\r\nContent-Length: 0\r\n\r\n')
+            raise WebSocketError("Unsupported WebSocket version")
+
+        self.__respond(
+            b'HTTP/1.1 101 Switching Protocols\r\n'
+            b'Upgrade: websocket\r\n'
+            b'Connection: Upgrade\r\n'
+            b'Sec-WebSocket-Accept: ' + accept_key(key) + b'\r\n\r\n'
+        )
+        # Release what was sent to this session while the upgrade was pending
+        with self._held_lock:
+            for packet, coalesce in self._held or ():
+                super()._enqueue(packet, coalesce)
+            self._held = None
+        self.upgraded = True
+        return end + 4
+
+    def __read_frames(self, data: memoryview, offset: int) -> int:
+        """Handle every complete frame, return the offset of the first incomplete one"""
+        size = len(data)
+        while size - offset >= 2 and not self.closing:
+            first, second = data[offset], data[offset + 1]
+            length = second & 0x7F
+            header = 2
+            if length == 126:
+                if size - offset < 4:
+                    break
+                length = struct.unpack_from('!H', data, offset + 2)[0]
+                header = 4
+            elif length == 127:
+                if size - offset < 10:
+                    break
+                length = struct.unpack_from('!Q', data, offset + 2)[0]
+                header = 10
+
+            if first & 0x70:
+                raise WebSocketError("Reserved bits set without a negotiated extension")
+            if not second & 0x80:
+                raise WebSocketError("Client frame is not masked")
+            if length > WEBSOCKET_MAX_MESSAGE_LENGTH:
+                raise WebSocketError("Frame of %d bytes exceeds the maximum message length" % length, 1009)
+
+            end = offset + header + 4 + length
+            if end > size:
+                break
+            mask = data[offset + header:offset + header + 4]
+            payload = unmask(data[offset + header + 4:end], mask)
+            offset = end
+            self.__handle_frame(bool(first & 0x80), first & 0x0F, payload)
+        return offset
+
+    def __handle_frame(self, fin: bool, opcode: int, payload: bytes):
+        if fin and opcode == WebSocketOpCode.BINARY and self._fragments is None:
+            # Common case: one unfragmented message carrying one packet
+            super()._parse_packets(memoryview(payload))
+            return
+
+        if opcode >= WebSocketOpCode.CLOSE:
+            if not fin or len(payload) > 125:
+                raise WebSocketError("Invalid control frame")
+            if opcode == WebSocketOpCode.PING:
+                super()._enqueue(encode_frame(WebSocketOpCode.PONG, payload))
+            elif opcode == WebSocketOpCode.CLOSE:
+                # Echo the status code, the client closes the TCP connection afterwards
+                self.closing = True
+                super()._enqueue(encode_frame(WebSocketOpCode.CLOSE, payload[:2]))
+            elif opcode != WebSocketOpCode.PONG:
+                raise WebSocketError("Unknown control opcode %d" % opcode)
+            return
+
+        if opcode == WebSocketOpCode.CONTINUATION:
+            if self._fragments is None:
+                raise WebSocketError("Continuation frame without a message")
+            if len(self._fragments) + len(payload) > WEBSOCKET_MAX_MESSAGE_LENGTH:
+                raise WebSocketError("Fragmented message exceeds the maximum message length", 1009)
+            self._fragments += payload
+            if fin:
+                message, self._fragments = self._fragments, None
+                super()._parse_packets(memoryview(message))
+        elif opcode in (WebSocketOpCode.BINARY, WebSocketOpCode.TEXT):
+            if self._fragments is not None:
+                raise WebSocketError("New message before the fragmented one ended")
+            if fin:
+                super()._parse_packets(memoryview(payload))
+            else:
+                self._fragments = bytearray(payload)
+        else:
+            raise WebSocketError("Unknown data opcode %d" % opcode)
+
+    def __respond(self, response: bytes):
+        # The HTTP response goes out ahead of any held frame
+        super()._enqueue(response)
+
+    def __fail(self, error: WebSocketError):
+        log("Closing WebSocket client after a protocol error", error=error)
+        if self.upgraded and not self.closing:
+            self.closing = True
+            super()._enqueue(encode_frame(WebSocketOpCode.CLOSE, struct.pack('!H', error.status)))
+        # Try to get the response out before the server closes the socket
+        self.flush()
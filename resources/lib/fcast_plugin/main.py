@@ -1,271 +1,656 @@
 import sys
-import socket
-from threading import Thread
-from typing import List, Optional
+from threading import Lock
+from typing import Callable, Optional, Tuple, TYPE_CHECKING
+import xbmcaddon
 import xbmcgui
 import xbmc
-import selectors
 from urllib.parse import urlparse
-from pathlib import Path
 
+from .FCastAdmission import AdmissionControl
+from .FCastCodec import encode_packet, json_loads
+from .FCastSelectorServer import FCastSelectorServer
 from .FCastSession import Event, FCastSession
+from .FCastSessionRegistry import SessionRegistry
 from .FCastPackets import *
-from .FCastHTTPServer import FCastHTTPServer
-from .player import FCastPlayer
-from .util import log, notify, debounce
+from .FCastMetrics import metrics
+from .FCastStreamDetector import Detection, StreamContext, StreamDetector, StreamType, normalize_mime_type
+from .player import FCastMonitor, FCastPlayer
+from .util import Coalescer, DaemonExecutor, Deadline, log, notify, writer
 
-session_threads: List[Thread] = []
-sessions: List[FCastSession] = []
+# Subsystems that are only needed for some play requests are imported when first used
+if TYPE_CHECKING:
+    from concurrent.futures import Future
+    from .FCastControlChannel import ControlChannel
+    from .FCastHTTPServer import FCastHTTPServer
+    from .FCastResolver import MediaResolver, Resolution
+
+sessions = SessionRegistry()
 
 # Constants
 FCAST_HOST = ''
 FCAST_PORT = 46899
+# Browser and desktop senders connect over WebSocket, set to 0 to disable the listener
+FCAST_WEBSOCKET_PORT = 46898
+# Clients that send nothing for FCAST_TIMEOUT milliseconds are disconnected.
+# Silent clients are pinged every FCAST_PING_INTERVAL seconds so that live ones answer in time
 FCAST_TIMEOUT = 60 * 1000
+FCAST_PING_INTERVAL = 20
 FCAST_BUFFER_SIZE = 32000
+# Upper bound on how long the event loop sleeps. Kodi's abort request wakes it right away,
+# this is only a fallback
+FCAST_SELECT_TIMEOUT = 5.0
+# Serve clients from the asyncio transport instead of the selector loop
+FCAST_USE_ASYNCIO = False
+# Longest wait for a media URL to be pre-resolved before playback starts without it
+FCAST_RESOLVE_TIMEOUT = 3
+# Minimum interval between two seeks, and whether the first/last seek of a burst is applied
+FCAST_SEEK_INTERVAL = 0.15
+FCAST_SEEK_LEADING = True
+FCAST_SEEK_TRAILING = True
+# Connections served at once in total and from one address (0 disables), loopback only counts in total
+FCAST_MAX_CONNECTIONS = 64
+FCAST_MAX_CONNECTIONS_PER_IP = 4
+# Packets and received bytes per second allowed to each client on average, and as a burst
+FCAST_PACKET_RATE = 100
+FCAST_PACKET_BURST = 200
+FCAST_BYTE_RATE = 256 * 1024
+FCAST_BYTE_BURST = 512 * 1024
+# Seconds an address is refused after one of its clients was dropped for flooding
+FCAST_FLOOD_PENALTY = 10.0
+# File recording the traffic of every session for benchmarks/replay.py, None to disable.
+# Rotated at FCastRecorder.RECORDING_MAX_BYTES
+FCAST_RECORDING_PATH: Optional[str] = None
+# Serve Prometheus metrics on http://<receiver>:FCAST_METRICS_PORT/metrics. The HTTP server, which
+# otherwise starts on an ephemeral port on the first play request needing it, then starts with the
+# receiver on this port, and also serves manifests and proxied streams
+FCAST_METRICS_ENABLED = False
+FCAST_METRICS_PORT = 46897
+# Seconds Kodi waits at most for the service to stop once it requested it
+FCAST_SHUTDOWN_TIMEOUT = 3.0
 
 plugin_handle = int(sys.argv[1]) if len(sys.argv) > 1 else None
 
-player_thread: Optional[Thread] = None
-
-# HTTP Server to stream manifest files
-http_server: Optional[FCastHTTPServer] = None
+# HTTP Server to stream manifest files, started by get_http_server() on first need
+http_server: Optional['FCastHTTPServer'] = None
 
 # Player needs to be a global so it stays in scope and doesn't get GC'd
 player: Optional[FCastPlayer] = None
 
-# Used to queue up seeks
-seeks: list[float] = []
+# Resolves media URLs (redirects, MIME type) in parallel to stopping the previous item, see get_resolver()
+resolver: Optional['MediaResolver'] = None
 
-def check_player():
-    global player
-    log("Starting player thread")
-    monitor = xbmc.Monitor()
-    while not monitor.abortRequested():
-        if player and player.isPlaying():
-            # Update the current time if it has changed
-            if int(player.getTime()) != player.prev_time:
-                player.onPlayBackTimeChanged()        
-        
-        if monitor.waitForAbort(0.05):
-            break
-    log("Exiting player thread")
+# Connection caps and per-client rate limits, shared by every listening port
+admission = AdmissionControl(
+    max_connections=FCAST_MAX_CONNECTIONS,
+    max_connections_per_ip=FCAST_MAX_CONNECTIONS_PER_IP,
+    penalty=FCAST_FLOOD_PENALTY,
+    packet_rate=FCAST_PACKET_RATE,
+    packet_burst=FCAST_PACKET_BURST,
+    byte_rate=FCAST_BYTE_RATE,
+    byte_burst=FCAST_BYTE_BURST,
+)
+
+# Guards the lazy creation of subsystems
+subsystem_lock = Lock()
+
+# Play requests are prepared (URL resolution, stopping the previous item) off the I/O loop,
+# one at a time. Each request or STOP increments the generation, superseding older requests
+play_executor: Optional[DaemonExecutor] = None
+play_generation = 0
+metrics_registered = False
+
+# Decides how Kodi opens a play request (HLS, DASH, progressive ...)
+stream_detector = StreamDetector()
+
+# Coalesces seek requests so that player.seekTime is called with a low frequency. This prevents Kodi from freezing
+seek_coalescer: Optional[Coalescer] = None
+
+# Sends volume and speed changes to Kodi as coalesced, batched JSON-RPC calls, see get_control()
+control: Optional['ControlChannel'] = None
+
+# A request being prepared: its stream context, URL, detection and pending resolution
+PendingMedia = Tuple[StreamContext, str, Optional[Detection], Optional['Future']]
 
 def handle_play(session: FCastSession, message = None):
-    log(f"Client request play")
-    play_item: Optional[xbmcgui.ListItem] = None
-    url: str = ""
+    log("Client request play")
 
     if not message:
         return
+    submit_play(start_play, message)
+
+def submit_play(job: Callable[..., None], *args):
+    """Run `job(generation, *args)` on the play worker, superseding requests not started yet"""
+    global play_executor, play_generation
+    with subsystem_lock:
+        play_generation += 1
+        if not play_executor:
+            play_executor = DaemonExecutor(max_workers=1, thread_name_prefix='fcast-play')
+        executor, generation = play_executor, play_generation
+    try:
+        executor.submit(run_play, job, generation, *args)
+    except RuntimeError:
+        # Shutting down
+        pass
+
+def run_play(job: Callable[..., None], generation: int, *args):
+    if not is_current_play(generation):
+        return
+    try:
+        job(generation, *args)
+    except Exception as e:
+        log("Play request failed", xbmc.LOGERROR, error=e)
+
+def is_current_play(generation: int) -> bool:
+    return generation == play_generation
+
+def cancel_play():
+    """Keep a play request still being prepared from starting"""
+    global play_generation
+    with subsystem_lock:
+        play_generation += 1
+
+def start_play(generation: int, message: PlayMessage):
+    if message.container == PLAYLIST_CONTAINER and message.content:
+        play_playlist(generation, message)
+        return
+
+    if player:
+        player.mark_play_requested()
+
+    pending = begin_prepare(message.container, message.url, message.content, message.headers)
+    if not player or not pending:
+        return
 
-    if message.url:
-        url = message.url
-        parsed_url = urlparse(url)
+    notify('Starting player ...', key='play')
+    if player.isPlaying():
+        player.stop()
 
-        play_item = xbmcgui.ListItem(path=url)
+    url, play_item = finish_prepare(pending, message.headers, message.time)
+    if not is_current_play(generation):
+        return
+    if message.volume is not None:
+        set_volume(message.volume)
+    player.set_play_data(message)
+    player.play(item=url, listitem=play_item)
 
-        # Detect HLS stream
-        if Path(parsed_url.path).suffix == '.m3u8':
-            log('Detected HLS stream in URL')
-            # Use inputstream adaptive to handle HLS stream
-            play_item.setContentLookup(False)
-            play_item.setMimeType('application/x-mpegURL')
-            play_item.setProperty('inputstream', 'inputstream.adaptive')
-            play_item.setProperty('inputstream.adaptive.manifest_type', 'hls')
+def play_playlist(generation: int, message: PlayMessage, index: Optional[int] = None):
+    """Play a version 3 playlist, or restart the current one from `index`"""
+    global player
+    if not player:
+        return
+
+    if index is None:
+        try:
+            content = PlaylistContent.from_wire(json_loads(message.content))
+        except Exception as e:
+            log("Invalid playlist", xbmc.LOGERROR, error=e)
+            notify('Invalid playlist', xbmcgui.NOTIFICATION_ERROR, key='invalid-playlist')
+            return
+        from .FCastPlaylist import Playlist
+        playlist = Playlist(content, prepare_item, xbmc.PlayList(xbmc.PLAYLIST_VIDEO))
+    else:
+        playlist = player.playlist
+    item = playlist.item(index) if playlist else None
+    if not playlist or not item:
+        return
+
+    log("Playing playlist", items=len(playlist), index=playlist.index if index is None else index)
+    player.mark_play_requested()
+    pending = begin_prepare(item.container, item.url, item.content, item.headers)
+    if not pending:
+        return
+
+    notify('Starting player ...', key='play')
+    if player.isPlaying():
+        player.stop()
+
+    prepared = finish_prepare(pending, item.headers, item.time)
+    if not is_current_play(generation):
+        return
+    playlist.restart(playlist.index if index is None else index)
+    playlist.queue(playlist.index, *prepared)
+    player.set_play_data(message, playlist)
+    player.play(item=playlist.kodi_playlist)
+
+def prepare_item(item: MediaItem) -> Optional[Tuple[str, xbmcgui.ListItem]]:
+    """Make a playlist item playable ahead of time, its manifest is fetched before Kodi asks for it"""
+    pending = begin_prepare(item.container, item.url, item.content, item.headers)
+    if not pending:
+        return None
+    url, play_item = finish_prepare(pending, item.headers, item.time)
+    if http_server and url.startswith(http_server.get_base_url()):
+        http_server.preload(url)
+    return url, play_item
+
+def begin_prepare(container: str, url: Optional[str], content: Optional[str], headers = None) -> Optional[PendingMedia]:
+    """Detect the stream type and start resolving the URL, which overlaps with stopping the previous item"""
+    resolution: Optional['Future'] = None
+    context = StreamContext(container, url=url, content=None if url else content)
+    detection = stream_detector.detect(context)
+
+    if url:
+        # Follow redirects and read the MIME type, or sniff the stream format, while the previous item stops
+        if is_http_url(url) and (not detection or not detection.adaptive):
+            resolution = get_resolver().resolve_async(url, headers, sniff=not detection)
+
+    elif content:
+        if not detection or not detection.adaptive:
+            notify(f'Unhandled content container {container}', key='container')
+            return None
+        # Each play request gets its own URL, so a new manifest never replaces one Kodi is still fetching
+        url = get_http_server().proxy_content(detection.mime_type, content, headers)
+
+    if not url:
+        return None
+    return context, url, detection, resolution
+
+def finish_prepare(pending: PendingMedia, headers = None, start_time: Optional[float] = None) -> Tuple[str, xbmcgui.ListItem]:
+    context, url, detection, resolution = pending
+    if resolution:
+        url, detection = apply_resolution(context, url, resolution, detection)
+
+    # Serve playlists and manifests through the local caching proxy, which forwards the sender's headers
+    if context.url and detection and detection.stream_type in (StreamType.HLS, StreamType.DASH) and is_http_url(url):
+        url = get_http_server().proxy_url(url, headers)
+
+    play_item = create_play_item(url, detection)
+    if start_time:
+        play_item.setProperty('StartOffset', str(float(start_time)))
+    return url, play_item
+
+def get_http_server() -> 'FCastHTTPServer':
+    global http_server
+    with subsystem_lock:
+        if not http_server:
+            from .FCastHTTPServer import FCastHTTPServer, METRICS_PATH
+            if FCAST_METRICS_ENABLED:
+                try:
+                    http_server = FCastHTTPServer(port=FCAST_METRICS_PORT)
+                except OSError as e:
+                    # Manifests and proxied streams work on any port, only scraping needs this one
+                    log("Cannot listen on the metrics port", xbmc.LOGERROR, port=FCAST_METRICS_PORT, error=e)
+            if not http_server:
+                http_server = FCastHTTPServer()
+            http_server.start()
+            log("HTTP server listening", xbmc.LOGINFO, port=http_server.get_port(), metrics=http_server.get_base_url() + METRICS_PATH)
+        return http_server
+
+def get_control() -> 'ControlChannel':
+    global control
+    with subsystem_lock:
+        if not control:
+            from .FCastControlChannel import ControlChannel
+            control = ControlChannel()
+        return control
+
+def get_resolver() -> 'MediaResolver':
+    global resolver
+    with subsystem_lock:
+        if not resolver:
+            from .FCastResolver import MediaResolver
+            resolver = MediaResolver()
+        return resolver
+
+def is_http_url(url: str) -> bool:
+    return urlparse(url).scheme in ('http', 'https')
+
+def create_play_item(url: str, detection: Optional[Detection]) -> xbmcgui.ListItem:
+    play_item = xbmcgui.ListItem(path=url)
+    if not detection:
+        log('Detected URL of unknown type')
+        play_item.setContentLookup(True)
+        return play_item
+
+    log("Detected stream", type=detection.stream_type.value, source=detection.source)
+    play_item.setContentLookup(False)
+    if detection.mime_type:
+        play_item.setMimeType(detection.mime_type)
+    if detection.adaptive:
+        # Basing this off what the YouTube addon does to enable adaptive streams
+        play_item.setProperty('inputstream', 'inputstream.adaptive')
+        play_item.setProperty('inputstream.adaptive.manifest_type', detection.stream_type.value)
+        if detection.stream_type == StreamType.HLS:
             play_item.setProperty('inputstream.adaptive.stream_selection_type', 'adaptive')
-        else:
-            log('Detected URL')
-            if message.container:
-                play_item.setContentLookup(False)
-                play_item.setMimeType(message.container)
-            else:
-                play_item.setContentLookup(True)
-
-    elif message.content:
-        if message.container in ['application/dash+xml', 'application/xml+dash']:
-            log('Detected DASH stream')
-
-            if http_server:
-                http_server.set_content(message.container, message.content)
-                url = f'http://{http_server.get_host()}:{http_server.get_port()}/manifest'
-
-                # Basing this off what the YouTube addon does to enable dash
-                play_item = xbmcgui.ListItem(path=url)
-                play_item.setContentLookup(False)
-                play_item.setMimeType(message.container)
-                play_item.setProperty('inputstream', 'inputstream.adaptive')
-                play_item.setProperty('inputstream.adaptive.manifest_type', 'mpd')
-        else:
-            notify(f'Unhandled content container {message.container}')
-
-    if player and play_item:
-        notify('Starting player ...')
-        play_item.setPath(url)
-        if player.isPlaying():
-            player.stop()
-        player.play(item=url, listitem=play_item)
-
-def do_seek():
-    global player, seeks
-
-    # we are only interested in the last consecutive seek, so we skip the first one if there are more than one
-    if len(seeks) > 1:
-        seeks.pop(0)
-    elif len(seeks) > 0:
-        # Last seek in the queue, seek to it
-        if player:
-            player.seekTime(seeks.pop(0))
+    return play_item
+
+def apply_resolution(
+    context: StreamContext,
+    url: str,
+    resolution: 'Future',
+    detection: Optional[Detection]
+) -> Tuple[str, Optional[Detection]]:
+    """Use the pre-resolved URL, and detect the stream type from the response if it is still unknown"""
+    try:
+        result: Optional['Resolution'] = resolution.result(timeout=FCAST_RESOLVE_TIMEOUT)
+    except Exception:
+        result = None
+
+    if not result or not result.ok:
+        return url, detection
+
+    log("Resolved URL", url=url, final_url=result.final_url, mime_type=result.mime_type, seconds=result.elapsed)
+    if player:
+        player.resolve_time = result.elapsed
+    if not detection:
+        context.head = result.head
+        context.mime_type = normalize_mime_type(result.mime_type)
+        detection = stream_detector.detect_fetched(context)
+    # Skip the redirect chain, Kodi opens the final location directly
+    return result.final_url, detection
+
+def do_seek(time: float):
+    global player
+    if player:
+        player.seekTime(time)
 
 def handle_seek(session: FCastSession, message = None):
-    global player, seeks
+    global player, seek_coalescer
 
-    if not message:
+    if not message or not isinstance(message.time, (int, float)):
         return
 
-    log(f"Client request seek to {message.time}")
-    # Send FCastMessage so the client's seek bar position updates better
-    session.send_playback_update(PlayBackUpdateMessage(
-        message.time,
-        PlayBackState.PAUSED if (player and player.is_paused) else PlayBackState.PLAYING,
-    ))
+    log("Client request seek", time=message.time)
+    if player:
+        # Move the extrapolated position right away and tell the client, so its seek bar
+        # does not jump back until Kodi reports the seek. Duration and speed stay as they are
+        player.state.update(position=float(message.time))
+        session.send_playback_update(player.state.playback_update())
 
-    # Append this seek to the seeks "queue"
-    seeks.append(float(message.time))
-    # Ensure that player.seekTime is called with a low frequency. This prevents Kodi from freezing
-    debounce(do_seek, 0.15)()
+    if seek_coalescer:
+        seek_coalescer.submit(float(message.time))
 
 def handle_stop(session: FCastPlayer, message = None):
     global player
-    log(f"Client request stop")
+    log("Client request stop")
+    cancel_play()
     if player:
         player.stop()
 
 def handle_pause(session: FCastPlayer, message = None):
     global player
-    log(f"Client request pause")
+    log("Client request pause")
     if player:
         player.doPause()
 
 def handle_resume(session: FCastPlayer, message = None):
     global player
-    log(f"Client request resume")
+    log("Client request resume")
     if player:
         player.doResume()
 
 def handle_volume(session: FCastSession, message: SetVolumeMessage):
-    global player
-    log(f"Client request set volume at {message.volume}")
-    volume_level = int(message.volume * 100)
-    xbmc.executebuiltin(f'SetVolume({volume_level})')
+    if not message or not isinstance(message.volume, (int, float)):
+        return
+    log("Client request set volume", volume=message.volume)
+    set_volume(message.volume)
 
-def handle_speed(session: FCastSession, message: SetSpeedMessage):
-    global player
-    log(f"Client request set speed at {message.speed}. Action currently not supported")
+def set_volume(volume: float):
+    # Kodi uses 0-100, FCast 0-1
+    get_control().call('Application.SetVolume', {'volume': round(min(max(volume, 0.0), 1.0) * 100)}, on_volume, key='volume')
 
-# Connection handler thread function
-def connection_handler(conn: socket.socket, addr):
-    global player, http_server
+def on_volume(result):
+    # Application.SetVolume returns the volume Kodi applied, GetProperties an object
+    volume = result.get('volume') if isinstance(result, dict) else result
+    if player and isinstance(volume, (int, float)):
+        player.onVolumeChanged(volume / 100)
 
-    monitor = xbmc.Monitor()
-    notify("Connection from %s" % addr[0])
+def handle_set_playlist_item(session: FCastSession, message: SetPlaylistItemMessage):
+    global player
+    if not message or not player or not player.playlist:
+        return
+    index = message.itemIndex
+    if not isinstance(index, int) or isinstance(index, bool):
+        log("Ignoring playlist item request with invalid index", index=index)
+        return
+    log("Client request playlist item", index=index)
+    position = player.playlist.position_of(index)
+    if position is not None:
+        # Already prepared and queued in Kodi's playlist
+        player.playselected(position)
+    elif player.playlist.item(index) and player.play_data:
+        submit_play(play_playlist, player.play_data, index)
+
+def handle_version(session: FCastSession, version: int):
+    if version < 3:
+        return
+    addon = xbmcaddon.Addon()
+    session.send_packet(encode_packet(OpCode.INITIAL, InitialReceiverMessage(
+        displayName=xbmc.getInfoLabel('System.FriendlyName') or None,
+        appName=addon.getAddonInfo('name'),
+        appVersion=addon.getAddonInfo('version'),
+        playData=player.play_data if player and player.is_active else None,
+    )))
+
+def handle_initial(session: FCastSession, message: InitialSenderMessage):
+    if message:
+        log("Sender identified", name=message.displayName, app=message.appName, app_version=message.appVersion)
 
-    session = FCastSession(conn)
+def handle_speed(session: FCastSession, message: SetSpeedMessage):
+    global player
+    if not message or not isinstance(message.speed, (int, float)):
+        return
+    from .FCastControlChannel import KODI_AUDIO_PLAYER_ID, KODI_VIDEO_PLAYER_ID, kodi_speed
+    speed = kodi_speed(message.speed)
+    log("Client request set speed", speed=message.speed, kodi_speed=speed)
+    if not player or not player.is_active:
+        return
+    player_id = KODI_AUDIO_PLAYER_ID if player.isPlayingAudio() else KODI_VIDEO_PLAYER_ID
+    get_control().call('Player.SetSpeed', {'playerid': player_id, 'speed': speed}, on_speed, key='speed')
+
+def on_speed(result):
+    if player and isinstance(result, dict) and isinstance(result.get('speed'), (int, float)):
+        player.onPlayBackSpeedChanged(result['speed'])
+
+def register_session_handlers(session: FCastSession, wrap: Optional[Callable] = None):
+    handlers = {
+        Event.PLAY: handle_play,
+        Event.STOP: handle_stop,
+        Event.PAUSE: handle_pause,
+        Event.RESUME: handle_resume,
+        Event.SEEK: handle_seek,
+        Event.SET_PLAYLIST_ITEM: handle_set_playlist_item,
+        Event.VERSION: handle_version,
+        Event.INITIAL: handle_initial,
+        Event.SET_VOLUME: handle_volume,
+        Event.SET_SPEED: handle_speed,
+    }
+    for event, handler in handlers.items():
+        session.on(event, wrap(handler) if wrap else handler)
+
+def open_session(session: FCastSession, addr):
+    global player
 
-    session.on(Event.PLAY, handle_play)
-    session.on(Event.STOP, handle_stop)
-    session.on(Event.PAUSE, handle_pause)
-    session.on(Event.RESUME, handle_resume)
-    session.on(Event.SEEK, handle_seek)
-    # TODO: Find out how to get/set volume
-    # session.on(Event.SET_VOLUME, handle_volume)
-    # TODO: Find out how to get/set playback speed
-    # session.on(Event.SET_SPEED, handle_speed)
+    notify("Connection from %s" % addr[0], key='connect', plural="%d devices connected")
+    session.send_version()
 
     # Allow Kodi to send playback update packets to this client
     if player:
         player.addSession(session)
+        player.send_snapshot(session)
+        if player.state.volume is None:
+            # Not known before the first change, ask Kodi so that senders get a VOLUME_UPDATE
+            get_control().call('Application.GetProperties', {'properties': ['volume']}, on_volume, key='volume-query')
 
-    # Receive data from the client and process it
-    while not monitor.abortRequested():
-        try:
-            buff = conn.recv(FCAST_BUFFER_SIZE)
-            if buff and len(buff) > 0:
-                session.process_bytes(buff)
-        except BlockingIOError:
-            # Normal behavior. Prevents blocking
-            pass
-        except Exception as e:
-            log(str(e), xbmc.LOGERROR)
-            break
-
-        if monitor.waitForAbort(0.05):
-            break
+def end_session(session: FCastSession, addr):
+    global player
 
     if player:
         player.removeSession(session)
     session.close()
-    notify("Connection closed from %s" % addr[0])
+    log("Session closed", address=addr[0], **session.queue_stats())
+    notify("Connection closed from %s" % addr[0], key='disconnect', plural="%d devices disconnected")
+
+# Serve FCast clients from a single-threaded selector loop
+def serve_selector(monitor: xbmc.Monitor):
+    server = FCastSelectorServer(
+        FCAST_HOST,
+        FCAST_PORT,
+        on_disconnect=end_session,
+        buffer_size=FCAST_BUFFER_SIZE,
+        select_timeout=FCAST_SELECT_TIMEOUT,
+        ping_interval=FCAST_PING_INTERVAL,
+        idle_timeout=FCAST_TIMEOUT / 1000,
+        admission=admission,
+    )
+
+    def on_connect(session: FCastSession, addr):
+        register_session_handlers(session)
+        open_session(session, addr)
+    server.on_connect = on_connect
 
-def main():
-    global player, sessions, session_threads, player_thread, http_server
+    try:
+        server.bind()
+    except:
+        notify("Bind failed", xbmcgui.NOTIFICATION_ERROR)
+        server.close()
+        return
 
-    notify("Starting FCast receiver ...")
-    # List of active sessions
+    if FCAST_WEBSOCKET_PORT:
+        from .FCastWebSocket import FCastWebSocketSession
+        try:
+            server.listen(FCAST_WEBSOCKET_PORT, FCastWebSocketSession)
+        except OSError as e:
+            # Raw TCP senders can still connect
+            log("WebSocket bind failed", xbmc.LOGWARNING, port=FCAST_WEBSOCKET_PORT, error=e)
 
-    # Create a socket for the FCast receiver
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.setblocking(False)
-    s.settimeout(FCAST_TIMEOUT / 1000)
-    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    notify("Server listening on port %d" % FCAST_PORT, timeout=1000)
 
-    player = FCastPlayer(sessions)
-    player_thread = Thread(target=check_player)
-    player_thread.start()
+    server.serve(monitor)
+
+# Serve FCast clients from an asyncio event loop running in its own thread
+def serve_asyncio(monitor: xbmc.Monitor, deadline: Callable[[], Deadline]):
+    from .FCastAsyncServer import FCastAsyncServer, FCastAsyncWebSocketSession
 
-    # Create HTTP server to stream manifest files
-    http_server = FCastHTTPServer()
-    http_server.start()
+    server = FCastAsyncServer(
+        FCAST_HOST,
+        FCAST_PORT,
+        on_disconnect=end_session,
+        ping_interval=FCAST_PING_INTERVAL,
+        idle_timeout=FCAST_TIMEOUT / 1000,
+        admission=admission,
+    )
+
+    def on_connect(session: FCastSession, addr):
+        register_session_handlers(session, wrap=server.to_async)
+        open_session(session, addr)
+    server.on_connect = on_connect
+    if FCAST_WEBSOCKET_PORT:
+        server.listen(FCAST_WEBSOCKET_PORT, FCastAsyncWebSocketSession)
 
     try:
-        s.bind((FCAST_HOST, FCAST_PORT))
-        s.listen()
+        server.start()
     except:
         notify("Bind failed", xbmcgui.NOTIFICATION_ERROR)
-        s.close()
-        exit()
-
-    # Set up event listener that detects for a new socket connection
-    selector = selectors.DefaultSelector()
-    selector.register(s, selectors.EVENT_READ, data=None)
+        return
 
     notify("Server listening on port %d" % FCAST_PORT, timeout=1000)
 
-    monitor = xbmc.Monitor()
-    # Loop for new connections
-    while not monitor.abortRequested():
-        events = selector.select(timeout=0)
-
-        # Check for connections
-        for key, mask in events:
-            if key.data is None:
-                conn, addr = s.accept()
-                conn.setblocking(False)
-                # Create a new thread for the connection
-                t = Thread(target=connection_handler, args=(conn, addr))
-                session_threads.append(t)
-                t.start()
+    monitor.waitForAbort()
+    server.stop(deadline().remaining())
 
-        # Remove dead threads from sessions list on every timeout or other exception
-        session_threads = [t for t in session_threads if t.is_alive()]
+def register_metrics():
+    """Expose counters kept by the receiver's components on /metrics, read from the current globals"""
+    global metrics_registered
+    if metrics_registered:
+        return
+    metrics_registered = True
+
+    metrics.collect('fcast_sessions', 'Connected FCast sessions', lambda: len(sessions))
+    metrics.collect('fcast_outbound_queue_packets', 'Packets queued for connected sessions',
+        lambda: sum(session.queue_stats()['queue_depth'] for session in sessions.snapshot()))
+    metrics.collect('fcast_outbound_queue_bytes', 'Bytes queued for connected sessions',
+        lambda: sum(session.queue_stats()['queue_bytes'] for session in sessions.snapshot()))
+    metrics.collect('fcast_admitted_connections', 'Connections counted by admission control', lambda: admission.connections)
+    metrics.collect('fcast_seeks_received_total', 'Seek requests received', lambda: seek_coalescer.received, 'counter')
+    metrics.collect('fcast_seeks_executed_total', 'Seeks applied to the player after coalescing', lambda: seek_coalescer.executed, 'counter')
+    metrics.collect('fcast_seek_coalescing_ratio', 'Share of received seeks that were coalesced away',
+        lambda: 1 - seek_coalescer.executed / seek_coalescer.received if seek_coalescer.received else 0)
+    metrics.collect('fcast_manifest_requests_total', 'Manifest lookups', lambda: http_server.content_store.hits, 'counter', result='hit')
+    metrics.collect('fcast_manifest_requests_total', 'Manifest lookups', lambda: http_server.content_store.misses, 'counter', result='miss')
+    metrics.collect('fcast_manifests_deduplicated_total', 'Manifests stored as a reference to an identical one', lambda: http_server.content_store.deduplicated, 'counter')
+    metrics.collect('fcast_manifest_evictions_total', 'Manifest tokens evicted for memory or idleness', lambda: http_server.content_store.evictions, 'counter')
+    metrics.collect('fcast_proxy_cache_requests_total', 'Proxied segment lookups', lambda: http_server.proxy.cache.hits, 'counter', result='hit')
+    metrics.collect('fcast_proxy_cache_requests_total', 'Proxied segment lookups', lambda: http_server.proxy.cache.misses, 'counter', result='miss')
+    metrics.collect('fcast_proxy_cache_bytes', 'Bytes held by the segment cache', lambda: http_server.proxy.cache.size)
+    metrics.collect('fcast_resolver_requests_total', 'Media URL resolutions', lambda: resolver.hits, 'counter', result='cached')
+    metrics.collect('fcast_resolver_requests_total', 'Media URL resolutions', lambda: resolver.misses, 'counter', result='resolved')
+    metrics.collect('fcast_stream_detections_memoized_total', 'Stream types detected from an earlier URL of the same service', lambda: stream_detector.memo_hits, 'counter')
+    metrics.collect('fcast_control_calls_total', 'Volume and speed calls made by senders', lambda: control.submitted, 'counter', result='received')
+    metrics.collect('fcast_control_calls_total', 'Volume and speed calls made by senders', lambda: control.sent, 'counter', result='sent')
+    metrics.collect('fcast_control_round_trips_total', 'JSON-RPC batches sent to Kodi', lambda: control.round_trips, 'counter')
+    metrics.collect('fcast_time_to_first_frame_seconds', 'Time from the last PLAY request to playback start',
+        lambda: player.last_ttff if player.last_ttff is not None else float('nan'))
+
+def shutdown(deadline: Deadline):
+    """Stop every subsystem that was started, giving up on stragglers once the deadline passed"""
+    global player, http_server, resolver, seek_coalescer, control, play_executor
+
+    # Sessions were closed by the server. Drop pending seeks before the player goes away
+    if seek_coalescer:
+        seek_coalescer.cancel()
+        log("Seek coalescing", **seek_coalescer.stats())
+        seek_coalescer = None
+    if control:
+        control.stop(deadline.remaining())
+        log("Control channel", **control.stats())
+        control = None
+    if play_executor:
+        cancel_play()
+        play_executor.shutdown(wait=False)
+        play_executor = None
+    if player:
+        player.reporter.stop(deadline.remaining())
+        player = None
+    if resolver:
+        log("URL resolutions", **resolver.stats())
+        resolver.close()
+        resolver = None
+    if http_server:
+        http_server.stop(deadline.remaining())
+        http_server = None
+    sessions.clear()
+    if FCastSession.recorder:
+        log("Recorded session traffic", path=FCastSession.recorder.path, records=FCastSession.recorder.records)
+        FCastSession.recorder.close()
+        FCastSession.recorder = None
 
-        if monitor.waitForAbort(0.250):
-            break
+    notify("Server stopped")
+    # Write queued log records and notifications before the addon exits
+    writer.stop(deadline.remaining())
 
-    s.close()
+def main():
+    global player, seek_coalescer
 
-    http_server.stop()
+    notify("Starting FCast receiver ...")
 
-    notify("Server stopped")
+    # The playback reporter starts on the first player callback or session,
+    # the HTTP server (unless metrics are enabled) and URL resolver on the first play request needing them,
+    # the control channel on the first session (which asks for the volume) or volume or speed request,
+    # the playlist, recorder and WebSocket modules are only imported when used
+    player = FCastPlayer(sessions)
+    seek_coalescer = Coalescer(do_seek, FCAST_SEEK_INTERVAL, FCAST_SEEK_LEADING, FCAST_SEEK_TRAILING)
+    if FCAST_RECORDING_PATH:
+        from .FCastRecorder import SessionRecorder
+        FCastSession.recorder = SessionRecorder(FCAST_RECORDING_PATH)
+    register_metrics()
+    if FCAST_METRICS_ENABLED:
+        get_http_server()
+
+    # The deadline starts when Kodi requests the abort, i.e. when serving returns
+    deadline: Optional[Deadline] = None
+    def shutdown_deadline() -> Deadline:
+        nonlocal deadline
+        if not deadline:
+            deadline = Deadline(FCAST_SHUTDOWN_TIMEOUT)
+        return deadline
+
+    monitor = FCastMonitor(player)
+    if FCAST_USE_ASYNCIO:
+        serve_asyncio(monitor, shutdown_deadline)
+    else:
+        serve_selector(monitor)
+
+    shutdown(shutdown_deadline())
     exit()
 
 if __name__ == '__main__':
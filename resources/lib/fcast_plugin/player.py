@@ -1,73 +1,306 @@
+import json
+import math
+from threading import Event, Lock, Thread
+import time
 import xbmc
 
-from .FCastSession import FCastSession, PlayBackUpdateMessage, PlayBackState
+from .FCastCodec import encode_packet
+from .FCastMetrics import BROADCAST_LATENCY, TIME_TO_FIRST_FRAME
+from .FCastPackets import EventMessage, EventType, MediaItem, PlayMessage, PlayUpdateMessage
+from .FCastPlaybackState import PlaybackStateStore
+from .FCastSession import FCastSession, OpCode, PlayBackState
+from .FCastSessionRegistry import SessionRegistry
 from .util import log
 
-from typing import List
+from typing import Optional, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from .FCastPlaylist import Playlist
+
+# Wake up slightly after the second boundary so that getTime() has moved past it
+BOUNDARY_MARGIN = 0.02
+# Seconds between getTime() calls correcting the extrapolated position for drift and stalls
+RESYNC_INTERVAL = 10.0
+
+class PlaybackReporter:
+    """
+    Sends position updates to senders once per second of media time.
+    Instead of polling Kodi, it predicts when the next whole second is reached
+    from the cached playback state, and sleeps until then.
+    While nothing plays or playback is paused it sleeps until a player callback wakes it;
+    the thread itself is only started by the first wake().
+    """
+
+    thread: Optional[Thread] = None
+
+    def __init__(self, player: 'FCastPlayer'):
+        self.player = player
+        self._wakeup = Event()
+        self._lock = Lock()
+        self._stopped = False
+
+    def start(self):
+        with self._lock:
+            if self.thread:
+                return
+            self._stopped = False
+            self.thread = Thread(target=self.__run, name='fcast-reporter', daemon=True)
+            self.thread.start()
+
+    def stop(self, timeout: Optional[float] = None):
+        with self._lock:
+            self._stopped = True
+            thread = self.thread
+        self._wakeup.set()
+        if thread:
+            thread.join(timeout)
+
+    def wake(self):
+        # Nothing needs reporting before the first player callback, so the thread starts then
+        if not self.thread and not self._stopped:
+            self.start()
+        self._wakeup.set()
+
+    def __run(self):
+        log("Starting playback reporter")
+        while not self._stopped:
+            self._wakeup.clear()
+            delay = self.player.report()
+            # None means there is nothing to report until a player callback fires
+            self._wakeup.wait(delay)
+        log("Exiting playback reporter")
 
 class FCastPlayer(xbmc.Player):
-    playback_speed: float = 1.0
-    sessions: List[FCastSession]
+    sessions: SessionRegistry
+    # Last known playback state, sent to senders without asking Kodi
+    state: PlaybackStateStore
     is_paused: bool = False
+    # Set between playback start and stop/end, so the reporter never queries an idle player
+    is_active: bool = False
     # Used to perform time updates
     prev_time: int = -1
+    # What the senders asked to play: the PLAY message, or the playing item of a playlist
+    play_data: Optional[PlayMessage] = None
+    media_item: Optional[MediaItem] = None
+    playlist: Optional['Playlist'] = None
+    # Item of the last onAVStarted, to tell a new item from a restarted one
+    started_item: Optional[MediaItem] = None
+    # Time to first frame: from the PLAY request to Kodi reporting started playback
+    play_requested_at: Optional[float] = None
+    resolve_time: Optional[float] = None
+    last_ttff: Optional[float] = None
 
-    def __init__(self, sessions: List[FCastSession]):
+    def __init__(self, sessions: SessionRegistry):
         self.sessions = sessions
+        self.state = PlaybackStateStore()
+        self.reporter = PlaybackReporter(self)
         super().__init__()
-    
+
     def doPause(self) -> None:
         if not self.is_paused:
             self.is_paused = True
             self.pause()
-    
+
     def doResume(self) -> None:
         if self.is_paused:
             self.is_paused = False
             self.pause()
 
+    def set_play_data(self, message: PlayMessage, playlist: Optional['Playlist'] = None) -> None:
+        """Record what is about to play, replacing the previous playlist"""
+        if self.playlist and self.playlist is not playlist:
+            self.playlist.close()
+        self.playlist = playlist
+        if playlist:
+            self.media_item = playlist.item()
+            self.play_data = self.media_item.to_play_message() if self.media_item else message
+        else:
+            self.play_data = message
+            self.media_item = MediaItem(
+                message.container,
+                url=message.url,
+                content=message.content,
+                time=message.time,
+                volume=message.volume,
+                speed=message.speed,
+                headers=message.headers,
+                metadata=message.metadata,
+            )
+
+    def mark_play_requested(self) -> None:
+        self.play_requested_at = time.monotonic()
+        self.resolve_time = None
+
     def onAVStarted(self) -> None:
         log("Playback started")
+        if self.play_requested_at is not None:
+            self.last_ttff = time.monotonic() - self.play_requested_at
+            TIME_TO_FIRST_FRAME.observe(self.last_ttff)
+            self.play_requested_at = None
+            log("Time to first frame", seconds=self.last_ttff, resolve_seconds=self.resolve_time)
+        # Kodi moves on to the next playlist entry without reporting the end of the previous one
+        previous = self.started_item if self.is_active else None
         self.is_paused = False
+        self.is_active = True
+        self.prev_time = -1
+        try:
+            duration: Optional[float] = self.getTotalTime()
+        except RuntimeError:
+            duration = None
+        item_index = self.__sync_playlist()
+        self.state.update(PlayBackState.PLAYING, self.__get_time(), duration, 1.0, item_index)
+
+        item = self.media_item
+        if item and item is not self.started_item:
+            if previous:
+                self.broadcast_event(EventType.MEDIA_ITEM_END, previous)
+            self.started_item = item
+            self.broadcast(OpCode.PLAY_UPDATE, PlayUpdateMessage(self.play_data), min_version=3)
+            self.broadcast_event(EventType.MEDIA_ITEM_CHANGE, item)
+        if item:
+            self.broadcast_event(EventType.MEDIA_ITEM_START, item)
+        if self.playlist:
+            self.playlist.preload()
         # Start time loop once the player is active
-        self.onPlayBackTimeChanged()
+        self.reporter.wake()
 
     def onPlayBackStopped(self) -> None:
         self.onPlayBackEnded()
 
     def onPlayBackPaused(self) -> None:
         self.is_paused = True
+        self.state.update(PlayBackState.PAUSED, self.__get_time())
         self.onPlayBackTimeChanged()
 
     def onPlayBackResumed(self) -> None:
         self.is_paused = False
-    
+        self.state.update(PlayBackState.PLAYING)
+        self.reporter.wake()
+
+    def onPlayBackSeek(self, time: int, seekOffset: int) -> None:
+        # Kodi passes the new position in milliseconds
+        self.state.update(position=time / 1000)
+        self.prev_time = -1
+        self.reporter.wake()
+
     def onPlayBackEnded(self) -> None:
-        for session in self.sessions:
-            session.send_playback_update(PlayBackUpdateMessage(
-                0,
-                PlayBackState.IDLE,
-            ))
-    
+        if self.is_active and self.media_item:
+            self.broadcast_event(EventType.MEDIA_ITEM_END, self.media_item)
+        self.is_active = False
+        self.prev_time = -1
+        self.state.update(PlayBackState.IDLE, 0.0, None, 1.0, None)
+        self.broadcast(OpCode.PLAYBACK_UPDATE, self.state.playback_update())
+
     def onPlayBackError(self) -> None:
         self.onPlayBackEnded()
-    
+
     def onPlayBackSpeedChanged(self, speed: int) -> None:
-        self.playback_speed = speed
-    
+        changed = self.state.speed != speed
+        self.state.update(speed=speed)
+        if changed and self.is_active:
+            # Senders extrapolate with the speed, tell them before the next whole second
+            self.onPlayBackTimeChanged()
+        self.reporter.wake()
+
+    def report(self) -> Optional[float]:
+        """Send an update if a new second was reached, return the delay until the next one is due"""
+        speed = self.state.speed
+        if not self.is_active or self.is_paused or speed == 0:
+            return None
+
+        now = time.monotonic()
+        if self.state.sample_age(now) >= RESYNC_INTERVAL:
+            try:
+                self.state.update(position=self.getTime())
+            except RuntimeError:
+                # Playback stopped in the meantime, a callback will follow
+                return None
+
+        position = self.state.position(now)
+        if int(position) != self.prev_time:
+            self.onPlayBackTimeChanged()
+
+        # Predict when media time crosses the next whole second
+        if speed > 0:
+            remaining = math.floor(position) + 1 - position
+        else:
+            remaining = position - (math.ceil(position) - 1)
+        return remaining / abs(speed) + BOUNDARY_MARGIN
+
     # Not overriden
     def onPlayBackTimeChanged(self) -> None:
-        time_int = int(self.getTime())
-        self.prev_time = int(self.getTime())
-        pb_message = PlayBackUpdateMessage(
-            time_int,
-            PlayBackState.PAUSED if self.is_paused else PlayBackState.PLAYING,
-        )
-        for session in self.sessions:
-            session.send_playback_update(pb_message)
-    
+        message = self.state.playback_update()
+        self.prev_time = int(message.time)
+        self.broadcast(OpCode.PLAYBACK_UPDATE, message)
+
+    def onVolumeChanged(self, volume: float) -> None:
+        # Reported both by Kodi's notification and the JSON-RPC result, only changes are sent
+        if self.state.set_volume(volume):
+            self.broadcast(OpCode.VOLUME_UPDATE, self.state.volume_update())
+
+    def send_snapshot(self, session: FCastSession):
+        """Bring a new sender up to date without waiting for the next update"""
+        for opcode, message in self.state.snapshot():
+            session.send_packet(encode_packet(opcode, message), opcode == OpCode.PLAYBACK_UPDATE)
+
+    def broadcast(self, opcode: OpCode, message = None, min_version: int = 1):
+        # Serialize once and write the same buffer to every session
+        start = time.perf_counter()
+        packet = encode_packet(opcode, message)
+        coalesce = opcode == OpCode.PLAYBACK_UPDATE
+        for session in self.sessions.snapshot():
+            if session.version >= min_version:
+                session.send_packet(packet, coalesce)
+        BROADCAST_LATENCY.observe(time.perf_counter() - start)
+
+    def broadcast_event(self, event_type: EventType, item: MediaItem):
+        """Send a media item event to the sessions subscribed to it"""
+        subscribers = [session for session in self.sessions.snapshot() if event_type in session.subscriptions]
+        if not subscribers:
+            return
+        packet = encode_packet(OpCode.EVENT, EventMessage.media_item(event_type, item))
+        for session in subscribers:
+            session.send_event(packet, event_type)
+
     def addSession(self, session: FCastSession):
-        self.sessions.append(session)
-    
+        self.sessions.add(session)
+
     def removeSession(self, session: FCastSession):
-        self.sessions.remove(session)
+        self.sessions.discard(session)
+
+    def __sync_playlist(self) -> Optional[int]:
+        """Follow Kodi moving through the playlist, return the playing item's index"""
+        playlist = self.playlist
+        if not playlist:
+            return None
+        index = playlist.index_at(xbmc.PlayList(xbmc.PLAYLIST_VIDEO).getposition())
+        if index is not None and index != playlist.index:
+            playlist.index = index
+        item = playlist.item()
+        if item is not self.media_item and item:
+            self.media_item = item
+            self.play_data = item.to_play_message()
+        return playlist.index
+
+    def __get_time(self) -> float:
+        try:
+            return self.getTime()
+        except RuntimeError:
+            return self.state.position()
+
+class FCastMonitor(xbmc.Monitor):
+    """Forwards Kodi notifications the player has no callback for"""
+
+    def __init__(self, player: FCastPlayer):
+        self.player = player
+        super().__init__()
+
+    def onNotification(self, sender: str, method: str, data: str) -> None:
+        if method != 'Application.OnVolumeChanged':
+            return
+        try:
+            volume = json.loads(data)['volume']
+        except (ValueError, KeyError, TypeError):
+            return
+        # Kodi reports 0-100, FCast uses 0-1
+        self.player.onVolumeChanged(volume / 100)
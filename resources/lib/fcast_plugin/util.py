@@ -1,28 +1,337 @@
 import xbmc
 import xbmcgui
 import xbmcaddon
-from threading import Timer
+from collections import deque, OrderedDict
+from threading import Condition, Lock, Thread, Timer
+import time
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from concurrent.futures import Future
 
 # Retrieve Kodi addon information
 addon       = xbmcaddon.Addon()
 addonname   = addon.getAddonInfo('name')
 
-def notify(msg, icon=xbmcgui.NOTIFICATION_INFO, timeout=3000, sound=False):
-    xbmcgui.Dialog().notification(addonname, msg, icon, timeout, sound)
+# Messages per second allowed for each log key, and the burst allowed above that rate
+LOG_RATE = 5.0
+LOG_BURST = 20
+# Records waiting for the writer thread; the oldest are dropped beyond this
+LOG_QUEUE_MAX = 1000
+# Number of log keys tracked for rate limiting
+LOG_KEYS_MAX = 512
+# Notifications sharing a key within this many seconds are shown as one
+NOTIFY_COALESCE_INTERVAL = 1.5
+# Notifications without a key waiting to be shown; the oldest are dropped beyond this
+NOTIFY_QUEUE_MAX = 8
+
+class Deadline:
+    """Point in time after which waiting on anything is given up"""
+
+    def __init__(self, seconds: float):
+        self.expires = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        return max(self.expires - time.monotonic(), 0.0)
+
+class PendingNotification:
+    __slots__ = ('message', 'plural', 'icon', 'timeout', 'sound', 'count', 'due')
+
+    def __init__(self, message: str, plural: Optional[str], icon: str, timeout: int, sound: bool, due: float):
+        self.message = message
+        self.plural = plural
+        self.icon = icon
+        self.timeout = timeout
+        self.sound = sound
+        self.count = 1
+        self.due = due
+
+class LogWriter:
+    """
+    Writes log records and shows notifications from a background thread, so that
+    callers only pay for queuing them. Records are formatted by the writer.
+
+    Each log key (the message template unless given) is rate limited with a token
+    bucket; suppressed records are counted and reported with the next one written.
+    Notifications given a key are held for NOTIFY_COALESCE_INTERVAL and merged
+    with later ones of the same key. Notifications without a key are shown as
+    they come, and only the most recent NOTIFY_QUEUE_MAX of them are kept.
+    """
+
+    thread: Optional[Thread] = None
+
+    def __init__(self, rate: float = LOG_RATE, burst: int = LOG_BURST, queue_max: int = LOG_QUEUE_MAX):
+        self.rate = rate
+        self.burst = burst
+        self.dropped = 0
+        self.suppressed = 0
+        self._condition = Condition(Lock())
+        self._records: Deque[Tuple[int, str, Dict[str, Any], int]] = deque(maxlen=queue_max)
+        # key -> [tokens, last refill, suppressed since last written, occurrences]
+        self._limits: 'OrderedDict[str, List[float]]' = OrderedDict()
+        self._notifications: Dict[str, PendingNotification] = {}
+        self._immediate: Deque[PendingNotification] = deque(maxlen=NOTIFY_QUEUE_MAX)
+        self._stopped = False
+
+    def log(self, msg: str, level: int, key: Optional[str], sample: int, fields: Dict[str, Any]):
+        with self._condition:
+            suppressed = self.__admit(msg if key is None else key, sample)
+            if suppressed is None:
+                return
+            if len(self._records) == self._records.maxlen:
+                self.dropped += 1
+            self._records.append((level, msg, fields, suppressed))
+            self.__start()
+            self._condition.notify()
+
+    def notify(self, msg: str, icon: str, timeout: int, sound: bool, key: Optional[str], plural: Optional[str]):
+        with self._condition:
+            pending = self._notifications.get(key) if key else None
+            if pending:
+                pending.count += 1
+                pending.message = msg
+            elif key:
+                self._notifications[key] = PendingNotification(msg, plural, icon, timeout, sound, time.monotonic() + NOTIFY_COALESCE_INTERVAL)
+            else:
+                self._immediate.append(PendingNotification(msg, None, icon, timeout, sound, 0))
+            self.__start()
+            self._condition.notify()
+
+    def stop(self, timeout: Optional[float] = 1.0):
+        """Write what is queued, including held notifications, and stop the writer"""
+        with self._condition:
+            self._stopped = True
+            for pending in self._notifications.values():
+                pending.due = 0
+            self._condition.notify()
+            thread = self.thread
+        if thread:
+            thread.join(timeout)
+        with self._condition:
+            # The writer starts again if the service is started once more in this interpreter
+            self.thread = None
+            self._stopped = False
+
+    def __admit(self, key: str, sample: int) -> Optional[int]:
+        """Apply sampling and the key's rate limit, return the count suppressed before, None to drop"""
+        now = time.monotonic()
+        limit = self._limits.get(key)
+        if limit is None:
+            limit = self._limits[key] = [float(self.burst), now, 0, 0]
+            if len(self._limits) > LOG_KEYS_MAX:
+                self._limits.popitem(last=False)
+        else:
+            self._limits.move_to_end(key)
+        limit[3] += 1
+        if sample > 1 and (limit[3] - 1) % sample:
+            return None
+
+        limit[0] = min(limit[0] + (now - limit[1]) * self.rate, self.burst)
+        limit[1] = now
+        if limit[0] < 1:
+            limit[2] += 1
+            self.suppressed += 1
+            return None
+        limit[0] -= 1
+        suppressed = int(limit[2])
+        limit[2] = 0
+        return suppressed
+
+    def __start(self):
+        if not self.thread and not self._stopped:
+            self.thread = Thread(target=self.__run, name='fcast-log', daemon=True)
+            self.thread.start()
+
+    def __run(self):
+        while True:
+            with self._condition:
+                while True:
+                    now = time.monotonic()
+                    due = [key for key, pending in self._notifications.items() if pending.due <= now]
+                    if self._records or self._immediate or due or self._stopped:
+                        break
+                    wait = min((pending.due for pending in self._notifications.values()), default=now + 60) - now
+                    self._condition.wait(wait)
+                records = list(self._records)
+                self._records.clear()
+                notifications = list(self._immediate) + [self._notifications.pop(key) for key in due]
+                self._immediate.clear()
+                stopped = self._stopped and not self._notifications
+
+            for level, msg, fields, suppressed in records:
+                self.__write(level, msg, fields, suppressed)
+            for pending in notifications:
+                self.__show(pending)
+            if stopped:
+                return
+
+    def __write(self, level: int, msg: str, fields: Dict[str, Any], suppressed: int):
+        try:
+            if fields:
+                msg = msg + ' ' + ' '.join('%s=%s' % item for item in fields.items())
+            if suppressed:
+                msg += ' (%d similar messages suppressed)' % suppressed
+            xbmc.log("%s: %s" % (addonname, msg), level=level)
+        except Exception:
+            pass
+
+    def __show(self, pending: PendingNotification):
+        message = pending.plural % pending.count if pending.count > 1 and pending.plural else pending.message
+        try:
+            xbmcgui.Dialog().notification(addonname, message, pending.icon, pending.timeout, pending.sound)
+        except Exception:
+            pass
+
+writer = LogWriter()
+
+def notify(msg, icon=xbmcgui.NOTIFICATION_INFO, timeout=3000, sound=False, key: Optional[str] = None, plural: Optional[str] = None):
+    """
+    Show a notification from the writer thread. Notifications sharing a `key` are coalesced:
+    when several arrive close together, `plural` formatted with their count is shown instead.
+    """
+    writer.notify(msg, icon, timeout, sound, key, plural)
+
+def log(msg, level=xbmc.LOGDEBUG, key: Optional[str] = None, sample: int = 1, **fields):
+    """
+    Queue a log record. Keyword fields are appended as key=value when the record is written,
+    so callers never format anything. Records are rate limited per `key` (by default the
+    message itself); with `sample`, only every n-th record of the key is considered.
+    """
+    writer.log(msg, level, key, sample, fields)
+
+class Coalescer:
+    """
+    Rate limits calls to `func` to one every `interval` seconds, keeping only the
+    most recent value submitted in between. With `leading`, a value submitted while
+    idle is applied right away; with `trailing`, the latest pending value is applied
+    once the interval has elapsed (since the first value of the burst without
+    `leading`). At most one Timer thread exists at any time.
+    """
+
+    def __init__(self, func: Callable[[Any], Any], interval: float, leading: bool = True, trailing: bool = True):
+        self.func = func
+        self.interval = interval
+        self.leading = leading
+        self.trailing = trailing
+        # Values submitted and values actually applied
+        self.received = 0
+        self.executed = 0
+        self._lock = Lock()
+        self._timer: Optional[Timer] = None
+        self._pending: Any = None
+        self._has_pending = False
+        self._last_call = -interval
+
+    def submit(self, value: Any):
+        with self._lock:
+            self.received += 1
+            now = time.monotonic()
+            if self.leading and not self._timer and now - self._last_call >= self.interval:
+                self._last_call = now
+                self._has_pending = False
+                self.executed += 1
+            else:
+                self._pending = value
+                self._has_pending = True
+                if self.trailing and not self._timer:
+                    # Without a leading call, the burst starts now and is applied a full interval later
+                    delay = max(self.interval - (now - self._last_call), 0) if self.leading else self.interval
+                    self._timer = Timer(delay, self.__fire)
+                    self._timer.daemon = True
+                    self._timer.start()
+                return
+        self.__call(value)
+
+    def cancel(self):
+        with self._lock:
+            if self._timer:
+                self._timer.cancel()
+            self._timer = None
+            self._has_pending = False
+            self._pending = None
+
+    def stats(self) -> Dict[str, int]:
+        return {'received': self.received, 'executed': self.executed}
+
+    def __fire(self):
+        with self._lock:
+            self._timer = None
+            if not self._has_pending:
+                return
+            value = self._pending
+            self._pending = None
+            self._has_pending = False
+            self._last_call = time.monotonic()
+            self.executed += 1
+        self.__call(value)
+
+    def __call(self, value: Any):
+        try:
+            self.func(value)
+        except Exception as e:
+            log("Coalesced call failed", xbmc.LOGERROR, error=e)
+
+class DaemonExecutor:
+    """
+    Subset of ThreadPoolExecutor (submit, shutdown) running on daemon threads.
+    The interpreter joins ThreadPoolExecutor workers at exit, so a worker stuck
+    on an unresponsive origin would hold up Kodi past the shutdown deadline;
+    these workers are abandoned instead. Workers are started as work arrives,
+    up to `max_workers`, and run what was submitted before shutdown.
+    """
 
-def log(msg, level=xbmc.LOGDEBUG):
-    xbmc.log("%s: %s" % (addonname, msg), level=level)
+    def __init__(self, max_workers: int, thread_name_prefix: str):
+        self.max_workers = max_workers
+        self.thread_name_prefix = thread_name_prefix
+        self._condition = Condition(Lock())
+        self._queue: Deque[Tuple['Future', Callable[..., Any], Tuple[Any, ...]]] = deque()
+        self._threads: List[Thread] = []
+        self._idle = 0
+        self._shutdown = False
 
-# Trottle repeated attempts at a function call
-def debounce(func, wait):
-    class _debounce:
-        timer: Timer
+    def submit(self, fn: Callable[..., Any], *args: Any) -> 'Future':
+        from concurrent.futures import Future
+        future: 'Future' = Future()
+        with self._condition:
+            if self._shutdown:
+                raise RuntimeError('cannot schedule new futures after shutdown')
+            self._queue.append((future, fn, args))
+            if len(self._queue) > self._idle and len(self._threads) < self.max_workers:
+                thread = Thread(
+                    target=self.__run,
+                    name='%s_%d' % (self.thread_name_prefix, len(self._threads)),
+                    daemon=True
+                )
+                self._threads.append(thread)
+                thread.start()
+            else:
+                self._condition.notify()
+        return future
 
-        @staticmethod
-        def debounced(*args, **kwargs):
-            _debounce.timer.cancel()
-            _debounce.timer = Timer(wait, func, args=args, kwargs=kwargs)
-            _debounce.timer.start()
+    def shutdown(self, wait: bool = True):
+        with self._condition:
+            self._shutdown = True
+            self._condition.notify_all()
+            threads = list(self._threads)
+        if wait:
+            for thread in threads:
+                thread.join()
 
-    _debounce.timer = Timer(0, lambda: None)  # Initial dummy timer
-    return _debounce.debounced
+    def __run(self):
+        while True:
+            with self._condition:
+                self._idle += 1
+                while not self._queue and not self._shutdown:
+                    self._condition.wait()
+                self._idle -= 1
+                if not self._queue:
+                    return
+                future, fn, args = self._queue.popleft()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = fn(*args)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)